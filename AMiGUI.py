@@ -1,15 +1,45 @@
-import serial, tkinter as tk
-from time import sleep
-from datetime import datetime
-from shutil import copyfile
-from picamera import PiCamera
-import numpy as np, RPi.GPIO as GPIO
-import re, sys, os
+from time import sleep, monotonic
+started=monotonic() # startup is timed from here
+import tkinter as tk
+import numpy as np
+import sys, os, threading, queue
+import ami_hardware, ami_run, ami_plan, ami_stack, ami_focusmap, ami_schedule, ami_server, ami_grbl, ami_jog
+from ami_run import tdate, Ualphabet, Lalphabet
 
 camera_delay=.2 # delay, in seconds, that the system should sit idle before each image 
+settle_mode='fixed' # 'fixed' waits camera_delay before each RUN image; 'frames' watches the video until the picture is still; 'model' waits longer after longer moves (see ami_settle)
+settle_min=0.05 # with settle_mode 'model': seconds after a move of no distance...
+settle_per_mm=0.005 # ...plus this much per mm moved (settle.log of a 'frames' run says what fits this instrument)
+settle_cap=1.0 # longest RUN ever waits to settle
 fracbelow=0.5 # this is the fraction of zrange below the expected plane of focus
 xmax,ymax,zmax=160.,118.,29.3 #translation limits in mm  
+jog_hold=0.4 # seconds a click pad has to be held down before the stage jogs on until it is let go (see ami_jog)
+jog_feed=1000. # mm/min of that jog with the pointer at the edge of a pad, slower nearer the middle
 disable_hard_limits=True  #this disables hard limits during RUN only
+pipelined_capture=True # save images in the background while the stage moves to the next z
+stream_stacks=False # send each z-stack to grbl in one go and capture on its signal, instead of one slice at a time
+burst_capture=False # capture each z-stack from the video port into memory and encode it afterwards (one frame interval per slice)
+keep_raw_stacks=False # with burst_capture, also keep each stack as rawimages/<sample>.npy (about 6 MB a slice)
+stack_files=False # store each sample's z-stack as one rawimages/<sample>.amis file instead of jpegs (turns burst_capture on)
+capture_window=None # seconds grbl holds still for each capture when stream_stacks is on (None: fit it to the camera)
+plate_overview=True # keep overview.jpg in the run directory, the whole plate in one picture, up to date during RUN
+quality_index='images/metrics.db' # add each sample's sharpness, best focus, brightness and edge score to this SQLite file during RUN (see ami_metrics; None: don't)
+change_detection=False # compare a quick look at each sample with the plate's last run and take only a few slices of those that have not changed (see ami_change)
+change_threshold=0.25 # how different (0 the same, about 1 unrelated) a sample has to look to count as changed
+unchanged_images=1 # slices taken of a sample that has not changed
+fuse_during_run=True # focus-stack each sample in the background as soon as its images are taken (needs PIL)
+autofocus_images=0 # with autofocus on (>0), take only this many full-size images per sample, centred on the sharpest z
+autofocus_steps=7 # number of small frames autofocus takes across the z range
+use_focus_map=True # correct the corners' z with what autofocus and SET on a well have found for this plate (focusmap_*.txt)
+resume_within=6. # hours; RUN carries on an unfinished run of the same plate left off less than this long ago (0: always start a new one)
+metrics_file=None # also write each run's metrics here for the node exporter, e.g. '/var/lib/node_exporter/textfile_collector/ami.prom'
+schedule_file='schedule.txt' # plates to image on a timetable, RUN by themselves when they are due (see ami_schedule; None: never)
+schedule_days='0,1,3,7,14' # days after now that a right click on RUN schedules the loaded plate for
+schedule_check=60. # seconds between looks at the schedule
+control_address=None # e.g. ('127.0.0.1',8765), or ('0.0.0.0',8765) for the whole network: serve the control API there (see ami_server)
+control_token=None # with control_address, a password every request has to give
+idle_method='edge' # how to tell grbl has stopped moving: 'edge' (gpio 27 interrupt), 'status' (ask grbl) or 'poll' (the old way)
+run_order='serpentine' # order RUN visits the samples: 'raster' (row by row), 'serpentine' or 'shortest'
 samp=0  #samp is the sub-sample index (used when there is more than one sample at each position)
 samp_coord=[] #fractional coordinates of the individual samples 
 gx,gy=0,0      #clicked coordinates on the canvas
@@ -20,35 +50,27 @@ corner='unset'
 alphabet=''; nroot=''; sID=''
 fname='AMi.config'
 viewing=False; running=False; stopit=False
+scheduled=False; schedule_paused=False; own_fname=None # whether this RUN was started by the schedule, and the file loaded before it
 lighting1=False;lighting2=False
-Ualphabet='ABCDEFGHIJKLMNOPQRSTUVWXYZ'; Lalphabet='abcdefghijklmnopqrstuvwxyz'
 alphabet=[]
+simulate='--sim' in sys.argv # python3 AMiGUI.py --sim runs against the simulated grbl, camera and gpio
+offline='--offline' in sys.argv # python3 AMiGUI.py --offline opens no hardware at all, to edit configurations and schedules
 
 print('\n Bonjour, ami \n')
-if not os.path.isdir("images"): # check to be sure images directory exists
+def images_missing(): # True, and says so, when there is nowhere to put pictures
+   if os.path.isdir("images"): return False # check to be sure images directory exists
    print( "\"images\" directory (or symbolic link) not found. \n This should be in the same directory as this program. \n You need to create the directory or fix the link before continuing. \n i.e. mkdir images")
-   sys.exit()
+   if 'canvas' in globals():
+       canvas.create_rectangle(2,2,318,60,fill='white')
+       canvas.create_text(160,27,text=("no \"images\" directory here:\n make it (mkdir images) or fix the link first"),font="Helvetia 10")
+       canvas.update()
+   return True
+images_missing()
 
 def read_config():  # read information from the configuration file
     global tl,tr,bl,br,nx,ny,samps,zstep,nimages,nroot,sID,filee,alphabet,samp_coord
     try:
-        f=open(fname,'r')
-        jnk=list(map(int,(re.findall(r'\S+', (f.readline()).split('#', 1)[0]))))
-        nx=jnk[0]; ny=jnk[1]; samps=jnk[2]
-        tl=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
-        tr=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
-        bl=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
-        br=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
-        samp_coord=[]
-        for i in range(samps):
-            samp_coord.append(list(map(float,(re.findall(r'\S+',f.readline().split('#', 1)[0])))))
-        zstep=float((f.readline()).split('#', 1)[0])
-        nimages=int((f.readline()).split('#', 1)[0])
-        sID=(f.readline()).split('#', 1)[0]
-        sID=sID.replace("\n",""); sID=sID.replace(" ","")
-        nroot=(f.readline()).split('#', 1)[0]
-        nroot=nroot.replace("\n",""); nroot=nroot.replace(" ","")
-        alphabet=Ualphabet[0:ny]+Lalphabet[0:ny]
+        p=ami_run.read_config(fname)
     except:
         print(' The configuration file was missing or the format was not right. It should look something like this:')
         print('  12   8    1        # number of positions along x and y and on the plate then number of samples at each position') 
@@ -62,64 +84,96 @@ def read_config():  # read information from the configuration file
         print('   AMi_sample        # sample name (no spaces)')
         print('   AB_xs2            # plate name (no spaces)')
         print('File error.')
-        f.close()
-        if fname=='AMi.config': sys.exit()
+        if fname!='AMi.config': return
+        print(' Starting with a 12 x 8 plate instead; UPDATE writes it to '+fname)
+        p=ami_run.Plate()
+    nx,ny,samps=p.nx,p.ny,p.samps
+    tl,tr,bl,br=p.tl,p.tr,p.bl,p.br
+    samp_coord=p.samp_coord
+    zstep,nimages,sID,nroot=p.zstep,p.nimages,p.sID,p.nroot
+    alphabet=p.alphabet
 read_config()
 
-# camera setup
-camera = PiCamera()
-camera.resolution=(1640,1232)
-camera.iso=50 # nnot sure this does anytihng
-
-#light1 and light2 setup - this is controled by gpio pins 17 and 18 on the pi
-#the light2 button also controls the 24V output of the arduino
-#gpio 27 is used to tell the pi when the arduino has fininished moving
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup(17,GPIO.OUT) #controls light 1
-GPIO.setup(18,GPIO.OUT) #controls light 2
-GPIO.setup(27, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # signal for movement completion
-
-
-def tdate(): # get the current date as a nice string
-   dstr=(datetime.now().strftime('%h-%d-%Y_%I:%M%p')) 
-   dstr=dstr.replace(" ","")
-   return dstr
-
-def wait_for_Idle(): # wait for grbl to complete movement -new version wait for pin A8 to go low 
-   s.write(('m9 \n').encode('utf-8')) # set pin A3 low
-#   print('sending m9') #set A8 low 
-   sleep(0.2) #wait a little just in case
-   while GPIO.input(27):
-#      print('waiting...') 
-      sleep(0.1)
-   s.write(('m8 \n').encode('utf-8')) # set pin A3 high 
-#   print('our long wait has ended')
-   
-# connect to the arduino and set zero 
-s = serial.Serial('/dev/ttyUSB0',115200) # open grbl serial port
-s.write(("\r\n\r\n").encode('utf-8')) # Wake up grbl
-sleep(2)   # Wait for grbl to initialize
-s.flushInput()  # Flush startup text in serial input
-s.write(('$21=1 \n').encode('utf-8')) # enable hard limits
-print(' ok so far...')
-s.write(('$H \n').encode('utf-8')) # tell grbl to find zero 
-grbl_out = s.readline() # Wait for grbl response with carriage return
-s.write(('? \n').encode('utf-8')) # Send g-code block to grbl
-response = s.readline().decode('utf-8') # Wait for grbl response with carriage return
-response=response.replace(":",","); response=response.replace(">",""); response=response.replace("<","")
-a_list=response.split(",")
-#print(a_list)
-wx=float(a_list[6]); wy=float(a_list[7]); wz=float(a_list[8])
-if wx==-199.0:
-  s.write(('G10 L2 P1 X '+str(wx)+' Y '+str(wy)+' Z '+str(wz)+' \n').encode('utf-8')) # ensures that zero is zero and not -199.0, -199.0, -199.0 
-  grbl_out = s.readline() # Wait for grbl response with carriage return
-s.write(('m8 \n').encode('utf-8')) # set pin A3 high -used later to detect end of movement 
-print(' You\'ll probably want to click VIEW and turn on some lights at this point. \n Then you may want to check the alignment of the four corner samples')
-s.write(('$x \n').encode('utf-8')) # unlock so spindle power can engage for light2 
-grbl_out = s.readline() # Wait for grbl response with carriage return
-s.write(('s1000 \n').encode('utf-8')) # set max spindle volocity
-grbl_out = s.readline() # Wait for grbl response with carriage return
+focusmap=None
+def focus_map(): # the focus map of the current plate, read from its file when the plate changes
+    global focusmap
+    path=ami_focusmap.path_for(fname,sID,nroot)
+    if focusmap is None or focusmap.path!=path: focusmap=ami_focusmap.FocusMap(path)
+    return focusmap
+
+def plate(): # the current parameters in the form ami_run wants them
+    return ami_run.Plate(nx,ny,samps,tl,tr,bl,br,samp_coord,zstep,nimages,sID,nroot,focus_map() if use_focus_map else None)
+
+the_plan=None; plan_key=None
+def plan(): # table of every sample's position and name, worked out again only when the plate changes
+    global the_plan,plan_key
+    p=plate()
+    key=repr((nx,ny,samps,list(p.tl),list(p.tr),list(p.bl),list(p.br),samp_coord[:samps],p.focusmap.coef.tolist() if p.focusmap else None))
+    if key!=plan_key: the_plan,plan_key=ami_plan.PlatePlan(p),key
+    return the_plan
+
+# the window comes up straight away; homing and the camera start meanwhile, side by side,
+# and the buttons that need them say so until they are ready (see check_startup)
+hw=None if offline else ami_hardware.open_hardware(simulate,images=True,defer_camera=True) # the simulated camera makes pictures that can be fused
+ami_run.idle_method=idle_method
+s,camera,GPIO,grbl=(hw.s,hw.camera,hw.GPIO,hw.grbl) if hw else (None,None,None,None)
+jog=ami_jog.Jogger(grbl,(xmax,ymax,zmax)) # the click pads' moves
+pad_down=False; pad_holding=False; pad_after=None
+control=ami_server.Controller(hw,lambda: plate(),lambda: run_options(),(xmax,ymax,zmax),run_order,resume_within,fuse_during_run,fname,
+                              where=lambda: (mx,my,mz),focus_maps=use_focus_map) # what remote clients can do, and the lock on the stage they share with the GUI
+
+def start_camera(): # camera setup, then a moment for it to settle its exposure
+    global camera
+    hw.status['camera']='opening'
+    c=hw.open_camera()
+    c.resolution=(1640,1232)
+    c.iso=50 # nnot sure this does anytihng
+    hw.status['camera']='warming up'
+    hw.clock.sleep(2)
+    camera=hw.camera=c
+
+if hw:
+    #light1 and light2 setup - this is controled by gpio pins 17 and 18 on the pi
+    #the light2 button also controls the 24V output of the arduino
+    #gpio 27 is used to tell the pi when the arduino has fininished moving
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+    GPIO.setup(17,GPIO.OUT) #controls light 1
+    GPIO.setup(18,GPIO.OUT) #controls light 2
+    GPIO.setup(27, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # signal for movement completion
+    hw.start('camera',start_camera)
+    hw.start('grbl',ami_run.home,hw) # connect to the arduino and set zero
+
+def wait_for_Idle(): # wait for grbl to complete movement
+   ami_run.wait_for_Idle(hw)
+
+def hardware_up(*parts,quiet=False): # True once parts (all of them by default) have started; otherwise says what is going on
+    if hw and hw.up(*parts): return True
+    if not quiet:
+        canvas.create_rectangle(2,2,318,60,fill='white')
+        if not hw: canvas.create_text(160,27,text=("offline: there is no hardware to use\n(restart without --offline for that)"),font="Helvetia 10")
+        else: canvas.create_text(160,27,text=("not ready yet: "+', '.join(p+' '+hw.status[p] for p in (parts or hw.ready) if hw.status[p]!='ready')),font="Helvetia 10",width=300)
+        canvas.update()
+    return False
+
+def check_startup(): # every 200 ms until homing and the camera are ready, showing how they are getting on
+    if not all(e.is_set() for e in hw.ready.values()):
+        canvas.create_rectangle(2,2,318,60,fill='white')
+        canvas.create_text(160,20,text=("starting up, nearly there..."),font="Helvetia 10")
+        canvas.create_text(160,40,text=(', '.join(p+': '+hw.status[p] for p in hw.ready)),font="Helvetia 9",fill="grey")
+        canvas.update()
+        root.after(200,check_startup)
+        return
+    print('hardware %s %.1f s after starting (%s)'%('ready' if hw.up() else 'NOT ready',monotonic()-started,
+                                                  ', '.join('%s %s in %.1f s'%(p,hw.status[p],hw.took[p]) for p in hw.ready)))
+    canvas.create_rectangle(2,2,318,60,fill='white')
+    if images_missing(): pass
+    elif hw.up():
+        print(' You\'ll probably want to click VIEW and turn on some lights at this point. \n Then you may want to check the alignment of the four corner samples')
+        canvas.create_text(160,32,text=(" The corner samples must be centered and \n in focus before imaging. Use blue buttons \n to check alignment, and XYZ windows to \n make corrections.  Good luck!!"),font="Helvetia 10",fill="darkblue")
+    else:
+        canvas.create_text(160,32,text=(', '.join(p+' '+hw.status[p] for p in hw.ready if hw.status[p]!='ready')+"\nfix it and restart"),font="Helvetia 10",fill="red",width=300)
+    canvas.update()
              
 def update_b(event): # write parameters to the configuration file
     global tl,tr,bl,br,nx,ny,zstep,nimages,nroot,sID,filee,fname,alphabet,samps
@@ -171,38 +225,74 @@ def read_b(event): #read parameters from specified configuration file
     sIDe.delete(0,tk.END); sIDe.insert(0,sID)
     IDe.delete(0,tk.END); IDe.insert(0,nroot)
     sampse.delete(0,tk.END); sampse.insert(0,samps)
+    control.fname=fname
     print('Parameters read from '+fname)
     canvas.update()
 
 def mcoords(): # moves to the position specified by xcol, yrow
     global mx,my,mz
     print('called mcoords with yrow,xcol,samp:',yrow,xcol,samp)
-    wait_for_Idle()
-    x=xcol/float(nx-1)+samp_coord[samp][0]
-    y=yrow/float(ny-1)+samp_coord[samp][1]
-    mx=br[0]*x*y+bl[0]*(1.-x)*y+tr[0]*x*(1.-y)+tl[0]*(1.-x)*(1.-y)
-    my=br[1]*x*y+bl[1]*(1.-x)*y+tr[1]*x*(1.-y)+tl[1]*(1.-x)*(1.-y)
-    mz=br[2]*x*y+bl[2]*(1.-x)*y+tr[2]*x*(1.-y)+tl[2]*(1.-x)*(1.-y)
-    print('mx,my,mz',mx,my,mz)
-    s.write(('G0 x '+str(mx)+' y '+str(my)+' z '+ str(mz) + ' \n').encode('utf-8')) # g-code to grbl
-    sleep(0.2)
-    grbl_out = s.readline() # Wait for grbl response with carriage return
-    letnum=alphabet[yrow]+str(xcol+1)
-    if samps>1:letnum+=Lalphabet[samp]
+    mx,my,mz=ami_run.goto(hw,plan().xyz[plan().index(yrow,xcol,samp)])
+    show_position(yrow,xcol,samp,mx,my,mz)
+
+def show_position(yrow,xcol,samp,mx,my,mz): # show where the stage is
+    letnum=plan().names[plan().index(yrow,xcol,samp)]
     pose.delete(0,tk.END); pose.insert(0,letnum)
-    wait_for_Idle()
     canvas.create_rectangle(2,2,318,60,fill='white')
     canvas.create_text(160,20,text=("showing "+letnum+'  position '+str(yrow*nx+xcol+1)),font="helvetica 11")
     canvas.create_text(160,39,text=('machine coordinates:  '+str(round(mx,3))+',  '+str(round(my,3))+',  '+str(round(mz,3))),font="helvetica 9",fill="grey")
     canvas.update()
 
+def gcode(line,timeout=None): # sends line to grbl and waits for the answer; False, and says why, when it did not work
+    try: grbl.command(line,timeout)
+    except ami_grbl.GrblError as e:
+        print(e)
+        canvas.create_rectangle(2,2,318,60,fill='white')
+        canvas.create_text(160,27,text=("grbl: "+str(e)+("\nclick reset to unlock or home it" if isinstance(e,ami_grbl.GrblAlarm) else "")),font="Helvetia 9",width=300)
+        canvas.update()
+        return False
+    return True
+
+def busy(quiet=False): # True, and says so, while RUN or a remote client is using the stage and camera
+    # (or they have not started yet); otherwise the GUI has them until the button or click that asked has been dealt with
+    if not hardware_up(quiet=quiet): return True
+    if control.lock.holder=='GUI' and not running: return False # already ours, for this click
+    if running or not control.lock.acquire('GUI'):
+        if not quiet:
+            canvas.create_rectangle(2,2,318,60,fill='white')
+            canvas.create_text(160,27,text=("RUN is going, click stop/close to stop it first" if running or control.lock.holder=='RUN'
+                                            else str(control.lock.holder)+" has the stage, try again in a moment"),font="Helvetia 10")
+            canvas.update()
+        return True
+    root.after_idle(release_gui)
+    if not quiet: jog.flush() # clicks on the pads go first
+    return False
+
+def release_gui(): # lets go of the stage once the pad's moves have all gone to grbl, and says if grbl refused one
+    if jog.pending():
+        root.after(20,release_gui)
+        return
+    control.lock.release('GUI')
+    if jog.error:
+        canvas.create_rectangle(2,2,318,60,fill='white')
+        canvas.create_text(160,27,text=("grbl refused the move:\n"+jog.error),font="Helvetia 9",width=300)
+        canvas.update()
+        jog.error=None
+
 def motion(event):
     global gx,gy,mx,my,mz
     gx, gy = event.x, event.y
 
 def left_click(event):
-    global gx,gy,corner,tl,tr,bl,br,pose,corner,alphabet,mx,my,mz,yrow,xcol,samps
+    global pad_down,pad_after
+    if busy(quiet=True): return # RUN or a remote client has the stage
     print('left_click gx,gy,xcol,yrow',gx,gy,xcol,yrow)
+    if pad_step():
+        pad_down=True
+        pad_after=root.after(int(jog_hold*1000),pad_hold)
+
+def pad_step(): # one click's move on the pad under the pointer; its direction and how far from the middle, or None
+    global mx,my,mz
 
     #adjust z
     if gx<40 and gy<335 and gy>65 :
@@ -210,12 +300,13 @@ def left_click(event):
         mzsav=mz
         mz+= 0.0001*(abs(rz)**2.2)*np.sign(rz)
         if mz>0. and mz<zmax:
-            s.write(('G0 z'+ str(mz) + '\n').encode('utf-8')) # Send g-code block to grbl
-            grbl_out = s.readline() # Wait for grbl response with carriage return
+            jog.go((mx,my,mz)) # merged with any other clicks still on their way
             if corner != 'unset':
                 canvas.create_rectangle(5,35,315,57,fill='white',outline='white')
                 canvas.create_text(160,47,text='current Z: '+str(round(mz,3))+' change: '+str(round((mz-mzsav),3)),font="Helvetia 9")
             print('current Z: '+str(round(mz,3))+' change: '+str(round((mz-mzsav),3)))
+            canvas.update()
+            return (0.,0.,np.sign(rz)),abs(rz)/135.
         else:
            canvas.create_rectangle(2,2,318,60,fill='white')
            canvas.create_text(160,27,text="that move would take you out of bounds",font="Helvetia 9")
@@ -229,21 +320,50 @@ def left_click(event):
         mx+= 0.0001*(abs(rx)**2.2)*np.sign(rx)
         my+= 0.0001*(abs(ry)**2.2)*np.sign(ry)
         if mx>0. and my>0. and mx<xmax and my<ymax:
-           s.write(('G0 x'+ str(mx) + ' y ' + str(my) +'\n').encode('utf-8')) 
-           grbl_out = s.readline() # Wait for grbl response with carriage return
+           jog.go((mx,my,mz)) # merged with any other clicks still on their way
            if corner != 'unset':
               canvas.create_rectangle(5,35,315,57,fill='white',outline='white')
               canvas.create_text(160,47,text='current X,Y: '+str(round(mx,3))+', '+str(round((my),3)),font="Helvetia 9")
            print('current X: '+str(round(mx,3))+' change: '+str(round((mx-mxsav),3)))
            print('current Y: '+str(round(my,3))+' change: '+str(round((my-mysav),3)))
+           canvas.update()
+           return (mx-mxsav,my-mysav,0.),min(1.,np.hypot(rx,ry)/135.)
         else:
            canvas.create_rectangle(2,2,318,60,fill='white')
            canvas.create_text(160,27,text="that move would take you out of bounds",font="Helvetia 9")
            mx,my=mxsav,mysav
         canvas.update()
 
+def pad_hold(): # the pad is still held down: jog on until it is let go
+    global pad_holding,pad_after
+    pad_after=None
+    if not pad_down or running or not (control.lock.holder=='GUI' or control.lock.acquire('GUI')): return # the GUI keeps the stage until then
+    step=pad_step()
+    if step is None:
+        release_gui()
+        return
+    direction,r=step
+    if jog.hold((mx,my,mz),direction,max(5.,jog_feed*r*r)): pad_holding=True
+    else:
+        release_gui()
+        if jog.mode=='g0': pad_after=root.after(250,pad_hold) # grbl cannot cancel a jog: repeat the click instead
+
+def left_release(event):
+    global pad_down,pad_holding,pad_after,mx,my,mz
+    pad_down=False
+    if pad_after: root.after_cancel(pad_after); pad_after=None
+    if pad_holding:
+        mx,my,mz=jog.stop() # the stage stops where it was let go
+        pad_holding=False
+        control.lock.release('GUI')
+        print('jogged to '+str(round(mx,3))+', '+str(round(my,3))+', '+str(round(mz,3)))
+        canvas.create_rectangle(5,35,315,57,fill='white',outline='white')
+        canvas.create_text(160,47,text='current X,Y,Z: '+str(round(mx,3))+', '+str(round(my,3))+', '+str(round(mz,3)),font="Helvetia 9")
+        canvas.update()
+
 def tl_left_b(event):
          global xcol,yrow,samp,mx,my,mz,corner
+         if busy(): return # RUN has the stage
          corner='TL'
          xcol=0; yrow=0; samp=0
          mcoords() # move to TL
@@ -254,6 +374,7 @@ def tl_left_b(event):
 
 def tl_right_b(event):
          global xcol,yrow,samp,mx,my,mz,corner,samps,samp_coord
+         if busy(): return # RUN has the stage
          samps=int(sampse.get())
          for i in range(samps): 
              try: test=samp_coord[i]
@@ -273,6 +394,7 @@ def tl_right_b(event):
 
 def tr_b(event):
          global xcol,yrow,samp,mx,my,mz,corner
+         if busy(): return # RUN has the stage
          corner='TR'
          xcol=nx-1; yrow=0; samp=0
          mcoords() # move to TR
@@ -281,6 +403,7 @@ def tr_b(event):
 
 def bl_b(event):
          global xcol,yrow,samp,mx,my,mz,corner
+         if busy(): return # RUN has the stage
          corner='BL'
          xcol=0; yrow=ny-1; samp=0
          mcoords() # move to BL
@@ -289,6 +412,7 @@ def bl_b(event):
 
 def br_b(event):
          global xcol,yrow,samp,mx,my,mz,corner
+         if busy(): return # RUN has the stage
          corner='BR'
          xcol=nx-1; yrow=ny-1; samp=0
          mcoords() # move to BR 
@@ -297,6 +421,7 @@ def br_b(event):
 
 def set_b(event):
           global tl,tr,bl,br,mx,my,mz,xcol,yrow,corner
+          if busy(): return # RUN has the stage
           m=[mx,my,mz]
           if corner=="TL":
              tl=m
@@ -310,6 +435,10 @@ def set_b(event):
           if corner=="BR":
              br=m
              print('new br',br)
+          if corner=="focus": # the well GO TO/next/prev went to is in focus here
+             focus_map().add(plate(),yrow,xcol,samp,mz)
+             focus_map().fit().save()
+             print(focus_map().report(plate()))
           if corner.isdigit():
              samp_coord[(int(corner))][0]=(m[0]-tl[0])/(tr[0]-tl[0])
              samp_coord[(int(corner))][1]=(m[1]-tl[1])/(bl[1]-tl[1])
@@ -318,12 +447,14 @@ def set_b(event):
           if corner=='unset':canvas.create_text(160,27,text=("You must first select a corner"),font="Helvetia 10")
           else:
               if corner.isdigit(): canvas.create_text(160,27,text=(Lalphabet[int(corner)]+" coordinates saved"),font="Helvetia 10")
+              elif corner=="focus": canvas.create_text(160,27,text=(ami_run.well_name(plate(),yrow,xcol,samp)+" focus saved to the focus map"),font="Helvetia 10")
               else: canvas.create_text(160,27,text=(corner + " coordinates saved"),font="Helvetia 10")
           corner='unset'
           canvas.update()
 
 def view_b(event):
       global viewing
+      if not hardware_up('camera'): return
       canvas.create_rectangle(2,2,318,60,fill='white')
       if not running:
          if viewing: 
@@ -337,28 +468,26 @@ def view_b(event):
 
 def reset_b(event):
          global corner
+         if busy(): return # RUN has the stage
          corner="unset"
          print('clicked origin reset')
          canvas.create_rectangle(2,2,318,60,fill='white')
          canvas.create_text(160,27,text=("wait while machine resets..."),font="Helvetia 10")
          canvas.update()
-         s.write(('$X \n').encode('utf-8')) # Send g-code home command to grbl
-         grbl_out = s.readline() # Wait for grbl response with carriage return
-         s.write(('$H \n').encode('utf-8')) # Send g-code home command to grbl
-         grbl_out = s.readline() # Wait for grbl response with carriage return
+         if not (gcode('$X') and gcode('$H',ami_grbl.homing_timeout)): return # Send g-code home command to grbl
          canvas.create_rectangle(2,2,318,60,fill='white')
          canvas.create_text(160,27,text=("Ready to rumble!"),font="Helvetia 10")
          canvas.update()
 
 def reset_br(event):
          global corner
+         if busy(): return # RUN has the stage
          corner="unset"
          print('clicked reset alarm')
          canvas.create_rectangle(2,2,318,60,fill='white')
          canvas.create_text(160,27,text=("$X sent to GRBL..."),font="Helvetia 10")
          canvas.update()
-         s.write(('$X \n').encode('utf-8')) # Send g-code home command to grbl
-         grbl_out = s.readline() # Wait for grbl response with carriage return
+         if not gcode('$X'): return # Send g-code unlock command to grbl
          canvas.create_rectangle(2,2,318,60,fill='white')
          canvas.create_text(160,27,text=("It might work now..."),font="Helvetia 10")
          canvas.update()
@@ -368,14 +497,25 @@ def close_b(event): # Closes the interface if not collecting images.  Stops the
     if running:
        print('stopping the run')
        stopit=True; 
+    elif control.lock.holder=='RUN': # a remote RUN: stopped the same way, and the window stays until it has
+       print('stopping the remote run')
+       try: control.stop()
+       except ValueError: pass # it is already stopping
+       canvas.create_rectangle(2,2,318,60,fill='white')
+       canvas.create_text(160,27,text=("stopping the remote RUN, close again once it has"),font="Helvetia 10")
+       canvas.update()
+    elif control.lock.holder not in (None,'GUI'): # a remote command: homing now would pull the stage from under it
+       canvas.create_rectangle(2,2,318,60,fill='white')
+       canvas.create_text(160,27,text=(str(control.lock.holder)+" has the stage, try again in a moment"),font="Helvetia 10")
+       canvas.update()
     else:
        print('moving back to the origin and closing the graphical user interface')
-       s.write(('$H \n').encode('utf-8')) # tell grbl to find zero 
-       grbl_out = s.readline() # Wait for grbl response with carriage return
+       if hw and hw.up('grbl'): gcode('$H',ami_grbl.homing_timeout) # tell grbl to find zero
        root.quit()
 
 def snap_b(event): # takes a simple snapshot of the current view
          global nroot
+         if busy(): return # RUN has the stage
          sID=str(sIDe.get())
          nroot=str(IDe.get())
          path1='images/'+sID
@@ -401,6 +541,7 @@ def snap_b(event): # takes a simple snapshot of the current view
 
 def snap_br(event): #right mouse snap - takes a series of z-stacked pictures using nimages and Z-spacing parameters
          global nroot,mx,my,mz
+         if busy(): return # RUN has the stage
          sID=str(sIDe.get())
          nroot=str(IDe.get())
          nimages=int(nimge.get())
@@ -427,22 +568,17 @@ def snap_br(event): #right mouse snap - takes a series of z-stacked pictures usi
          processf.write('echo \'processing: '+samp_name+'\' \n')
          samp_name+='_'+tdate()
          line='align_image_stack -m -a OUT '
-         for imgnum in range(nimages):
-             s.write(('G0 z '+ str(z) + '\n').encode('utf-8')) # move to z
-             grbl_out=s.readline()
-             wait_for_Idle()
-             imgname=path1+'/'+samp_name+'_'+str(imgnum)+'.jpg'
-             sleep(camera_delay)#slow things down to allow camera to settle down
-             camera.capture(imgname)
-             line+=samp_name+'_'+str(imgnum)+'.jpg '
-             z+=zstep
+         zs=[z+imgnum*zstep for imgnum in range(nimages)]
+         names=[samp_name+'_'+str(imgnum)+'.jpg' for imgnum in range(nimages)]
+         if stream_stacks: ami_run.stream_stack(hw,zs,[path1+'/'+n for n in names],camera.capture,camera_delay,capture_window or 0.8)
+         else: ami_run.take_stack(hw,zs,[path1+'/'+n for n in names],camera.capture,camera_delay)
+         line+=' '.join(names)+' '
          line+=(' \n') 
          processf.write(line)
          processf.write('enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask --output='+samp_name+'.tif OUT*.tif \n')
          processf.write('rm OUT*.tif \n')
          processf.close()
-         s.write(('G0 z '+ str(z_sav) + '\n').encode('utf-8')) # return to original z 
-         grbl_out=s.readline()
+         gcode('G0 z '+ str(z_sav)) # return to original z
          wait_for_Idle()
          canvas.create_rectangle(2,2,318,60,fill='white')
          canvas.create_text(160,17,text=('individual images:'+path1),font="Helvetia 10")
@@ -451,168 +587,247 @@ def snap_br(event): #right mouse snap - takes a series of z-stacked pictures usi
 
 def light1_b(event):
          global lighting1
+         if not hw: return hardware_up() # offline
          if lighting1: # light1 is on so we turn it off
              GPIO.output(17,GPIO.LOW)
              print('light1 turned off')
              lighting1=False
+             control.lights[1]=False
          else: # light1 is off so we turn it on
              GPIO.output(17,GPIO.HIGH)
              print('light1 turned on')
              lighting1=True
+             control.lights[1]=True
 
 def light2_b(event): # this controls both the lower 120V AC output and the 24V DC output of the arduino 
          global lighting2
+         if busy(): return # RUN has the stage
          if lighting2: # light2 is on so we turn it off
              GPIO.output(18,GPIO.LOW) # make pin 18 on the pi low
-             s.write(('m5 \n').encode('utf-8')) #turn off the spindle power
-             grbl_out = s.readline() # Wait for grbl response with carriage return
+             gcode('m5') #turn off the spindle power
              print('light2 turned off')
              lighting2=False
+             control.lights[2]=False
          else: # light2 is off so we turn it on
              GPIO.output(18,GPIO.HIGH) # make pin 18 on the pi high
-             s.write(('m3 \n').encode('utf-8')) #turn on spindle power
-             grbl_out = s.readline() # Wait for grbl response with carriage return
+             gcode('m3') #turn on spindle power
              print('light2 turned on')
              lighting2=True
+             control.lights[2]=True
 
 def run_b(event):
          global yrow,xcol,samp,mx,my,mz,corner,running,viewing,lighting1,lighting2,nroot,sID,nimages,zstep,samps,stopit
+         global schedule_paused
+         if busy(): return # RUN has the stage
+         if event is not None: schedule_paused=False # RUN by hand lets the schedule carry on too
          write_b() # get data from the GUI window and save/update the configuration file... 
          nimages=int(nimge.get())
          samps=int(sampse.get()) 
          zstep=float(zspe.get()) 
          sID=str(sIDe.get())
          nroot=str(IDe.get())
+         try: imgpath,run_plan,resume=ami_run.prepare_run(plate(),run_order,fname,resume_within,(xmax,ymax,zmax),fracbelow)
+         except ami_run.OutOfBounds as e:
+             canvas.create_rectangle(2,2,318,60,fill='white')
+             canvas.create_text(160,20,text=str(e),font="Helvetia 10")
+             canvas.create_text(160,40,text=("check the corners, zstep and nimages"),font="Helvetia 9")
+             canvas.update()
+             return
          yrow=0; xcol=0; samp=0
          mcoords() #go to A1 
-         imgpath='images/'+sID
-         if not os.path.isdir(imgpath):
-           os.mkdir(imgpath)
-           print('created directory: '+imgpath)
-         imgpath='images/'+sID+'/'+nroot
-         if not os.path.isdir(imgpath):
-           os.mkdir(imgpath)
-           print('created directory: '+imgpath)
-         imgpath+='/'+tdate()
-         if not os.path.isdir(imgpath):
-           os.mkdir(imgpath)
-           print('created directory: '+imgpath)
-         if not os.path.isdir(imgpath+'/rawimages'):
-           os.mkdir(imgpath+'/rawimages')
-           print('created directory: '+imgpath+'/rawimages')
-           copyfile(fname,(imgpath+'/'+fname))
-         if not viewing: 
-             camera.start_preview(fullscreen=False,window=(0,-76,1597,1200))
-             viewing=True
-             sleep(2) # let camera adapt to the light before collecting images
-         processf=open(imgpath+'/process'+nroot+'.com','w')
-         processf.write('rm OUT*.tif \n')
-         zrange=(nimages-1)*zstep
          running=True
+         control.lock.hand_over('GUI','RUN') # until run_finished
          canvas.create_rectangle(2,2,318,60,fill='white')
-         canvas.create_text(160,27,text=("imaging samples..."),font="Helvetia 10")
+         canvas.create_text(160,27,text=("carrying on the last run..." if resume else "imaging samples..."),font="Helvetia 10")
          canvas.update()
-         if disable_hard_limits: 
-           s.write(('$21=0 \n').encode('utf-8')) #turn off hard limits
-           print('hard limits disabled')
-         for yrow in range(ny):
-            for xcol in range(nx):
-                for samp in range(samps):  
-                   mcoords() # go to the expected position of the focussed sample 
-                   z=mz-(1-fracbelow)*zrange # bottom of the zrange (this is the top of the sample!)
-                   samp_name=alphabet[yrow]+str(xcol+1)
-                   if samps>1:samp_name+=Lalphabet[samp]
-                   processf.write('echo \'processing: '+samp_name+'\' \n')
-                   line='align_image_stack -m -a OUT '
-                   for imgnum in range(nimages):
-                      s.write(('G0 z '+ str(z) + '\n').encode('utf-8')) # move to z
-                      grbl_out=s.readline()
-                      wait_for_Idle()
-                      sleep(0.2)
-                      # take image
-                      imgname=imgpath+'/rawimages/'+samp_name+'_'+str(imgnum)+'.jpg'
-                      sleep(camera_delay)#slow things down to allow camera to settle down
-                      camera.capture(imgname)
-                      line+='rawimages/'+samp_name+'_'+str(imgnum)+'.jpg '
-                      z+=zstep
-                   line+=(' \n') 
-                   processf.write(line)
-                   processf.write('enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask --output='+samp_name+'.tif OUT*.tif \n')
-                   processf.write('rm OUT*.tif \n')
-                   if stopit: break
-                if stopit: break
-            if stopit: break
+         fusion=ami_stack.FusionPool() if fuse_during_run else None
+         run_plate=plate(); options=run_options()
+         def work(): # on the acquisition thread: nothing in here may touch tk, it all goes through run_events
+             try:
+                 stats=ami_run.run_plate(hw,run_plate,imgpath,show=lambda *a: run_events.put(('position',a)),stop=lambda: stopit,
+                                 plan=run_plan,fusion=fusion,resume=resume,progress=lambda *a: run_events.put(('progress',a)),**options)
+                 run_events.put(('done',(stats,fusion)))
+             except Exception as e:
+                 run_events.put(('failed',(e,fusion)))
+         threading.Thread(target=work,name='ami-run',daemon=True).start()
+         root.after(100,check_run)
+
+def run_options(): # how RUN is set up here, as run_plate's keyword arguments
+         return dict(preview=not viewing,camera_delay=camera_delay,fracbelow=fracbelow,disable_hard_limits=disable_hard_limits,
+                     pipelined=pipelined_capture,streamed=stream_stacks,capture_window=capture_window,
+                     autofocus_images=autofocus_images,autofocus_steps=autofocus_steps,metrics_file=metrics_file,
+                     burst=burst_capture,keep_raw=keep_raw_stacks,stack_files=stack_files,
+                     overview=plate_overview,changes=change_detection,change_threshold=change_threshold,
+                     unchanged_images=unchanged_images,settle_mode=settle_mode,settle_min=settle_min,
+                     settle_per_mm=settle_per_mm,settle_cap=settle_cap,quality_index=quality_index)
+
+run_events=queue.Queue() # what the acquisition thread has to tell the GUI
+def check_run(): # runs on the tk thread every 100 ms while RUN is going
+         while True:
+             try: what,a=run_events.get_nowait()
+             except queue.Empty: break
+             if what=='position': show_run_position(*a)
+             elif what=='progress':
+                 name,done,total,secs,eta=a
+                 canvas.create_rectangle(5,35,315,57,fill='white',outline='white')
+                 canvas.create_text(160,47,text=('%s took %.1f s, %d of %d done, about %d min to go'%(name,secs,done,total,round(eta/60.))),font="Helvetia 9")
+                 canvas.update()
+             elif what=='done': return run_finished(*a)
+             elif what=='failed':
+                 e,fusion=a
+                 print('RUN failed: '+str(e))
+                 canvas.create_rectangle(2,2,318,60,fill='white')
+                 canvas.create_text(160,20,text=("RUN failed, RUN again to carry on"),font="Helvetia 10")
+                 canvas.create_text(160,40,text=(str(e)[:50]),font="Helvetia 8")
+                 canvas.update()
+                 if fusion: fusion.close(wait=False)
+                 return run_finished(None,None)
+         root.after(100,check_run)
+
+def run_finished(stats,fusion): # back on the tk thread once the run is over
+         global running,viewing,lighting1,lighting2,stopit
+         control.lock.release('RUN')
+         if stats:
+           if stats['resumed']: print('%d samples were already done'%stats['resumed'])
+           print('imaged %d samples in %.0f seconds (%.0f seconds of saving done in the background)'%(stats['wells'],stats['seconds'],stats['hidden']))
+           if autofocus_images: print('autofocus saved %d images and %.0f seconds'%(stats['af_images_saved'],stats['af_seconds_saved']))
+           if fusion:
+               print('%d samples already fused, %d still being fused in the background'%(stats['fused'],stats['unfused']))
+               fusion.close(wait=False)
+           if stats['compared']: print('%d of %d samples had not changed since the last run'%(stats['unchanged'],stats['compared']))
+           if stats['overview']: print('plate overview: '+stats['overview'].path)
+           if use_focus_map and stats['focus']:
+               for (y,x,sa),z in stats['focus'].items(): focus_map().add(plate(),y,x,sa,z)
+               focus_map().fit().save()
+               print(focus_map().report(plate()))
+         if stats:
+             canvas.create_rectangle(2,2,318,60,fill='white')
+             canvas.create_text(160,27,text=("RUN stopped, RUN again to carry on" if stats['stopped'] else "RUN finished"),font="Helvetia 10")
+             canvas.update()
          running=False
-         processf.close()
-         camera.stop_preview() # turn off the preview so the monitor can go black when the pi sleeps 
-         viewing=False
-         GPIO.output(17, GPIO.LOW) #turn off light1
-         lighting1=False
-         GPIO.output(18, GPIO.LOW) #turn off light2
-         s.write(('m5 \n').encode('utf-8')) #turn off the spindle power (light 2)
-         lighting2=False
-         if disable_hard_limits: 
-           s.write(('$21=1 \n').encode('utf-8')) # turn hard limits back on
-           print('hard limits enabled')
+         if stats and stats['cleaned']: # run_plate turned them off
+             viewing=False
+             lighting1=False
+             lighting2=False
+         else: # failed, maybe before it got that far: see what they are
+             try:
+                 viewing=bool(camera.preview)
+                 lighting1=bool(GPIO.input(17))
+                 lighting2=bool(GPIO.input(18))
+             except Exception as e: print('could not read the lights back: '+str(e))
+         control.lights.update({1:lighting1,2:lighting2})
          stopit=False
+         schedule_done(stats)
+
+def schedule_done(stats): # a RUN has finished: tick it off the schedule, then start the next plate that is due
+         global scheduled,schedule_paused
+         if schedule_file:
+             sched=ami_schedule.Schedule(schedule_file)
+             if stats and not stats['stopped']:
+                 for e in sched.entries:
+                     if e.config==fname and e.due(): sched.finished(e) # by hand or not, the plate is done for now
+             elif scheduled: # stopped or failed with nobody there: leave the rest to whoever comes along
+                 schedule_paused=True
+                 print('scheduled plates wait until RUN is pressed again')
+         scheduled=False
+         start_due()
+
+def start_due(): # RUN the plate on the schedule that has waited longest, if one is due and nothing else is going on
+         global scheduled,schedule_paused,own_fname,fname
+         if running or viewing or schedule_paused or not schedule_file or control.lock.holder or not hardware_up(quiet=True): return
+         sched=ami_schedule.Schedule(schedule_file)
+         for e in sched.due():
+             try: ami_run.read_config(e.config)
+             except Exception as err:
+                 print('scheduled plate '+e.config+' cannot be read ('+str(err)+'), taking it off the schedule')
+                 sched.remove(e.config)
+                 continue
+             if own_fname is None: own_fname=fname
+             filee.delete(0,tk.END); filee.insert(0,e.config)
+             read_b(None)
+             if ('1' in e.lights)!=lighting1: light1_b(None)
+             if ('2' in e.lights)!=lighting2: light2_b(None)
+             print('scheduled RUN of '+e.config+', day '+ami_schedule.days_text(e.due()))
+             scheduled=True
+             run_b(None)
+             if not running: # it would not start (out of bounds): wait for someone
+                 scheduled=False; schedule_paused=True
+             return
+         if own_fname is not None: # the schedule is done for now: back to the plate that was loaded
+             filee.delete(0,tk.END); filee.insert(0,own_fname)
+             own_fname=None
+             read_b(None)
+
+def check_schedule(): # every schedule_check seconds
+         start_due()
+         root.after(int(schedule_check*1000),check_schedule)
+
+def run_br(event): # right click: put the loaded plate on the schedule, imaged now and on the days in schedule_days
+         if (busy() if hw else running) or not schedule_file: return # offline it can still go on the schedule
+         write_b()
+         sched=ami_schedule.Schedule(schedule_file)
+         sched.add(fname,schedule_days.split(','),lights=('1' if lighting1 else '')+('2' if lighting2 else '') or '0')
+         print(sched.report())
+         canvas.create_rectangle(2,2,318,60,fill='white')
+         canvas.create_text(160,27,text=(fname+" scheduled for days "+schedule_days),font="Helvetia 10")
+         canvas.update()
+         start_due()
+
+remote_events=queue.Queue() # what remote clients have done, for the GUI to catch up with
+control.listeners.append(remote_events.put)
+def check_remote(): # every 200 ms with the control server on
+         global mx,my,mz,yrow,xcol,samp,lighting1,lighting2,focusmap
+         while True:
+             try: e=remote_events.get_nowait()
+             except queue.Empty: break
+             if running: continue # RUN from here keeps the GUI up to date itself
+             if e['event']=='position':
+                 mx,my,mz=e['position']
+                 if e.get('at'):
+                     yrow,xcol,samp=e['at']
+                     show_position(yrow,xcol,samp,mx,my,mz)
+             elif e['event']=='light':
+                 if e['light']==1: lighting1=e['on']
+                 else: lighting2=e['on']
+             elif e['event'] in ('run','sample'):
+                 if e['event']=='run' and e['state']!='running': focusmap=None # read again with what autofocus found
+                 canvas.create_rectangle(2,2,318,60,fill='white')
+                 canvas.create_text(160,27,text=('remote RUN: '+(e.get('state') or '%s, %d of %d done'%(e['name'],e['done'],e['total']))),font="Helvetia 10")
+                 canvas.update()
+         root.after(200,check_remote)
+
+def show_run_position(y,x,sa,zx,zy,zz): # keeps the GUI up to date while RUN moves the stage
+         global yrow,xcol,samp,mx,my,mz
+         yrow,xcol,samp,mx,my,mz=y,x,sa,zx,zy,zz
+         show_position(yrow,xcol,samp,mx,my,mz)
          
 def goto_b(event):
          global xcol,yrow,mx,my,mz,corner,samp,pose_txt,samps
+         if busy(): return # RUN has the stage
          samps=int(sampse.get()) 
-         corner='unset'
+         corner='focus' if use_focus_map else 'unset' # SET now saves the focus of this well
          canvas.update()
          pose_txt=str(pose.get())
          pose_txt=pose_txt.replace(" ", "") #get rid of spaces
          pose_txt=pose_txt.rstrip("\r\n") # get rid of carrage return
-         samp=0
-         pose_txtt=pose_txt
-         #first deal with the sub-sample character if present
-         if not pose_txt[-1].isdigit(): # sub-sample is specified
-             if pose_txt[-1] in Ualphabet[0:samps]:samp=Ualphabet.find(pose_txt[-1])
-             if pose_txt[-1] in Lalphabet[0:samps]:samp=Lalphabet.find(pose_txt[-1])
-             pose_txtt=pose_txt[0:-1]
-         if pose_txtt[0].isdigit(): # now see if it is in number format
-             numb=int(pose_txtt) 
-             numb-=1
-             if numb<nx*ny and numb>=0:
-                 yrow=int(numb/nx)
-                 xcol=numb-(yrow*nx)
-                 print('yrow,xcol',yrow, xcol)
-                 mcoords()
-             else:
-                 canvas.create_rectangle(2,2,318,60,fill='white')
-                 canvas.create_text(160,27,text=("input error"),font="Helvetia 10")
-                 canvas.update()
-         else: # assume it is letter then number format
-           let0=pose_txtt[0]
-           num0=int(pose_txtt[1:])
-           if ((let0 in alphabet) and (num0 <= nx)): 
-             yrow=alphabet.index(let0) 
-             if yrow>(ny-1): 
-               yrow=yrow-ny
-             xcol=num0-1
-             mcoords()
-           else:
+         i=plan().find(pose_txt) # B7, b7 or 19, with a sub-sample letter if there are sub-samples
+         if i is None:
              canvas.create_rectangle(2,2,318,60,fill='white')
              canvas.create_text(160,27,text=("input error"),font="Helvetia 10")
              canvas.update()
+         else:
+             yrow,xcol,samp=(int(c) for c in plan().where[i])
+             mcoords()
 
 def prev_bl(event):
          global xcol,yrow,samp,mx,my,mz,corner,samps
+         if busy(): return # RUN has the stage
          samps=int(sampse.get()) 
-         corner='unset'
+         corner='focus' if use_focus_map else 'unset' # SET now saves the focus of this well
          canvas.create_rectangle(2,2,318,60,fill='white')
-         if samp>0:
-             samp-=1
-             mcoords()
-         elif xcol>0:
-             xcol-=1
-             samp=samps-1
-             mcoords()
-         elif yrow>0:
-             yrow-=1
-             xcol=nx-1
-             samp=samps-1
+         i=plan().index(yrow,xcol,samp)-1
+         if i>=0:
+             yrow,xcol,samp=(int(c) for c in plan().where[i])
              mcoords()
          else:
              canvas.create_text(160,27,text=("cannot reverse beyond the first sample"),font="Helvetia 10")
@@ -620,6 +835,7 @@ def prev_bl(event):
 
 def prev_br(event):
         global xcol,yrow,mx,my,mz,corner,samps
+        if busy(): return # RUN has the stage
         samps=int(sampse.get()) 
         canvas.create_rectangle(2,2,318,60,fill='white')
         yrow-=1
@@ -628,20 +844,13 @@ def prev_br(event):
 
 def next_bl(event):
          global xcol,yrow,samp,mx,my,mz,corner,samps
+         if busy(): return # RUN has the stage
          samps=int(sampse.get()) 
-         corner='unset'
+         corner='focus' if use_focus_map else 'unset' # SET now saves the focus of this well
          canvas.create_rectangle(2,2,318,60,fill='white')
-         if samp<(samps-1):
-             samp+=1
-             mcoords()
-         elif xcol<(nx-1):
-             xcol+=1
-             samp=0
-             mcoords()
-         elif yrow<(ny-1):
-             yrow+=1
-             xcol=0
-             samp=0
+         i=plan().index(yrow,xcol,samp)+1
+         if i<len(plan()):
+             yrow,xcol,samp=(int(c) for c in plan().where[i])
              mcoords()
          else:
              canvas.create_text(160,27,text=("cannot advance beyond the last sample"),font="Helvetia 10")
@@ -649,8 +858,9 @@ def next_bl(event):
 
 def next_br(event):
          global xcol,yrow,mx,my,mz,corner,samps
+         if busy(): return # RUN has the stage
          samps=int(sampse.get()) 
-         corner='unset'
+         corner='focus' if use_focus_map else 'unset' # SET now saves the focus of this well
          canvas.create_rectangle(2,2,318,60,fill='white')
          yrow+=1
          if yrow == 8: yrow=0
@@ -661,6 +871,7 @@ root.title('AMiGUI v1.0')
 root.geometry('320x637+1597+30')
 
 root.bind('<Button-1>', left_click) #left click
+root.bind('<ButtonRelease-1>', left_release)
 #root.bind('<Button-3>', right_click) #right click
 root.bind('<Motion>', motion)
 
@@ -754,6 +965,7 @@ runButton = tk.Button(root, text = "RUN",font="Helvetia 12 bold",fg="yellow")
 runButton.configure(width = 10, background = "black",  activebackground = "green", relief = tk.RAISED)
 runButton_window = canvas.create_window(175,491, anchor = tk.NW, window=runButton)
 runButton.bind('<Button-1>',run_b)
+runButton.bind('<Button-3>',run_br)
 
 # manual movement
 canvas.create_rectangle(5,450,168,525,width=3,fill="lightgrey")  
@@ -832,17 +1044,28 @@ sampse.insert(0,samps)
 canvas.create_window(302,618, width=14, window = sampse) 
 
 #start message
-canvas.create_text(160,32,text=(" The corner samples must be centered and \n in focus before imaging. Use blue buttons \n to check alignment, and XYZ windows to \n make corrections.  Good luck!!"),font="Helvetia 10",fill="darkblue")
+if offline: canvas.create_text(160,32,text=(" Offline: nothing moves and no pictures are \n taken.  Configurations can be read, edited \n and updated, and plates scheduled."),font="Helvetia 10",fill="darkblue")
+else: root.after(0,check_startup)
 
 canvas.update()
 fname=str(filee.get())
 root.update()
+print('window up %.2f s after starting'%(monotonic()-started)) # from here on the GUI answers clicks
+if control_address:
+    ami_server.Server(control,control_address[0],control_address[1],control_token).start()
+    root.after(200,check_remote)
+if schedule_file:
+    if os.path.exists(schedule_file): print(ami_schedule.Schedule(schedule_file).report())
+    root.after(2000,check_schedule)
 
 root.mainloop()
 
 print('\n Hope you find what you\'re looking for!  \n')
-GPIO.output(17, GPIO.LOW) #turn off light1
-GPIO.output(18, GPIO.LOW) #turn off light2
-s.write(('m5 \n').encode('utf-8')) #turn off light2
-s.close() # Close serial port 
-camera.stop_preview() # stop preview
+if hw:
+    GPIO.output(17, GPIO.LOW) #turn off light1
+    GPIO.output(18, GPIO.LOW) #turn off light2
+    try: grbl.send('m5').wait(2.) #turn off light2
+    except ami_grbl.GrblError as e: print(e)
+    grbl.close()
+    s.close() # Close serial port 
+    if camera: camera.stop_preview() # stop preview
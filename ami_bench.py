@@ -0,0 +1,109 @@
+# time a plate run on the simulated instrument
+#
+#   python ami_bench.py                  # 12 x 8 plate, 4 images per drop
+#   python ami_bench.py AMi.config -s 50 # plate from a config file, 50x faster than real time
+#
+# Times are in instrument seconds, so they don't depend on the speed-up, but anything the
+# laptop itself does (writing files, encoding, waking up from sleep) is stretched by the
+# speed-up factor, so keep it modest (20-50) when comparing numbers.
+
+import argparse, contextlib, io, os, shutil, tempfile
+import numpy as np
+import ami_hardware, ami_run, ami_plan, ami_stack, ami_focusmap, ami_settle
+
+def sim_focus(plate,x,y): # where the simulated drops are in focus: the corners' plane plus a sag in the middle
+    fx=(x-plate.tl[0])/(plate.tr[0]-plate.tl[0]); fy=(y-plate.tl[1])/(plate.bl[1]-plate.tl[1])
+    plane=plate.tl[2]+fx*(plate.tr[2]-plate.tl[2])+fy*(plate.bl[2]-plate.tl[2])
+    return plane-0.4*np.sin(np.pi*np.clip(fx,0,1))*np.sin(np.pi*np.clip(fy,0,1))
+
+def moved(plate,x,y,fraction): # whether the drop at x,y is one of the fraction that change between runs
+    return np.random.default_rng(abs(int(round(x*10)))*100000+abs(int(round(y*10)))).random()<fraction # machine coordinates are negative
+
+def bench(plate,speed=20.,verbose=False,keep=False,fuse=False,changed=None,pty=False,**kw):
+    # with fuse, the simulated camera makes real pictures, they are fused during the run and the
+    # plate overview is made from them
+    # with changed (a fraction), the plate is run twice with change detection and that fraction of
+    # the drops go out of focus in between; the numbers are for the second run
+    # with pty, g-code goes to the simulated grbl through a pseudo terminal and pyserial
+    hw=ami_hardware.open_hardware(simulate=True,speed=speed,images=fuse,pty=pty)
+    hw.camera.focus=lambda x,y: sim_focus(plate,x,y)
+    quiet=contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    tmp=tempfile.mkdtemp(prefix='ami_bench_')
+    try:
+        with quiet:
+            ami_run.home(hw)
+            imgpath=ami_run.make_run_dir(plate.sID,plate.nroot,images=tmp)
+            if changed is not None:
+                ami_run.run_plate(hw,plate,imgpath,overview=False,changes=True,**kw)
+                os.rename(imgpath,imgpath+'_before') # the second run would get the same minute's directory
+                imgpath=ami_run.make_run_dir(plate.sID,plate.nroot,images=tmp)
+                hw.camera.focus=lambda x,y: sim_focus(plate,x,y)+(0.6 if moved(plate,x,y,changed) else 0.)
+                kw['changes']=True
+            fusion=ami_stack.FusionPool() if fuse else None
+            stats=ami_run.run_plate(hw,plate,imgpath,fusion=fusion,overview=fuse,**kw)
+            if fusion:
+                t0=hw.clock.time()
+                fusion.close()
+                stats['fuse_tail']=hw.clock.time()-t0
+                stats['overview'].wait()
+    finally:
+        if keep: print('images left in '+tmp)
+        else: shutil.rmtree(tmp)
+    stats['moves']=hw.s.nmoves
+    stats['grbl']=hw.grbl.report(); stats['overflows']=hw.s.overflows
+    return stats
+
+def report(plate,stats):
+    print('plate: %d x %d, %d sample(s)/position, %d images/sample'%(plate.nx,plate.ny,plate.samps,plate.nimages))
+    print('run time:        %9.1f s'%stats['seconds'])
+    print('samples:         %9d'%stats['wells'])
+    print('images:          %9d'%stats['images'])
+    print('moves:           %9d'%stats['moves'])
+    print('per sample:      %9.2f s'%(stats['seconds']/max(stats['wells'],1)))
+    print('samples/hour:    %9.1f'%(3600.*stats['wells']/max(stats['seconds'],1e-9)))
+    if stats['hidden']: print('saved in background: %5.1f s'%stats['hidden'])
+    if stats['af_images_saved'] or stats['af_seconds_saved']:
+        print('autofocus saved:    %6d images, %.1f s'%(stats['af_images_saved'],stats['af_seconds_saved']))
+    if 'fuse_tail' in stats:
+        print('fused during run:   %6d of %d samples'%(stats['fused'],stats['wells']))
+        print('fusing the rest:    %6.1f s after the run'%stats['fuse_tail'])
+    if stats['compared']: print('unchanged:          %6d of %d samples'%(stats['unchanged'],stats['compared']))
+    print(ami_run.timings.report(stats['wells'],stats['seconds']))
+    print(ami_run.idle_latency.report())
+    print(stats['grbl'])
+    if stats['overflows']: print('grbl\'s receive buffer overflowed %d times'%stats['overflows'])
+
+if __name__=='__main__':
+    p=argparse.ArgumentParser(description='time a plate run on the simulated instrument')
+    p.add_argument('config',nargs='?',help='configuration file (default: built-in 12 x 8 plate)')
+    p.add_argument('-s','--speed',type=float,default=20.,help='how much faster than real time to run the simulator')
+    p.add_argument('-o','--order',default='raster',choices=ami_plan.orders,help='order to visit the samples')
+    p.add_argument('-p','--pipelined',action='store_true',help='save images in the background')
+    p.add_argument('-z','--streamed',action='store_true',help='send each z-stack to grbl in one go')
+    p.add_argument('-w','--wait',default=ami_run.idle_method,choices=('edge','status','poll'),help='how to tell the stage has stopped')
+    p.add_argument('-b','--burst',action='store_true',help='capture each z-stack from the video port into memory')
+    p.add_argument('-r','--raw',action='store_true',help='with --burst, keep each stack as a .npy file too')
+    p.add_argument('-c','--stackfiles',action='store_true',help='store each z-stack as one .amis file (implies --burst)')
+    p.add_argument('-f','--fuse',action='store_true',help='fuse stacks during the run (needs PIL)')
+    p.add_argument('-a','--autofocus',type=int,default=0,help='autofocus, then take this many full-size images')
+    p.add_argument('-m','--focusmap',help='use this focus map file and add what autofocus finds to it')
+    p.add_argument('-t','--settle',default='fixed',choices=ami_settle.modes,help='how to decide each settle time')
+    p.add_argument('-x','--changed',type=float,help='run twice with change detection, this fraction of the drops changing in between')
+    p.add_argument('-g','--pty',action='store_true',help='talk to the simulated grbl through a pseudo terminal')
+    p.add_argument('-v','--verbose',action='store_true',help='show everything the run prints')
+    p.add_argument('-k','--keep',action='store_true',help='keep the images and process file')
+    args=p.parse_args()
+    plate=ami_run.read_config(args.config) if args.config else ami_run.Plate()
+    ami_run.idle_method=args.wait
+    if args.focusmap:
+        plate.focusmap=ami_focusmap.FocusMap(args.focusmap)
+        print(plate.focusmap.report(plate))
+    plan=ami_plan.PlatePlan(plate,args.order)
+    print(ami_plan.report(plate,plan.order()))
+    stats=bench(plate,args.speed,args.verbose,args.keep,plan=plan,pipelined=args.pipelined,streamed=args.streamed,fuse=args.fuse,burst=args.burst,keep_raw=args.raw,stack_files=args.stackfiles,
+                autofocus_images=args.autofocus,changed=args.changed,settle_mode=args.settle,pty=args.pty)
+    report(plate,stats)
+    if args.focusmap and stats['focus']:
+        for k,z in stats['focus'].items(): plate.focusmap.add(plate,*k,z)
+        plate.focusmap.fit().save()
+        print(plate.focusmap.report(plate))
@@ -0,0 +1,147 @@
+# capturing images without waiting for them to be saved
+#
+# camera.capture(filename) does not return until the picture is encoded and written to
+# the SD card, and the stage sits still the whole time.  A CapturePipeline grabs the
+# picture into memory and hands it to a background thread that writes it, so the next
+# z move can start right away.  The queue between them is bounded (depth frames), so a
+# slow card holds up the capture instead of filling up the pi's memory.
+#
+# encode='camera' has the camera encode the jpeg into memory (on the pi that is done by
+# the GPU and is quick).  encode='worker' grabs raw rgb into a recycled buffer and the
+# thread encodes it with PIL, which takes the encoding off the capture path too.
+#
+# For burst z-stacks (see ami_run.burst_stack) the whole stack is captured from the video
+# port into a stack_buffer() and handed over with save_stack(); the thread encodes each
+# frame as a jpeg and can keep the raw stack as a .npy file as well.  There are only ever
+# two stack buffers (one being filled, one being saved), each nimages full frames.
+
+import numpy as np
+import io, os, threading, queue
+
+class CapturePipeline:
+    def __init__(self,camera,clock,depth=4,encode='camera',quality=85,timings=None):
+        # timings (an ami_timing.Timings) gets how long each write took and how big it was
+        self.camera=camera; self.clock=clock; self.encode=encode; self.quality=quality; self.timings=timings
+        self.q=queue.Queue(maxsize=depth)
+        self.buffers=queue.Queue() # raw frame buffers ready to be reused (encode='worker')
+        self.stacks=queue.Queue() # raw stack buffers ready to be reused (burst)
+        self.nstacks=0
+        self.error=None
+        self.busy=0. # seconds the thread spent saving since the last well_done()
+        self.blocked=0. # seconds capture() waited for room in the queue since the last well_done()
+        self.hidden=0. # total seconds of saving that overlapped with other work
+        self.nsaved=0; self.nbytes=0
+        self.lock=threading.Lock()
+        self.thread=threading.Thread(target=self._work,name='ami-capture',daemon=True)
+        self.thread.start()
+
+    def _buffer(self):
+        w,h=self.camera.resolution
+        try: return self.buffers.get_nowait()
+        except queue.Empty: return np.empty((((h+15)//16)*16,((w+31)//32)*32,3),np.uint8) # picamera pads rows and columns
+
+    def capture(self,path): # take a picture now, save it later
+        if self.error: raise self.error
+        if self.encode=='worker':
+            buf=self._buffer()
+            self.camera.capture(buf,format='rgb')
+            item=(path,buf)
+        else:
+            buf=io.BytesIO()
+            self.camera.capture(buf,format='jpeg')
+            item=(path,buf.getvalue())
+        self._put(item)
+
+    def stack_buffer(self,n): # room for a burst of n padded rgb frames
+        w,h=self.camera.resolution
+        shape=(n,((h+15)//16)*16,((w+31)//32)*32,3)
+        if self.stacks.empty() and self.nstacks<2:
+            self.nstacks+=1
+            return np.empty(shape,np.uint8)
+        t0=self.clock.time()
+        buf=self.stacks.get() # wait for the stack before last to be saved
+        with self.lock: self.blocked+=self.clock.time()-t0
+        return buf if buf.shape[0]>=n and buf.shape[1:]==shape[1:] else np.empty(shape,np.uint8)
+
+    def save_stack(self,paths,frames,raw=None): # encode frames[k] to paths[k] later, and np.save them to raw if given
+        if self.error: raise self.error
+        self._put((list(paths),(frames,raw)))
+
+    def after(self,fn): # call fn (on the saving thread) once everything captured so far is written
+        self._put((None,fn))
+
+    def _put(self,item):
+        t0=self.clock.time()
+        self.q.put(item)
+        with self.lock: self.blocked+=self.clock.time()-t0
+
+    def _work(self):
+        while True:
+            item=self.q.get()
+            if item is None:
+                self.q.task_done()
+                return
+            t0=self.clock.time()
+            path,data=item
+            try:
+                if path is None: data()
+                elif isinstance(path,list): # a burst stack
+                    self._save_stack(path,*data)
+                    path=None
+                elif isinstance(data,np.ndarray):
+                    from PIL import Image
+                    w,h=self.camera.resolution
+                    with open(path,'wb') as f:
+                        Image.fromarray(data[:h,:w]).save(f,format='JPEG',quality=self.quality)
+                        n=f.tell()
+                    self.buffers.put(data)
+                else:
+                    with open(path,'wb') as f: f.write(data)
+                    n=len(data)
+                if path:
+                    self.nbytes+=n; self.nsaved+=1
+                    if self.timings: self.timings.add('write',self.clock.time()-t0,n,os.path.basename(path).rsplit('_',1)[0])
+            except Exception as e:
+                self.error=e
+            with self.lock: self.busy+=self.clock.time()-t0
+            self.q.task_done()
+
+    def _save_stack(self,paths,frames,raw):
+        from PIL import Image
+        w,h=self.camera.resolution
+        try:
+            for path,frame in zip(paths,frames):
+                t0=self.clock.time()
+                with open(path,'wb') as f:
+                    Image.fromarray(frame[:h,:w]).save(f,format='JPEG',quality=self.quality)
+                    n=f.tell()
+                self.nbytes+=n; self.nsaved+=1
+                if self.timings: self.timings.add('write',self.clock.time()-t0,n,os.path.basename(path).rsplit('_',1)[0])
+            if raw:
+                t0=self.clock.time()
+                with open(raw+'.part','wb') as f:
+                    np.save(f,frames[:len(paths),:h,:w])
+                    n=f.tell()
+                os.replace(raw+'.part',raw)
+                self.nbytes+=n
+                if self.timings: self.timings.add('write',self.clock.time()-t0,n,os.path.basename(raw)[:-4])
+        finally:
+            self.stacks.put(frames)
+
+    def well_done(self): # seconds of saving hidden behind other work since the last call
+        with self.lock:
+            hidden=max(self.busy-self.blocked,0.)
+            self.busy=0.; self.blocked=0.
+        self.hidden+=hidden
+        return hidden
+
+    def flush(self): # wait for everything to be written
+        t0=self.clock.time()
+        self.q.join()
+        with self.lock: self.blocked+=self.clock.time()-t0
+        if self.error: raise self.error
+
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
+        if self.error: raise self.error
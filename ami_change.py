@@ -0,0 +1,81 @@
+# change detection: skip the full z-stack of drops that look the same as last time
+#
+# With it on, RUN grabs one small video frame (a probe) of each sample at its focus z
+# before taking the stack, and keeps it as probes/<sample>.npy in the run directory.
+# When the plate has been imaged before, the probe is compared with the same sample's
+# probe from the last run of the plate: both are shrunk to 64 x 48, brought to zero mean
+# and unit spread (so a dimmer lamp makes no difference), lined up with each other (a
+# plate never goes back in exactly the same place) and the mean absolute difference is
+# taken.  0 is the same picture, about 1.1 two unrelated ones.  Below threshold the
+# sample counts as unchanged: RUN takes only a few slices, does not fuse them, and
+# <sample>.tif is a link to the last run's.  Every sample's score is in changes.txt.
+#
+# A probe costs one video frame and a few milliseconds of numpy; an unchanged sample
+# saves the rest of its stack and its fusion, so it pays for itself if even one sample
+# in twenty or so is unchanged.  Both are in the run's timings ('probe', 'sample').
+
+import numpy as np
+import os
+from ami_stack import find_shift, shift
+
+size=(64,48) # probes are kept this small
+
+def shrink(frame): # brightness frame down to size, by block means
+    g=np.asarray(frame,np.float32)
+    w,h=size
+    fy,fx=max(1,g.shape[0]//h),max(1,g.shape[1]//w)
+    g=g[:fy*h,:fx*w]
+    return g.reshape(g.shape[0]//fy,fy,g.shape[1]//fx,fx).mean(axis=(1,3))
+
+def normalise(g):
+    g=g-g.mean()
+    return g/max(float(g.std()),1e-6)
+
+def difference(a,b): # how unlike two probes are: 0 the same, about 1.1 unrelated
+    a=normalise(np.asarray(a,np.float32)); b=normalise(np.asarray(b,np.float32))
+    if a.shape!=b.shape: return float('inf')
+    dy,dx=find_shift(a,b,down=1)
+    dy,dx=int(round(dy)),int(round(dx))
+    h,w=a.shape
+    if abs(dy)>h//4 or abs(dx)>w//4: return float('inf') # too far off to say
+    b=shift(b,dy,dx)
+    keep=(slice(max(dy,0),h+min(dy,0)),slice(max(dx,0),w+min(dx,0))) # only where both pictures are
+    return float(np.mean(np.abs(a[keep]-b[keep])))
+
+def previous_run(imgpath): # the latest other run directory of the same plate that kept probes, or None
+    root=os.path.dirname(os.path.abspath(imgpath))
+    best=None
+    for d in os.listdir(root):
+        p=os.path.join(root,d)
+        if p==os.path.abspath(imgpath) or not os.path.isdir(p+'/probes'): continue
+        t=os.path.getmtime(p+'/probes')
+        if best is None or t>best[0]: best=(t,p)
+    return best[1] if best else None
+
+class Changes: # probes each sample of a run and says which look the same as in the run before
+    def __init__(self,imgpath,previous=None,threshold=0.25,append=False):
+        self.imgpath=imgpath; self.previous=previous; self.threshold=threshold
+        self.unchanged=0; self.compared=0
+        if not os.path.isdir(imgpath+'/probes'): os.mkdir(imgpath+'/probes')
+        if append and os.path.exists(imgpath+'/changes.txt'): return
+        with open(imgpath+'/changes.txt','w') as f:
+            f.write('# compared with '+(previous or 'nothing')+'\n# sample  difference  unchanged\n')
+
+    def check(self,name,frame): # keep the probe; True if the sample looks the same as last time
+        probe=shrink(frame).astype(np.uint8)
+        np.save(self.imgpath+'/probes/'+name+'.npy',probe)
+        old=self.previous and self.previous+'/probes/'+name+'.npy'
+        if not old or not os.path.exists(old): return False
+        score=difference(np.load(old),probe)
+        same=score<self.threshold
+        self.compared+=1; self.unchanged+=same
+        with open(self.imgpath+'/changes.txt','a') as f: f.write('%-8s %8.3f  %s\n'%(name,score,'yes' if same else 'no'))
+        return same
+
+    def link(self,name): # <sample>.tif pointing at the last run's, which may still be being fused
+        out=self.imgpath+'/'+name+'.tif'
+        if os.path.lexists(out): os.remove(out)
+        os.symlink(self.target(name),out)
+
+    def target(self,name): # the last run's fused image, relative to this run's directory
+        return os.path.relpath(self.previous+'/'+name+'.tif',self.imgpath)
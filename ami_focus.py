@@ -0,0 +1,64 @@
+# contrast autofocus
+#
+# Instead of always taking nimages full-size pictures around the z the corners predict,
+# take a few small frames from the video port over the same z range, score how sharp
+# each one is (variance of the Laplacian), and take a shorter full-size stack centred on
+# the sharpest z.  If nothing stands out (an empty or very dim drop) the normal stack is
+# taken instead.
+
+import numpy as np
+import os
+import ami_run
+
+def sharpness(g): # variance of the Laplacian of a brightness image
+    g=np.asarray(g,np.float32)
+    lap=g[1:-1,:-2]+g[1:-1,2:]+g[:-2,1:-1]+g[2:,1:-1]-4.*g[1:-1,1:-1]
+    return float(lap.var())
+
+def grab(camera,size=(320,240)): # small brightness frame from the video port
+    w,h=size
+    fw,fh=((w+31)//32)*32,((h+15)//16)*16 # the camera pads yuv frames to these
+    buf=np.empty(fw*fh*3//2,np.uint8)
+    camera.capture(buf,format='yuv',use_video_port=True,resize=(w,h))
+    return buf[:fw*fh].reshape(fh,fw)[:h,:w]
+
+def peak(zs,scores): # z of the sharpest frame, refined with a parabola through its neighbours
+    i=int(np.argmax(scores))
+    if 0<i<len(zs)-1:
+        a,b,c=scores[i-1],scores[i],scores[i+1]
+        d=a-2.*b+c
+        if d<0: return zs[i]+0.5*(a-c)/d*(zs[i+1]-zs[i])
+    return zs[i]
+
+def sweep(hw,zs,size=(320,240),settle=0.2): # sharpness at each z
+    # settle (seconds, or an ami_settle.Settler) before each frame: one still ringing from the
+    # move to the well is blurred, which would push the peak towards the later z's
+    scores=[]
+    for z in zs:
+        hw.grbl.command('G0 z '+ str(z)) # move to z
+        ami_run.wait_for_Idle(hw)
+        ami_run.settle_down(hw,settle,z)
+        scores.append(sharpness(grab(hw.camera,size)))
+    return scores
+
+def autofocus(hw,zlo,zhi,steps=7,size=(320,240),contrast=1.15,settle=0.2):
+    # sweeps zlo..zhi in steps frames; returns (best z or None if nothing stood out, scores)
+    zs=list(np.linspace(zlo,zhi,steps))
+    scores=sweep(hw,zs,size,settle)
+    if max(scores)<contrast*max(np.median(scores),1e-9): return None,scores
+    return float(peak(zs,scores)),scores
+
+class FocusLog: # per sample record of what autofocus saved, kept in the run directory
+    def __init__(self,path,append=False): # append carries on the log of a resumed run
+        self.path=path
+        self.saved_images=0; self.saved_seconds=0.
+        if append and os.path.exists(path): return
+        with open(path,'w') as f: f.write('# sample  best_z  images_taken  images_saved  sweep_s  seconds_saved\n')
+
+    def add(self,name,zbest,taken,full,sweep_s,slice_s):
+        saved=full-taken
+        secs=saved*slice_s-sweep_s
+        self.saved_images+=saved; self.saved_seconds+=secs
+        with open(self.path,'a') as f:
+            f.write('%-8s %8s %6d %6d %8.2f %8.2f\n'%(name,'%.3f'%zbest if zbest is not None else 'none',taken,saved,sweep_s,secs))
+        return saved,secs
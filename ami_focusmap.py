@@ -0,0 +1,102 @@
+# focus map: where each drop is in focus, learned from more than the four corners
+#
+# plate_xyz gets z by bilinear interpolation between the corners, so a plate that sags
+# or is warped needs a taller z-stack to be sure of catching every drop.  A FocusMap
+# keeps the z of any wells that have been focused on (by autofocus during RUN, or by
+# hand with SET after GO TO/next/prev) and fits a smooth polynomial surface to how far
+# they are from the corners' bilinear surface.  Every term of it is zero at all four
+# corners, so the corners stay exactly where SET put them however many wells there are
+# (and with none it changes nothing), and re-setting the corners for a plate that sits a
+# bit differently keeps its learned shape.
+#
+#   python ami_focusmap.py    # fits to a made-up warped plate, and checks the corners stay put
+#
+# Each plate (sample name and plate name) has its own file next to the configuration
+# file, focusmap_<sample>_<plate>.txt, that is read again the next time the plate is run.
+
+import numpy as np
+import os
+import ami_run
+
+# the biquadratic surfaces that are zero at the four corners (anything bilinear is the corners' job)
+bowl=lambda u,v:u*(1.-u)+v*(1.-v) # a plate sagging in the middle
+terms=[lambda u,v:u*(1.-u),lambda u,v:v*(1.-v),                       # bowed across, bowed down
+       lambda u,v:u*(1.-u)*v,lambda u,v:u*v*(1.-v),                   # bowed more at one side
+       lambda u,v:u*(1.-u)*v*(1.-v)]
+corners=((0.,0.),(1.,0.),(0.,1.),(1.,1.))
+
+def path_for(fname,sID,nroot): # the focus map file for a plate, next to its configuration file
+    return os.path.join(os.path.dirname(os.path.abspath(fname)),'focusmap_'+sID+'_'+nroot+'.txt')
+
+def fraction(plate,yrow,xcol,samp): # where a sample is on the plate, 0 to 1 from TL to BR
+    return xcol/float(plate.nx-1)+plate.samp_coord[samp][0],yrow/float(plate.ny-1)+plate.samp_coord[samp][1]
+
+def bilinear(plate,u,v): # z from the corners alone
+    tl,tr,bl,br=plate.tl[2],plate.tr[2],plate.bl[2],plate.br[2]
+    return br*u*v+bl*(1.-u)*v+tr*u*(1.-v)+tl*(1.-u)*(1.-v)
+
+class FocusMap:
+    def __init__(self,path=None):
+        self.path=path
+        self.points={} # sample name -> (u,v,dz) with dz how far its focus is above the corners' surface
+        self.coef=np.zeros(1); self.used=[bowl]; self.rms=0.
+        if path and os.path.exists(path): self.load()
+        self.fit()
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                if line.startswith('#') or not line.strip(): continue
+                name,u,v,dz=line.split()[:4]
+                self.points[name]=(float(u),float(v),float(dz))
+
+    def save(self): # written to a temporary file first so a crash never leaves half a map
+        tmp=self.path+'.part'
+        with open(tmp,'w') as f:
+            f.write('# sample  u  v  dz (mm above the corners\' surface)\n')
+            for name,(u,v,dz) in sorted(self.points.items()): f.write('%-8s %8.4f %8.4f %8.4f\n'%(name,u,v,dz))
+        os.replace(tmp,self.path)
+
+    def add(self,plate,yrow,xcol,samp,z): # a sample was in focus at machine z
+        u,v=fraction(plate,yrow,xcol,samp)
+        self.points[ami_run.well_name(plate,yrow,xcol,samp)]=(u,v,z-bilinear(plate,u,v))
+
+    def fit(self): # least squares, with as many terms as the number of wells supports
+        if not self.points:
+            self.coef=np.zeros(1); self.used=[bowl]; self.rms=0.
+            return self
+        p=np.array([(u,v) for u,v,dz in self.points.values()]).reshape(-1,2)
+        dz=np.array([dz for u,v,dz in self.points.values()])
+        n=len(p)
+        self.used=terms if n>=12 else terms[:4] if n>=8 else terms[:2] if n>=4 else [bowl]
+        a=np.stack([t(p[:,0],p[:,1]) for t in self.used],axis=1)
+        self.coef=np.linalg.lstsq(a,dz,rcond=None)[0]
+        self.rms=float(np.sqrt(np.mean((a@self.coef-dz)**2)))
+        return self
+
+    def dz(self,u,v): # correction to the corners' z at (u,v)
+        u=np.asarray(u,float); v=np.asarray(v,float)
+        return sum(c*t(u,v) for c,t in zip(self.coef,self.used))
+
+    def report(self,plate): # how well the map fits and how many images that makes worth taking
+        if not self.points: return 'focus map: no wells measured yet, using the corners only'
+        u,v=np.meshgrid(np.linspace(0,1,plate.nx),np.linspace(0,1,plate.ny))
+        fit='focus map from %d wells: corrects z by up to %.3f mm'%(len(self.points),float(np.abs(self.dz(u,v)).max()))
+        if len(self.points)<=len(self.used): return fit+'; too few wells to tell how well it fits' # it goes through every one
+        spread=6.*self.rms # stack covering the fit error three times over either way
+        return fit+', fit within %.3f mm; %d images at zstep %.3f would cover it'%(self.rms,int(np.ceil(spread/plate.zstep))+1,plate.zstep)
+
+if __name__=='__main__': # a made-up plate sagging 0.4 mm in the middle, a bit more on one side, measured at more and more wells
+    plate=ami_run.Plate(tl=[134.2,29.3,7.5],tr=[23.4,28.7,7.1],bl=[134.9,93.5,6.7],br=[24.1,92.9,6.4])
+    rng=np.random.default_rng(1)
+    m=FocusMap()
+    wells=[(y,x) for y in range(plate.ny) for x in range(plate.nx) if (y,x) not in ((0,0),(0,plate.nx-1),(plate.ny-1,0),(plate.ny-1,plate.nx-1))]
+    for n in (1,2,3,4,8,12,30):
+        while len(m.points)<n:
+            y,x=wells[rng.integers(len(wells))]
+            u,v=fraction(plate,y,x,0)
+            m.add(plate,y,x,0,bilinear(plate,u,v)-0.8*(u*(1-u)+v*(1-v))+0.05*u*(1-u)*v+rng.normal(0,0.005))
+        m.fit()
+        off=max(abs(float(m.dz(u,v))) for u,v in corners)
+        assert off<1e-12,'the focus map moved a corner by %g mm'%off
+        print('%2d wells, %d terms: corners moved by %.1e mm; %s'%(n,len(m.used),off,m.report(plate)))
@@ -0,0 +1,298 @@
+# grbl: lines to the motion controller and the replies that go with them
+#
+# grbl answers every line it is sent with 'ok' or 'error:...', in the order the lines
+# came, and has a 128 byte receive buffer.  AMi used to write a line and read one line
+# back, but some lines (m8, m9, m5) were never read back at all, so replies drifted out
+# of step with the lines they answered, and a reply that never came hung the GUI for good.
+#
+# A Grbl owns the serial port.  send() queues a line and returns a Command straight away;
+# a writer thread sends queued lines as soon as grbl's receive buffer has room for them
+# (counting the bytes of every line not answered yet), so several can be in flight, and a
+# reader thread hands each 'ok' or 'error:' to the oldest line still waiting for one.
+# command() is send() and wait for the reply.  status() asks with '?' and waits for the
+# <...> report.
+#
+#  - a line has a timeout, counted from when grbl got round to it (the reply to the line
+#    before came): one grbl never answers fails with GrblTimeout instead of everything
+#    after it waiting for ever.  Its reply may still come, and would then be taken for the
+#    next line's, so every line in flight or queued fails too and grbl is soft-reset
+#    (ctrl-x); replies are thrown away until its banner says it has started again, and
+#    nothing but $ lines is sent until $X or $H, as after an alarm
+#  - 'error:' fails its line with GrblError
+#  - 'ALARM:' (a hard limit, a homing failure) fails every line in flight or queued with
+#    GrblAlarm, and so is anything sent afterwards until $X or $H
+#  - resets counts alarms, resets and unlocks: grbl turns its coolant and spindle outputs
+#    off when it resets, so whoever relies on them can tell when to set them again
+#  - how long each kind of line ('G0', 'M8', '$H'...) took to be answered is kept, and
+#    report() sums it up with the errors, timeouts and the most bytes ever in flight
+#
+# ami_hardware.serve_pty puts the simulator behind a pseudo terminal, so this can be run
+# against a serial port just like the one on the instrument:
+#
+#   python ami_grbl.py            # commands to a simulated grbl over a pty, and their latencies
+
+import numpy as np
+import collections, re, threading
+
+rx_size=127 # grbl's serial receive buffer (128 bytes), less one to be safe
+default_timeout=30. # seconds grbl may take to answer a line once it is the one it is on
+homing_timeout=60.
+resync_timeout=5. # seconds to wait for grbl's banner after a soft reset before taking replies again
+
+class GrblError(RuntimeError):
+    def __init__(self,message,line=None,reply=None):
+        super().__init__(message)
+        self.line=line # the line that failed
+        self.reply=reply # what grbl said to it, if it said anything
+
+class GrblAlarm(GrblError): pass # grbl is locked until $X or $H
+
+class GrblTimeout(GrblError): pass
+
+def kind(line): # what a line counts as in the latency statistics: 'G0', 'M8', '$H', '$21', 'S'...
+    w=line.strip().upper().split()
+    if not w: return 'empty'
+    k=w[0].split('=')[0]
+    return k[0] if k[0] in 'FSXYZ' else k
+
+def unlocks(line): return line.strip().upper() in ('$X','$H')
+
+def parse_status(line): # '<Idle,MPos:...,WPos:...>' (grbl 0.9) or '<Idle|MPos:...|WCO:...>' (1.1) as a dict
+    fields=re.split(r'[,|](?=[A-Za-z])',line.strip().strip('<>'))
+    st={'state':fields[0].split(':')[0]}
+    for f in fields[1:]:
+        k,_,v=f.partition(':')
+        try: st[k.lower()]=[float(x) for x in v.split(',')]
+        except ValueError: st[k.lower()]=v
+    if 'wpos' not in st and 'mpos' in st and 'wco' in st: st['wpos']=[m-o for m,o in zip(st['mpos'],st['wco'])]
+    return st
+
+class Command: # a line for grbl and, once it comes, its reply
+    def __init__(self,line,timeout):
+        self.line=line; self.timeout=timeout
+        self.sent=None # clock time it was written to the port
+        self.reply=None; self.error=None
+        self.done=threading.Event()
+
+    def finish(self,reply=None,error=None):
+        self.reply=reply; self.error=error
+        self.done.set()
+
+    def wait(self,timeout=None): # the reply ('ok'), or raises what the line failed with
+        # the reader thread times lines out itself; timeout (real seconds) is only a backstop
+        if not self.done.wait(timeout): raise GrblTimeout('no reply to '+self.line+' yet',self.line)
+        if self.error: raise self.error
+        return self.reply
+
+class Grbl:
+    def __init__(self,port,clock,timeout=default_timeout,poll=0.05):
+        self.port=port; self.clock=clock; self.timeout=timeout
+        port.timeout=poll # how often the reader looks at the clock when grbl says nothing
+        self.cond=threading.Condition()
+        self.queue=collections.deque() # Commands not written yet
+        self.inflight=collections.deque() # written, waiting for their reply, oldest first
+        self.used=0 # bytes of them in grbl's receive buffer
+        self.since=0. # when grbl got round to the oldest one in flight
+        self.alarm=None # what grbl said when it went into alarm, until $X or $H
+        self.resyncing=None # clock time of the soft reset, until grbl's banner comes
+        self.resets=0 # alarms, resets and unlocks so far (see above)
+        self.wco=None # the last work offset grbl reported; grbl 1.1 only sends it now and then
+        self.last_status=None; self.nstatus=0
+        self.messages=collections.deque(maxlen=50) # anything else grbl said: its banner, [feedback]
+        self.write_lock=threading.Lock()
+        self.closed=False
+        self.reset_stats()
+        threading.Thread(target=self._writer,name='grbl-write',daemon=True).start()
+        threading.Thread(target=self._reader,name='grbl-read',daemon=True).start()
+
+    def reset_stats(self):
+        self.latency={} # kind -> seconds from writing each line to its reply
+        self.errors=0; self.timeouts=0; self.alarms=0; self.strays=0; self.most=0
+
+    def send(self,line,timeout=None): # queues line and returns its Command without waiting for it
+        c=Command(line.strip(),self.timeout if timeout is None else timeout)
+        if len(c.line)+1>rx_size: raise ValueError('line too long for grbl: '+c.line)
+        with self.cond:
+            if self.closed: raise GrblError('the connection to grbl is closed',c.line)
+            if self.alarm and not unlocks(c.line) and not c.line.startswith('$'):
+                raise GrblAlarm('grbl is in alarm ('+self.alarm+'), home or unlock it first',c.line)
+            self.queue.append(c)
+            self.cond.notify_all()
+        return c
+
+    def command(self,line,timeout=None): # sends line and waits for grbl to answer it; returns the reply
+        return self.send(line,timeout).wait()
+
+    def realtime(self,data): # '?', '!', '~', ctrl-x: acted on at once, not queued and not answered with 'ok'
+        with self.write_lock: self.port.write(data)
+
+    def status(self,timeout=2.): # grbl's status report as a dict: state, mpos, wpos...
+        for tries in range(31): # grbl 1.1 sends WCO at least every 30 reports; wpos comes from the last one
+            with self.cond:
+                n=self.nstatus
+                self.realtime(b'?')
+                if not self.cond.wait_for(lambda: self.nstatus>n or self.closed,timeout/self.clock.speed) or self.closed:
+                    raise GrblTimeout('no status report from grbl within '+str(timeout)+' s','?')
+                st=parse_status(self.last_status)
+            if 'wco' in st: self.wco=st['wco']
+            elif 'wpos' in st and 'mpos' in st: self.wco=[m-w for m,w in zip(st['mpos'],st['wpos'])]
+            if 'wpos' in st or 'mpos' not in st: return st
+            if self.wco is not None:
+                st['wpos']=[m-o for m,o in zip(st['mpos'],self.wco)]
+                return st
+        raise GrblError('no work offset (WCO) in 30 status reports from grbl','?')
+
+    def room(self): # bytes that can be sent now without waiting for grbl
+        with self.cond: return rx_size-self.used-sum(len(c.line)+1 for c in self.queue)
+
+    def drain(self,timeout=None): # waits until every line sent so far has its reply
+        with self.cond:
+            last=self.queue[-1] if self.queue else self.inflight[-1] if self.inflight else None
+        if last: last.done.wait(timeout)
+
+    def wake(self): # the first thing after opening the port: grbl may still be starting up
+        self.realtime(b'\r\n\r\n')
+        self.clock.sleep(2) # its banner and those 'ok's arrive meanwhile, with nothing waiting for them
+
+    def close(self):
+        with self.cond:
+            self.closed=True
+            self._fail_all(GrblError('the connection to grbl was closed'))
+            self.cond.notify_all()
+
+    def _fail_all(self,error): # with cond held
+        for c in list(self.inflight)+list(self.queue):
+            c.finish(error=type(error)(str(error),c.line))
+        self.inflight.clear(); self.queue.clear(); self.used=0
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                while not self.closed and (self.resyncing is not None or not (self.queue and self.used+len(self.queue[0].line)+1<=rx_size)):
+                    self.cond.wait(0.1 if self.resyncing is not None else None)
+                if self.closed: return
+                c=self.queue.popleft()
+                c.sent=self.clock.time()
+                if not self.inflight: self.since=c.sent
+                self.inflight.append(c)
+                self.used+=len(c.line)+1
+                self.most=max(self.most,self.used)
+                # written with cond held, so a realtime '?' from status() cannot split the line
+                with self.write_lock: self.port.write((c.line+'\n').encode('utf-8'))
+
+    def _reader(self):
+        part=b''
+        while not self.closed:
+            try: data=self.port.readline()
+            except Exception as e: # the port has gone
+                print('grbl: cannot read the serial port: '+str(e))
+                self.close()
+                return
+            if data:
+                part+=data
+                if part.endswith(b'\n'): # a timed out read can end part way through a line
+                    self._line(part.decode('utf-8','replace').strip())
+                    part=b''
+            self._check_timeout()
+
+    def _line(self,text):
+        if not text: return
+        now=self.clock.time()
+        with self.cond:
+            if text.startswith('<'):
+                self.last_status=text; self.nstatus+=1
+            elif text=='ok' or text.startswith('error'):
+                if not self.inflight or self.resyncing is not None: # the answer to a line that timed out, or to wake()
+                    self.strays+=1
+                    return
+                c=self.inflight.popleft()
+                self.used-=len(c.line)+1
+                self.since=now
+                self.latency.setdefault(kind(c.line),[]).append(now-c.sent)
+                if text=='ok':
+                    if unlocks(c.line): self.alarm=None; self.resets+=1
+                    c.finish(text)
+                else:
+                    self.errors+=1
+                    # 'error: Alarm lock' (0.9); 1.1's 'error:9' is its lock for an alarm and for a jog
+                    # both, so it only counts as the alarm lock when grbl is known to be in alarm
+                    alarm='alarm' in text.lower() or (text=='error:9' and self.alarm is not None)
+                    if alarm and not self.alarm: self.alarm=text
+                    print('grbl: '+text+' for '+c.line)
+                    c.finish(text,(GrblAlarm if alarm else GrblError)('grbl said '+text+' to '+c.line,c.line,text))
+            elif text.upper().startswith('ALARM'):
+                self.alarm=text; self.alarms+=1; self.resets+=1
+                print('grbl: '+text+', home or unlock ($X) to carry on')
+                self._fail_all(GrblAlarm('grbl went into alarm: '+text))
+            else:
+                self.messages.append(text)
+                if text.startswith('Grbl '): self.resets+=1
+                if self.resyncing is not None and text.startswith('Grbl '): # the reset after a timeout is done:
+                    self.resyncing=None # what was queued since goes now
+                elif text.startswith('Grbl '): # grbl has been reset: lines in flight are lost
+                    self._fail_all(GrblError('grbl was reset'))
+                elif 'to unlock' in text: self.alarm=self.alarm or text # starts up locked until homed
+            self.cond.notify_all()
+
+    def _check_timeout(self):
+        now=self.clock.time()
+        with self.cond:
+            if self.resyncing is not None and now-self.resyncing>resync_timeout: # no banner: carry on anyway
+                print('grbl: no banner after the reset, taking replies again')
+                self.resyncing=None
+                self.cond.notify_all()
+            if not self.inflight: return
+            c=self.inflight[0]
+            if now-max(c.sent,self.since)<=c.timeout: return
+            self.inflight.popleft()
+            self.used-=len(c.line)+1
+            self.since=now; self.timeouts+=1
+            c.finish(error=GrblTimeout('grbl did not answer '+c.line+' within '+str(c.timeout)+' s',c.line))
+            # its reply may yet come and be taken for the next line's: start again from a reset grbl
+            self._fail_all(GrblTimeout('grbl did not answer '+c.line+', so it was reset before this was done'))
+            self.alarm='reset after no answer to '+c.line
+            self.resyncing=now
+            self.realtime(b'\x18')
+            self.cond.notify_all()
+        print('grbl: no answer to '+c.line+' within '+str(c.timeout)+' s; reset it, home or unlock ($X) to carry on')
+
+    def stats(self): # kind -> (count, median, 95th percentile, longest) of the seconds to a reply
+        with self.cond:
+            return dict((k,(len(v),float(np.percentile(v,50)),float(np.percentile(v,95)),float(max(v))))
+                        for k,v in self.latency.items() if v)
+
+    def report(self):
+        lines=['grbl line    count   median     p95    longest']
+        for k,(n,p50,p95,top) in sorted(self.stats().items()):
+            lines.append('%-10s %7d %7.3f s %6.3f s %7.3f s'%(k,n,p50,p95,top))
+        lines.append('at most %d of %d bytes in flight; %d errors, %d timeouts, %d alarms, %d stray replies'%(
+            self.most,rx_size,self.errors,self.timeouts,self.alarms,self.strays))
+        return '\n'.join(lines)
+
+if __name__=='__main__': # a simulated grbl over a pty: correlation, a lost reply, an alarm
+    import serial, time
+    import ami_hardware
+    clock=ami_hardware.SimClock(10.)
+    sim=ami_hardware.SimGrbl(clock)
+    g=Grbl(serial.Serial(ami_hardware.serve_pty(sim),115200),clock,timeout=5.)
+    g.wake()
+    g.command('$21=1'); g.command('$H',homing_timeout); g.command('G10 L2 P1 X-199 Y-199 Z-199')
+    print('homed:',g.status())
+    t=time.time()
+    cmds=[g.send('G0 x%g y%g z5'%(10+i,20+i)) for i in range(40)]+[g.send('m8'),g.send('m9')]
+    for c in cmds: c.wait()
+    print('%d lines answered in order in %.2f s real, %d bytes in flight at most'%(len(cmds),time.time()-t,g.most))
+    sim.drop=1 # the next reply is lost on the way
+    try: g.command('G0 x50',timeout=1.)
+    except GrblTimeout as e: print('as it should:',e)
+    sim.drop=0
+    try: g.command('G0 x60')
+    except GrblAlarm as e: print('as it should:',e)
+    g.command('$X'); print('unlocked, carries on:',g.command('G0 x60'))
+    try: g.command('G0 x500')
+    except GrblAlarm as e: print('as it should:',e)
+    try: g.command('G0 x10')
+    except GrblAlarm as e: print('as it should:',e)
+    g.command('$X'); print('unlocked:',g.command('G0 x10'),g.status()['state'])
+    print(g.report())
+    print('the simulator\'s receive buffer overflowed %d times'%sim.overflows)
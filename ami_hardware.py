@@ -0,0 +1,493 @@
+# hardware backends for AMi
+#
+# AMiGUI talks to three pieces of hardware: grbl on the arduino (motion, light2 via the
+# spindle output and the "finished moving" signal on gpio 27), the pi camera and the
+# pi gpio pins (light1, light2 and pin 27).  open_hardware() returns objects for all
+# three plus a clock, and an ami_grbl.Grbl that everything sends its g-code through.
+# Parts that are slow to get going (homing, the camera) can be started side by side on
+# threads of their own with Hardware.start(); up() says when they are ready.  The real ones are pyserial, picamera and RPi.GPIO.  The simulated
+# ones copy just the parts of those libraries that AMi uses, so the rest of the program
+# doesn't need to know which one it has.  That lets a whole plate run on a laptop.
+#
+# The simulator models grbl 0.9 closely enough for timing:
+#  - moves take trapezoidal-profile time from the max rate and acceleration of each axis
+#  - 'ok' for a move comes back as soon as it is planned (unless the planner is full)
+#  - M8/M9 (and M3/M5) wait for the planner to empty, then change the coolant pin that
+#    is wired to gpio 27, which is what wait_for_Idle watches
+#  - '?' gets a <Idle,MPos:...,WPos:...> status report, and its newline gets an 'ok'
+#    of its own, just like the real thing
+#  - with hard limits on ($21=1), a move outside the travel stops everything with
+#    'ALARM: Hard/soft limit', and lines get 'error: Alarm lock' until $X or $H
+#  - '$J=' jogs (from grbl 1.1) move like G0 at their feed rate, a jog beyond the travel
+#    gets 'error:15', and the real-time jog cancel (0x85) brings a jog to a stop.  While
+#    it jogs, any other g-code line gets 'error:9' (grbl 1.1's g-code lock), and a jog
+#    sent while other motion is still going gets 'error:8'
+#  - reports11 makes status reports like grbl 1.1's: <Jog|MPos:...|FS:...>, with the work
+#    offset (WCO) in only every 10th of them
+#  - a soft reset (ctrl-x) stops everything, throws away the replies not sent yet and
+#    answers with the banner; reset in the middle of a move, it is in alarm until $X or $H
+#  - an alarm or a reset turns the coolant pin and the spindle off, as grbl's mc_reset does
+#  - drop=n loses every n-th reply on the way back, and overflows counts the lines
+#    that arrived with grbl's 128 byte receive buffer already full
+# serve_pty() puts it behind a pseudo terminal, so it can be opened as a serial port.
+# Captures take a fixed still-port or video-port latency.  After a move the picture shakes
+# for a while, more after a long move than a short one, like the real stage rings.
+
+import numpy as np
+import io, os, re, threading
+import ami_grbl
+from time import sleep, monotonic
+
+grbl_max_rate=(2000.,2000.,600.) # $110-$112, mm/min; used by the simulator and to estimate travel times
+grbl_accel=(50.,50.,50.) # $120-$122, mm/s^2
+
+class Clock: # wall clock used with the real hardware
+    speed=1.
+    def time(self): return monotonic()
+    def sleep(self,dt):
+        if dt>0: sleep(dt)
+
+class SimClock(Clock): # clock for the simulator; speed>1 runs the instrument faster than real time
+    def __init__(self,speed=1.):
+        self.speed=float(speed)
+        self.t0=monotonic()
+    def time(self): return (monotonic()-self.t0)*self.speed # seconds of instrument time
+    def sleep(self,dt):
+        if dt>0: sleep(dt/self.speed)
+
+def move_time(dist,vmax,accel): # time for a trapezoidal (or triangular) velocity profile
+    dist=abs(dist)
+    if dist==0.: return 0.
+    if dist>=vmax*vmax/accel: return dist/vmax+vmax/accel
+    return 2.*np.sqrt(dist/accel)
+
+class SimGrbl: # stands in for serial.Serial('/dev/ttyUSB0',115200) with grbl 0.9 on the other end
+    planner_size=15 # blocks grbl can hold before it stops answering 'ok'
+    def __init__(self,clock,max_rate=grbl_max_rate,accel=grbl_accel,home_time=8.,home_pos=-199.,line_time=0.002,
+                 travel=(199.,199.,199.)):
+        self.clock=clock
+        self.max_rate=[r/60. for r in max_rate] # $110-$112 are in mm/min, we want mm/s
+        self.accel=list(accel) # $120-$122, mm/s^2
+        self.home_time=home_time; self.home_pos=home_pos
+        self.travel=travel # machine coordinates go from home_pos to home_pos+travel
+        self.hard_limits=False; self.alarm=False
+        self.jogging=False # the motion queued is all jogs, which 0x85 can cancel
+        self.jogs=True # False: '$J=' is not known, as before grbl 1.1
+        self.reports11=False; self.nreports=0 # grbl 1.1 status reports (see above)
+        self.stop_time=0.05 # seconds a cancelled jog takes to come to a stop
+        self.drop=0; self.nreplies=0
+        self.unanswered=[] # (time answered, bytes) of lines taking up the receive buffer
+        self.overflows=0
+        self.line_time=line_time # time grbl takes to receive and parse one line
+        self.moves=[] # (start time, end time, start machine position, end machine position)
+        self.target=[0.,0.,0.] # machine position at the end of everything queued
+        self.wco=[0.,0.,0.] # work coordinate offset (G54)
+        self.busy_until=0. # time the queued motion will be finished
+        self.last_ready=0. # time the last response goes out; grbl answers lines in order
+        self.pin=[(0.,0)] # (time, level) changes of the coolant output wired to gpio 27
+        self.spindle=[(0.,0)]
+        self.out=[] # (time the response is available, response bytes)
+        self.rx=b''
+        self.timeout=None
+        self.nlines=0; self.nmoves=0
+        self.lock=threading.Lock() # the gpio simulator reads the pin from its own thread
+        self.io=threading.Lock() # and lines come in and replies go out on threads of their own
+        self.listeners=[] # called with (time, level) whenever a change of the coolant pin is scheduled
+
+    def position(self,t=None): # machine position at time t (now by default)
+        if t is None: t=self.clock.time()
+        for t0,t1,p0,p1 in reversed(self.moves):
+            if t>=t1: return list(p1)
+            if t>=t0:
+                f=(t-t0)/(t1-t0)
+                return [a+(b-a)*f for a,b in zip(p0,p1)]
+        return list(self.moves[0][2]) if self.moves else list(self.target)
+
+    def level(self,events,t=None): # value of a timed output at time t
+        with self.lock:
+            if t is None:
+                t=self.clock.time()
+                while len(events)>1 and events[1][0]<=t: del events[0] # changes come in time order, so the past can go
+            val=events[0][1]
+            for te,v in events:
+                if te>t: break
+                val=v
+        return val
+
+    def idle(self,t=None):
+        if t is None: t=self.clock.time()
+        return t>=self.busy_until
+
+    def _respond(self,t,line):
+        self.nreplies+=1
+        if self.drop and self.nreplies%self.drop==0: return # lost on the way
+        t=max(t,self.last_ready)
+        self.last_ready=t
+        self.out.append((t,(line+'\r\n').encode('utf-8')))
+
+    def _queue_move(self,t,target,rate=None): # rate (mm/s) slower than the axes' max rate for jogs
+        start=max(t,self.busy_until)
+        dt=max(move_time(b-a,min(v,rate) if rate else v,acc) for a,b,v,acc in zip(self.target,target,self.max_rate,self.accel))
+        self.moves.append((start,start+dt,list(self.target),list(target)))
+        self.moves=self.moves[-64:]
+        self.target=list(target)
+        self.busy_until=start+dt
+        self.nmoves+=1
+        # the planner only holds so many blocks; when it is full the 'ok' waits for a slot
+        ready=t
+        if len(self.moves)>self.planner_size:
+            ready=max(t,self.moves[-self.planner_size-1][1])
+        return ready
+
+    def _status(self,t):
+        m=self.position(t)
+        w=[a-b for a,b in zip(m,self.wco)]
+        state='Idle' if self.idle(t) else 'Jog' if self.jogging else 'Run'
+        if self.reports11:
+            self.nreports+=1
+            return '<%s|MPos:%.3f,%.3f,%.3f|FS:0,0'%(state,m[0],m[1],m[2])+('|WCO:%.3f,%.3f,%.3f'%tuple(self.wco) if self.nreports%10==1 else '')+'>'
+        return '<%s,MPos:%.3f,%.3f,%.3f,WPos:%.3f,%.3f,%.3f>'%(state,m[0],m[1],m[2],w[0],w[1],w[2])
+
+    def _execute(self,line):
+        t=max(self.clock.time(),self.last_ready)+self.line_time
+        self.nlines+=1
+        cmd=line.replace(' ','').upper()
+        words=dict((k,float(v)) for k,v in re.findall(r'([A-Z])(-?[0-9.]+)',cmd))
+        if self.alarm and cmd not in ('$X','$H'):
+            self._respond(t,'ok' if cmd.startswith('$') or not cmd else 'error: Alarm lock')
+        elif cmd=='$X':
+            self.alarm=False
+            self._respond(t,'ok')
+        elif self.jogging and not self.idle(t) and cmd and not cmd.startswith('$'):
+            self._respond(t,'error:9') # g-code is locked out while grbl jogs
+        elif cmd.startswith('$J='): # jog: G0 at the feed rate given, absolute (G90) or relative (G91)
+            if not self.jogs:
+                self._respond(t,'error: Invalid statement') # what grbl 0.9 says to a '$' line it does not know
+                return
+            if 'F' not in words:
+                self._respond(t,'error:22') # grbl 1.1: a jog needs a feed rate
+                return
+            if not (self.jogging or self.idle(t)):
+                self._respond(t,'error:8') # grbl 1.1 only jogs from Idle or Jog
+                return
+            target=list(self.target)
+            for i,ax in enumerate('XYZ'):
+                if ax in words: target[i]=(target[i] if 'G91' in cmd else self.wco[i])+words[ax]
+            if any(not self.home_pos-1e-6<=c<=self.home_pos+r+1e-6 for c,r in zip(target,self.travel)):
+                self._respond(t,'error:15') # jog beyond the travel: refused, no alarm
+                return
+            if self.idle(t): self.jogging=True
+            self._respond(self._queue_move(t,target,words['F']/60.),'ok')
+        elif cmd=='$H': # homing cycle waits for everything else and blocks until done
+            self.alarm=False; self.jogging=False
+            start=max(t,self.busy_until)
+            home=[self.home_pos]*3
+            self.moves.append((start,start+self.home_time,list(self.target),home))
+            self.target=home; self.busy_until=start+self.home_time
+            self._respond(self.busy_until,'ok')
+        elif cmd.startswith('$'): # settings and friends
+            if cmd.startswith('$21='): self.hard_limits=cmd=='$21=1'
+            self._respond(t,'ok')
+        elif cmd.startswith('G10') and words.get('L')==2.: # set the work coordinate offset
+            for i,ax in enumerate('XYZ'):
+                if ax in words: self.wco[i]=words[ax]
+            self._respond(t,'ok')
+        elif cmd.startswith('G4'): # dwell waits for the planner to empty and blocks
+            self.busy_until=max(t,self.busy_until)+words.get('P',0.)
+            self._respond(self.busy_until,'ok')
+        elif cmd[:2] in ('M8','M9','M3','M5') and not cmd[2:3].isdigit(): # synchronized outputs
+            t1=max(t,self.busy_until)
+            with self.lock:
+                if cmd[:2] in ('M8','M9'):
+                    self.pin.append((t1,1 if cmd[:2]=='M8' else 0))
+                    for f in self.listeners: f(*self.pin[-1])
+                else: self.spindle.append((t1,1 if cmd[:2]=='M3' else 0))
+            self._respond(t1,'ok')
+        elif cmd[:2] in ('G0','G1') and not cmd[2:3].isdigit() and any(ax in words for ax in 'XYZ'):
+            target=list(self.target)
+            for i,ax in enumerate('XYZ'):
+                if ax in words: target[i]=words[ax]+self.wco[i]
+            self.jogging=False
+            if self.hard_limits and any(not self.home_pos-1e-6<=c<=self.home_pos+r+1e-6 for c,r in zip(target,self.travel)):
+                self._limit(max(t,self.busy_until))
+            else: self._respond(self._queue_move(t,target),'ok')
+        else: # empty lines, S words, anything else grbl would accept
+            self._respond(t,'ok')
+
+    def _limit(self,t): # the stage ran into a limit switch at t: everything stops
+        self.moves=[m for m in self.moves if m[0]<=t]
+        p=self.position(t)
+        self.moves.append((t,t,p,p))
+        self.target=p; self.busy_until=t
+        self.alarm=True
+        self._outputs_off(t)
+        t=max(t,self.last_ready); self.last_ready=t
+        self.out.append((t,b'ALARM: Hard/soft limit\r\n'))
+
+    def _outputs_off(self,t): # grbl resets coolant and spindle when it stops everything, and drops their changes still queued
+        with self.lock:
+            self.pin=[e for e in self.pin if e[0]<=t]+[(t,0)]
+            self.spindle=[e for e in self.spindle if e[0]<=t]+[(t,0)]
+            for f in self.listeners: f(t,0)
+
+    def _jog_cancel(self,t): # 0x85: a jog decelerates to a stop and the jogs queued after it are dropped
+        if not self.jogging or self.idle(t): return
+        p0=self.position(t); p1=self.position(t+self.stop_time)
+        self.moves=[m for m in self.moves if m[0]<=t]
+        self.moves.append((t,t+self.stop_time,p0,p1))
+        self.target=p1; self.busy_until=t+self.stop_time
+        self.jogging=False
+
+    def _reset(self,t): # ctrl-x: motion stops where it is, and nothing still to come is answered
+        if not self.idle(t): self.alarm=True # grbl no longer knows where it is
+        self.moves=[m for m in self.moves if m[0]<=t]
+        p=self.position(t)
+        self.moves.append((t,t,p,p))
+        self.target=p; self.busy_until=t; self.jogging=False
+        self._outputs_off(t)
+        self.out=[o for o in self.out if o[0]<=t]
+        self.rx=b''; self.unanswered=[]
+        self.last_ready=t
+        self.out.append((t,b'\r\n'))
+        self.out.append((t,b"Grbl 0.9j ['$' for help]\r\n"))
+        if self.alarm: self.out.append((t,b"['$H'|'$X' to unlock]\r\n"))
+
+    def write(self,data):
+        with self.io:
+            for c in data.decode('latin-1'): # real-time commands like 0x85 are not utf-8
+                if c=='\x85':
+                    self._jog_cancel(self.clock.time())
+                elif c=='\x18':
+                    self._reset(self.clock.time())
+                elif c=='?': # real-time status request, answered right away
+                    t=self.clock.time()
+                    self.out.append((t,(self._status(t)+'\r\n').encode('utf-8')))
+                    self.out.sort(key=lambda o:o[0]) # it can overtake 'ok's that are still waiting
+                elif c=='\n':
+                    line=self.rx.decode('latin-1').strip()
+                    self.rx=b''
+                    now=self.clock.time()
+                    self.unanswered=[u for u in self.unanswered if u[0]>now]
+                    if sum(n for _,n in self.unanswered)+len(line)+1>128: self.overflows+=1 # grbl would have lost some of it
+                    self._execute(line)
+                    self.unanswered.append((self.last_ready,len(line)+1))
+                elif c!='\r':
+                    self.rx+=c.encode('latin-1')
+        return len(data)
+
+    def readline(self):
+        end=self.clock.time()+(self.timeout or 0.)
+        while True:
+            with self.io:
+                now=self.clock.time()
+                if self.out and self.out[0][0]<=now: return self.out.pop(0)[1]
+                due=self.out[0][0] if self.out else None
+            if due is None and not self.timeout: return b'' # nothing coming; a real port without a timeout would hang here
+            if due is None or (self.timeout and due>end):
+                if now>=end: return b''
+                due=end
+            self.clock.sleep(min(due-now,0.002*self.clock.speed)) # a '?' can still overtake what is coming
+
+    @property
+    def in_waiting(self):
+        t=self.clock.time()
+        with self.io: return sum(len(line) for te,line in self.out if te<=t)
+
+    def flushInput(self):
+        t=self.clock.time()
+        with self.io: self.out=[o for o in self.out if o[0]>t]
+    reset_input_buffer=flushInput
+
+    def close(self): pass
+
+def serve_pty(grbl): # grbl (a SimGrbl) behind a pseudo terminal; returns the name of the port to open
+    import pty, tty
+    master,slave=pty.openpty()
+    tty.setraw(slave) # no echo, no line editing: bytes go through as they are
+    grbl.timeout=1.
+    def incoming():
+        while True: grbl.write(os.read(master,256))
+    def outgoing():
+        while True:
+            line=grbl.readline()
+            if line: os.write(master,line)
+    threading.Thread(target=incoming,name='sim-pty-in',daemon=True).start()
+    threading.Thread(target=outgoing,name='sim-pty-out',daemon=True).start()
+    grbl.pty=(master,slave) # kept open for as long as the simulator is there
+    return os.ttyname(slave)
+
+class SimGPIO: # stands in for the RPi.GPIO module; pin 27 follows the grbl coolant output
+    BCM='BCM'; BOARD='BOARD'
+    IN='IN'; OUT='OUT'
+    PUD_DOWN='PUD_DOWN'; PUD_UP='PUD_UP'; PUD_OFF='PUD_OFF'
+    LOW=0; HIGH=1
+    RISING='RISING'; FALLING='FALLING'; BOTH='BOTH'
+    def __init__(self,grbl,idle_pin=27):
+        self.grbl=grbl; self.idle_pin=idle_pin
+        self.outputs={}
+        self.detect={} # pin -> [edge, callbacks, detected flag]; only the idle pin has edges
+        self.watcher=None
+        self.changes=[] # scheduled (time, level) changes of the idle pin the watcher hasn't reached yet
+        grbl.listeners.append(self._changed)
+    def _changed(self,t,v): # the idle pin goes to v at t; a reset can take back changes that were to come later
+        self.changes[:]=[c for c in self.changes if c[0]<=t]+[(t,v)]
+    def setmode(self,mode): pass
+    def setwarnings(self,flag): pass
+    def setup(self,pin,direction,pull_up_down=None,initial=None):
+        if direction==self.OUT: self.outputs[pin]=initial or self.LOW
+    def output(self,pin,value): self.outputs[pin]=int(bool(value))
+    def input(self,pin):
+        if pin==self.idle_pin: return self.grbl.level(self.grbl.pin)
+        return self.outputs.get(pin,self.LOW)
+    def cleanup(self,*pins): self.outputs={}; self.detect={}
+
+    def _edge(self,edge,was,now):
+        return was!=now and (edge==self.BOTH or (edge==self.RISING)==bool(now))
+
+    def wait_for_edge(self,pin,edge,bouncetime=None,timeout=None): # timeout in ms, like RPi.GPIO
+        end=None if timeout is None else monotonic()+timeout/1000./self.grbl.clock.speed
+        was=self.input(pin)
+        while end is None or monotonic()<end:
+            sleep(0.0002)
+            now=self.input(pin)
+            if self._edge(edge,was,now): return pin
+            was=now
+        return None
+
+    def add_event_detect(self,pin,edge,callback=None,bouncetime=None): # callbacks run on a separate thread, like RPi.GPIO
+        self.detect[pin]=[edge,[callback] if callback else [],False]
+        if self.watcher is None:
+            now=self.grbl.clock.time()
+            self.changes=[c for c in self.changes if c[0]>now] # the past is already in the current level
+            self.watcher=threading.Thread(target=self._watch,name='sim-gpio',daemon=True)
+            self.watcher.start()
+    def add_event_callback(self,pin,callback): self.detect[pin][1].append(callback)
+    def remove_event_detect(self,pin): self.detect.pop(pin,None)
+    def event_detected(self,pin):
+        d=self.detect.get(pin)
+        if not d or not d[2]: return False
+        d[2]=False
+        return True
+
+    def _watch(self): # goes through the pin changes as their time comes, so even short pulses make edges
+        level=self.input(self.idle_pin)
+        while True:
+            now=self.grbl.clock.time()
+            while self.changes and self.changes[0][0]<=now:
+                t,v=self.changes.pop(0)
+                d=self.detect.get(self.idle_pin)
+                if d and self._edge(d[0],level,v):
+                    d[2]=True
+                    for cb in d[1]: cb(self.idle_pin)
+                level=v
+            sleep(0.0002)
+
+class SimCamera: # stands in for picamera.PiCamera
+    def __init__(self,clock,grbl=None,still_latency=0.4,jpeg_bytes=350000,card_rate=5e6,images=False):
+        self.clock=clock; self.grbl=grbl
+        self.resolution=(1640,1232)
+        self.framerate=30
+        self.iso=0
+        self.still_latency=still_latency # mode switch, exposure and jpeg encode on the still port
+        self.jpeg_bytes=jpeg_bytes # size of the stand-in file written when images is False
+        self.card_rate=card_rate # bytes/s written to the SD card when capturing straight to a file
+        self.images=images # make real synthetic pictures (needs PIL to write jpegs)
+        self.focus=None # function (x,y) -> z that is in focus (work coordinates, what G0 is given), used when images is True
+        self.shake=0.5 # pixels of ringing per mm of the last move, dying away over shake_tau seconds
+        self.shake_tau=0.15
+        self.preview=False
+        self.ncaptures=0
+
+    def start_preview(self,**kw): self.preview=True
+    def stop_preview(self): self.preview=False
+    def close(self): pass
+
+    def frame(self,resize=None): # synthetic picture that gets blurrier away from the focal plane
+        w,h=resize or self.resolution
+        m=[a-o for a,o in zip(self.grbl.position(),self.grbl.wco)] if self.grbl else [0.,0.,0.] # work coordinates, like focus's
+        focus=self.focus(m[0],m[1]) if self.focus else m[2]
+        sharp=np.exp(-((m[2]-focus)/0.3)**2)
+        yy,xx=np.mgrid[0:h,0:w].astype(np.float32)
+        if self.grbl: # ringing after the last few moves
+            for t0,t1,p0,p1 in self.grbl.moves[-4:]:
+                dt=self.clock.time()-t1
+                if dt>0: xx+=self.shake*np.sqrt(sum((a-b)**2 for a,b in zip(p0,p1)))*np.exp(-dt/self.shake_tau)*np.sin(2*np.pi*12.*dt)*w/self.resolution[0]
+        img=128.+60.*np.sin((xx+37.*m[0])/7.)*np.sin((yy+37.*m[1])/5.)*sharp
+        return np.repeat(np.clip(img,0,255).astype(np.uint8)[:,:,None],3,axis=2)
+
+    def capture(self,output,format=None,use_video_port=False,resize=None,**kw):
+        t0=monotonic()
+        if format is None and isinstance(output,str): format=os.path.splitext(output)[1][1:].lower() or 'jpeg'
+        if format=='jpg': format='jpeg'
+        if not self.images and format in ('rgb','yuv') and not resize and isinstance(output,np.ndarray):
+            data=None # a full-size raw frame nobody is going to look at: only the timing matters
+        elif self.images or format in ('rgb','yuv'):
+            img=self.frame(resize)
+            if format in ('rgb','yuv'): # unencoded captures are padded to 32 columns and 16 rows like picamera's
+                h,w=img.shape[:2]
+                pad=np.zeros((((h+15)//16)*16,((w+31)//32)*32,3),np.uint8); pad[:h,:w]=img
+                data=pad.tobytes() if format=='rgb' else pad[:,:,0].tobytes()+bytes([128])*(pad.shape[0]*pad.shape[1]//2)
+            else:
+                from PIL import Image
+                buf=io.BytesIO(); Image.fromarray(img).save(buf,format='JPEG'); data=buf.getvalue()
+        else: data=bytes(self.jpeg_bytes)
+        latency=(1./self.framerate) if use_video_port else self.still_latency
+        if isinstance(output,str): latency+=len(data)/self.card_rate
+        self.clock.sleep(latency-(monotonic()-t0)*self.clock.speed)
+        if isinstance(output,str):
+            with open(output,'wb') as f: f.write(data)
+        elif isinstance(output,np.ndarray):
+            if data is not None: output.reshape(-1)[:len(data)]=np.frombuffer(data,np.uint8)
+        else: output.write(data)
+        self.ncaptures+=1
+
+    def capture_sequence(self,outputs,format='jpeg',use_video_port=False,resize=None,**kw):
+        for output in outputs: self.capture(output,format,use_video_port,resize)
+
+class Hardware: # everything AMi needs to talk to, real or simulated
+    def __init__(self,s,camera,GPIO,clock,simulated=False,grbl=None,open_camera=None):
+        self.s=s; self.camera=camera; self.GPIO=GPIO; self.clock=clock
+        self.simulated=simulated
+        self.grbl=grbl or ami_grbl.Grbl(s,clock) # the only thing that reads or writes s
+        self.open_camera=open_camera # makes the camera, when it was left for later (camera is None till then)
+        self.status={} # part -> how starting it is going: 'homing', 'ready', or what went wrong
+        self.ready={} # part -> threading.Event set once it is ready or has failed
+        self.took={} # part -> seconds it took
+
+    def start(self,part,fn,*args): # fn(*args) on a thread of its own, alongside any other part starting
+        self.status[part]='starting'
+        done=self.ready[part]=threading.Event()
+        def run():
+            t0=monotonic()
+            try:
+                fn(*args)
+                self.status[part]='ready'
+            except Exception as e:
+                self.status[part]='failed: '+str(e)
+                print(part+' did not start: '+str(e))
+            self.took[part]=monotonic()-t0
+            done.set()
+        threading.Thread(target=run,name='start-'+part,daemon=True).start()
+
+    def up(self,*parts): # whether parts (all those started, by default) are ready
+        return all(self.ready[p].is_set() and self.status[p]=='ready' for p in (parts or self.ready) if p in self.ready)
+
+def open_hardware(simulate=False,speed=1.,port='/dev/ttyUSB0',images=False,pty=False,defer_camera=False):
+    # pty talks to the simulated grbl through a pseudo terminal and pyserial, like to the real one
+    # defer_camera leaves hw.camera None and hw.open_camera() to make it, e.g. alongside homing
+    if simulate:
+        clock=SimClock(speed)
+        s=SimGrbl(clock)
+        grbl=None
+        if pty:
+            import serial
+            grbl=ami_grbl.Grbl(serial.Serial(serve_pty(s),115200),clock)
+        make=lambda: SimCamera(clock,s,images=images)
+        return Hardware(s,None if defer_camera else make(),SimGPIO(s),clock,simulated=True,grbl=grbl,open_camera=make)
+    import serial
+    import RPi.GPIO as GPIO
+    def make():
+        from picamera import PiCamera
+        return PiCamera()
+    s=serial.Serial(port,115200) # open grbl serial port
+    return Hardware(s,None if defer_camera else make(),GPIO,Clock(),open_camera=make)
@@ -0,0 +1,179 @@
+# jogging: the XY and Z click pads move the stage with grbl jogs
+#
+# A click on a pad used to send a G0 and wait for grbl to take it before the next click
+# was looked at, so quick clicks queued up behind each other, the stage trailed the
+# operator while the corners were being lined up, and a long move could not be taken back.
+# A Jogger moves the stage with grbl 1.1's '$J=' jog commands instead:
+#
+#  - go() says where the stage should end up and returns at once.  A thread sends one jog
+#    there, and the next only when the one before is nearly there (lead seconds from the
+#    end), so all the clicks that come while a jog is on its way merge into one (jogs go
+#    to absolute positions, so no click is lost)
+#  - hold() jogs towards the edge of the travel for as long as a pad is held down, and
+#    stop() cancels it with the real-time jog cancel (0x85): the stage comes to rest where
+#    the button was let go, instead of running through a queue of moves
+#
+# The GUI still checks every click against xmax, ymax and zmax, and a hold stops short of
+# them.  grbl older than 1.1 does not know '$J='; the first jog it refuses as unknown
+# switches the Jogger to G0 moves (still merged, but hold() then says no and the GUI
+# repeats clicks).  Any other error is kept in error for the GUI to show.  grbl 1.1 takes
+# no other g-code while it jogs (error:9), so flush() and pending() go on until every go()
+# has been sent and grbl has stopped jogging: the GUI keeps the stage until then.
+#
+#   python ami_jog.py    # 40 quick clicks on the simulator, with G0 as before and with jogs
+
+import numpy as np
+import threading, time
+import ami_grbl
+
+margin=0.01 # mm a hold stops short of the limits
+unknown=('error: Invalid statement','error: Unsupported statement','error:3') # what grbl before 1.1 says to '$J='
+
+class Jogger:
+    def __init__(self,grbl,limits,mode='jog',gather=0.03,lead=0.2):
+        self.grbl=grbl; self.limits=limits
+        self.mode=mode # 'jog', or 'g0' for grbl older than 1.1
+        self.gather=gather # seconds to wait for more clicks before sending a jog
+        self.lead=lead # seconds before the last jog gets there that the next can go
+        self.feed=2000. # mm/min of jogs go() sends (grbl still keeps each axis to its max rate)
+        self.target=None # where the stage is going, work coordinates
+        self.sent=None # where the last jog sent was going
+        self.asked=0; self.done=0 # go()s so far, and how many of them have been sent
+        self.sending=False; self.holding=False
+        self.jogs=0; self.clicks=0 # jogs sent and go()s they covered
+        self.error=None # the last thing grbl refused, until whoever shows it clears it
+        self.cond=threading.Condition()
+        threading.Thread(target=self._work,name='jog',daemon=True).start()
+
+    def go(self,xyz): # the stage is to end up at xyz (already checked against the limits)
+        with self.cond:
+            self.target=[float(c) for c in xyz]
+            self.asked+=1
+            self.cond.notify_all()
+
+    def flush(self): # until every go() so far has been sent to grbl and grbl has stopped jogging
+        with self.cond:
+            self.cond.wait_for(lambda: not self.sending and self.done==self.asked)
+
+    def pending(self): # True while go()s are still to be sent or jogging, or a hold goes on; never waits
+        with self.cond: return self.sending or self.done!=self.asked or self.holding
+
+    def edge(self,frm,direction): # how far from frm along direction the travel goes, short of the limits
+        d=np.asarray(direction,float)
+        d=d/max(np.linalg.norm(d),1e-12)
+        s=min(((m-margin if di>0 else margin)-p)/di for p,di,m in zip(frm,d,self.limits) if abs(di)>1e-9)
+        return [p+s*di for p,di in zip(frm,d)] if s>0 else None
+
+    def hold(self,frm,direction,feed): # jogs from frm along direction at feed mm/min until stop(); False if it cannot
+        if self.mode!='jog': return False
+        self.flush()
+        end=self.edge(frm,direction)
+        if end is None: return False
+        with self.cond: self.holding=True
+        try: self.grbl.send(self.line(end,feed))
+        except ami_grbl.GrblError as e:
+            print('jog: '+str(e))
+            with self.cond: self.holding=False; self.error=str(e)
+            return False
+        return True
+
+    def stop(self,timeout=5.): # the pad is let go: stops a hold and returns where the stage came to rest
+        with self.cond:
+            if not self.holding: return self.target
+        self.grbl.realtime(b'\x85')
+        clock=self.grbl.clock; deadline=clock.time()+timeout
+        st=self.grbl.status()
+        while st['state'] not in ('Idle','Alarm') and clock.time()<deadline:
+            clock.sleep(0.01)
+            st=self.grbl.status()
+        with self.cond:
+            self.target=self.sent=[round(c,3) for c in st['wpos']]
+            self.done=self.asked
+            self.holding=False
+            return self.target
+
+    def line(self,xyz,feed):
+        if self.mode=='jog': return '$J=G90 G21 X%.4f Y%.4f Z%.4f F%.0f'%(xyz[0],xyz[1],xyz[2],feed)
+        return 'G0 X%.4f Y%.4f Z%.4f'%tuple(xyz)
+
+    def _nearly_there(self): # waits while the last jog still has more than lead seconds to go
+        if self.sent is None: return
+        clock=self.grbl.clock
+        try:
+            while True:
+                st=self.grbl.status()
+                if st['state'] not in ('Jog','Run'): return
+                left=np.linalg.norm(np.subtract(self.sent,st['wpos']))
+                if left<=self.feed/60.*self.lead: return
+                clock.sleep(0.02)
+        except ami_grbl.GrblError: return # no status: send it anyway
+
+    def _until_stopped(self): # while grbl jogs, unless another click comes
+        clock=self.grbl.clock
+        while self.grbl.status()['state']=='Jog':
+            with self.cond:
+                if self.done!=self.asked or self.holding: return
+            clock.sleep(0.02)
+
+    def _work(self): # sends a jog to the latest target whenever it has moved
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.done!=self.asked and not self.holding)
+                self.sending=True
+            time.sleep(self.gather) # clicks close together go out as one jog
+            n=0
+            try:
+                self._nearly_there()
+                with self.cond:
+                    to=self.sent=list(self.target)
+                    n=self.asked-self.done; self.done=self.asked
+                self.grbl.command(self.line(to,self.feed))
+                self.jogs+=1; self.clicks+=n
+            except ami_grbl.GrblError as e:
+                if self.mode=='jog' and not self.jogs and e.reply in unknown: # no '$J=' before grbl 1.1
+                    print('grbl does not jog ('+str(e)+'): moving with G0 instead')
+                    self.mode='g0'
+                    with self.cond: self.done-=n # send it again
+                else:
+                    print('jog: '+str(e))
+                    with self.cond: self.error=str(e)
+            except Exception as e: # anything else would leave sending set, and flush() waiting for ever
+                print('jog: '+repr(e))
+                with self.cond: self.error=repr(e); self.done=self.asked
+            try: self._until_stopped()
+            except Exception as e: print('jog: no status from grbl: '+repr(e))
+            with self.cond:
+                self.sending=False
+                self.cond.notify_all()
+
+if __name__=='__main__': # the same 40 clicks, 50 ms apart, with a G0 each, with a Jogger, and with one on grbl 0.9
+    import ami_hardware
+    for how in ('G0 each','0.9 jogs','jogs'):
+        hw=ami_hardware.open_hardware(simulate=True,speed=1.)
+        if how=='0.9 jogs': hw.s.jogs=False
+        else: hw.s.reports11=True # jogs come with grbl 1.1's status reports, WCO in only some of them
+        g=hw.grbl
+        g.command('$H',ami_grbl.homing_timeout); g.command('G10 L2 P1 X-199 Y-199 Z-199')
+        jog=Jogger(g,(160.,118.,29.3))
+        x=20.; t0=hw.clock.time(); gui=0.
+        for i in range(40):
+            x+=1.5
+            t=hw.clock.time()
+            if how!='G0 each': jog.go((x,30.,5.))
+            else: g.command('G0 x%g y30 z5'%x)
+            gui+=hw.clock.time()-t # how long the GUI could not look at the next click
+            hw.clock.sleep(max(0.,t+0.05-hw.clock.time()))
+        jog.flush()
+        while g.status()['state']!='Idle': hw.clock.sleep(0.01)
+        print('%-8s GUI busy %.2f s, stage at the last click %.2f s after it, %d lines sent'%(
+            how,gui,hw.clock.time()-t0-40*0.05,g.stats().get('G0',(0,))[0]+g.stats().get('$J',(0,))[0]))
+    jog.go((x-20.,30.,5.)); jog.flush()
+    print('g-code straight after a jog:',g.command('G0 x%g y30 z5'%x)) # not refused by the g-code lock
+    while g.status()['state']!='Idle': hw.clock.sleep(0.01) # grbl only jogs from Idle
+    jog.go((x,30.,250.)) # past the travel grbl has: refused (error:15), not taken for a grbl without jogs
+    jog.flush()
+    print('still in '+jog.mode+' mode, for the GUI to show: '+str(jog.error))
+    t=hw.clock.time()
+    jog.hold((x,30.,5.),(1.,0.,0.),1000.)
+    hw.clock.sleep(1.)
+    print('held for 1 s at 1000 mm/min, stopped at',jog.stop(),'%.2f s after letting go'%(hw.clock.time()-t-1.))
@@ -0,0 +1,82 @@
+# run journal: what a RUN has finished, so a stopped or crashed run can carry on
+#
+# Every run directory gets a journal.txt.  A line is added as each slice is taken and
+# once all of a sample's images are on disk; 'end' is written when the whole plate is
+# done.  If RUN is stopped, grbl raises an alarm or the pi loses power, the next RUN of
+# the same plate can pick the run directory up again (see unfinished) and only image the
+# samples that are not done, appending to the process .com file instead of starting it
+# over.
+#
+#   well A1a
+#   slice A1a 0 rawimages/A1a_0.jpg
+#   done A1a 4
+#   stopped
+#   end
+
+import os, threading, time
+
+class RunJournal:
+    def __init__(self,imgpath,resume=False): # without resume any old journal in imgpath is started over
+        self.imgpath=imgpath
+        self.path=imgpath+'/journal.txt'
+        self.slices={} # sample -> image paths (relative to imgpath) taken so far
+        self.done=[] # samples with all their images on disk, in the order they were finished
+        self.ended=False
+        if resume and os.path.exists(self.path): self._read()
+        self.lock=threading.Lock()
+        self.f=open(self.path,'a' if resume else 'w')
+
+    def _read(self):
+        with open(self.path) as f:
+            for line in f:
+                w=line.split()
+                if not w: continue
+                if w[0]=='well': self.slices[w[1]]=[] # a sample that was started again
+                elif w[0]=='slice': self.slices.setdefault(w[1],[]).append(w[3])
+                elif w[0]=='done' and w[1] not in self.done: self.done.append(w[1])
+                elif w[0]=='end': self.ended=True
+
+    def _write(self,line,sync=False):
+        with self.lock:
+            self.f.write(line+'\n')
+            self.f.flush()
+            if sync: os.fsync(self.f.fileno()) # survives the pi losing power
+
+    def start(self,resumed):
+        self._write(('resume ' if resumed else 'start ')+time.strftime('%Y-%m-%d_%H:%M:%S'))
+
+    def well(self,name): # starting on sample name
+        self.slices[name]=[]
+        self._write('well '+name)
+
+    def slice(self,name,path): # another image of sample name has been taken (path relative to the run directory)
+        self.slices[name].append(path)
+        self._write('slice %s %d %s'%(name,len(self.slices[name])-1,path))
+
+    def finished(self,name,nimages): # all of sample name's images are on disk
+        self.done.append(name)
+        self._write('done %s %d'%(name,nimages),sync=True)
+
+    def note(self,what): # e.g. 'stopped'
+        self._write(what,sync=True)
+
+    def end(self):
+        self.ended=True
+        self._write('end',sync=True)
+
+    def close(self):
+        self.f.close()
+
+def unfinished(imgroot,within=6.): # the latest run directory under imgroot with a journal that did not end
+    # only runs left off less than within hours ago count, so an old stopped run is not mixed with a new one
+    best=None
+    if not os.path.isdir(imgroot): return None
+    for d in os.listdir(imgroot):
+        j=imgroot+'/'+d+'/journal.txt'
+        if not os.path.exists(j) or not os.path.exists(imgroot+'/'+d+'/plan.txt'): continue
+        t=os.path.getmtime(j)
+        if time.time()-t>within*3600.: continue
+        with open(j) as f: lines=f.read().split()
+        if lines and lines[-1]=='end': continue
+        if best is None or t>best[0]: best=(t,imgroot+'/'+d)
+    return best[1] if best else None
@@ -0,0 +1,214 @@
+# image quality metrics: a few numbers for every sample of every run, in one SQLite file
+#
+# The run directories are the only record of what was imaged, so questions like "which
+# wells of this plate have gone blurry" or "which drops changed between day 3 and day 7"
+# meant opening every picture.  With quality_index set, RUN scores each sample on a
+# thread of its own as soon as its images are on disk, and adds it to an SQLite file
+# (images/metrics.db by default) keyed by sample ID, plate, run and well:
+#
+#   sharpness   of each slice (variance of the Laplacian, as autofocus uses) and of the best
+#   best_z      z of the sharpest slice (NULL when it is not known, e.g. past runs saved as jpegs)
+#   brightness  mean grey level of the sharpest slice, 0-255
+#   edges       fraction of the sharpest slice where the brightness steps by more than edge_step
+#               from one pixel to the next: next to nothing for a clear drop, more for
+#               precipitate, crystals and their edges
+#
+# Slices are read at about a quarter size (jpegs decoded in PIL's draft mode, stack files
+# read every few pixels, as for the overview), which takes a few milliseconds a slice.
+# Past runs can be added with 'index'; queries go through Index:
+#
+#   python ami_metrics.py index images                      # every run not in the index yet
+#   python ami_metrics.py wells AMi_sample AB_xs2           # the latest run of a plate
+#   python ami_metrics.py dropped AMi_sample AB_xs2         # wells less sharp than the run before
+#   python ami_metrics.py compare AMi_sample AB_xs2 3 7 -m edges  # days 3 and 7 (or two run names)
+
+import numpy as np
+import os, queue, sqlite3, sys, threading, time
+from datetime import datetime
+import ami_run # first: ami_focus and ami_overview need it loaded
+import ami_focus, ami_overview, ami_stack # as modules: ami_run imports this one
+
+default_index='images/metrics.db'
+size=(320,240) # slices are scored at about this size
+edge_step=16. # grey levels from one pixel to the next that count as an edge
+
+schema='''
+create table if not exists wells(sample text,plate text,run text,well text,time real,imgpath text,slices int,
+    best_slice int,best_z real,sharpness real,brightness real,edges real,unchanged int,
+    primary key(sample,plate,run,well));
+create table if not exists slices(sample text,plate text,run text,well text,slice int,z real,sharpness real,
+    primary key(sample,plate,run,well,slice));
+create index if not exists wells_by_time on wells(sample,plate,well,time);
+'''
+columns=('sample','plate','run','well','time','imgpath','slices','best_slice','best_z','sharpness','brightness','edges','unchanged')
+metrics=('sharpness','brightness','edges') # the columns runs can be compared on
+
+def run_key(imgpath): # (sample ID, plate, run) of images/<sID>/<nroot>/<date>
+    d=os.path.abspath(imgpath)
+    return os.path.basename(os.path.dirname(os.path.dirname(d))),os.path.basename(os.path.dirname(d)),os.path.basename(d)
+
+def run_time(imgpath): # when the run started, from its directory name (ami_run.tdate)
+    try: return time.mktime(datetime.strptime(os.path.basename(os.path.abspath(imgpath)),'%b-%d-%Y_%I:%M%p').timetuple())
+    except ValueError: return os.path.getmtime(imgpath)
+
+def edges(g): # fraction of pixels the brightness steps by more than edge_step to the next one from
+    step=np.maximum(np.abs(np.diff(g,axis=0))[:,:-1],np.abs(np.diff(g,axis=1))[:-1,:])
+    return float(np.mean(step>edge_step))
+
+def score(paths,zs=None): # a sample's metrics from its slice files (jpegs, or one stack file)
+    sharp=[]; best=None
+    for img in (s for p in paths for s in ami_overview.small_slices(p,size)):
+        g=ami_stack.gray(img)
+        sharp.append(ami_focus.sharpness(g))
+        if len(sharp)==1 or sharp[-1]>max(sharp[:-1]): best=g
+    if not sharp: return None
+    k=int(np.argmax(sharp))
+    return {'slices':len(sharp),'best_slice':k,'best_z':float(zs[k]) if zs and k<len(zs) else None,
+            'sharpness':sharp[k],'brightness':float(best.mean()),'edges':edges(best),'per_slice':sharp}
+
+def connect(path):
+    db=sqlite3.connect(path,timeout=30.)
+    db.execute('pragma journal_mode=wal') # RUN can add samples while queries read
+    db.executescript(schema)
+    return db
+
+def store(db,imgpath,well,m,zs=None,unchanged=False):
+    sample,plate,run=run_key(imgpath)
+    with db:
+        db.execute('insert or replace into wells values (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                   (sample,plate,run,well,run_time(imgpath),os.path.normpath(imgpath),m['slices'],m['best_slice'],m['best_z'],
+                    m['sharpness'],m['brightness'],m['edges'],int(unchanged)))
+        db.execute('delete from slices where sample=? and plate=? and run=? and well=?',(sample,plate,run,well))
+        db.executemany('insert into slices values (?,?,?,?,?,?,?)',
+                       [(sample,plate,run,well,k,float(zs[k]) if zs and k<len(zs) else None,s) for k,s in enumerate(m['per_slice'])])
+
+class Indexer: # scores samples on a thread of its own while RUN goes on
+    def __init__(self,path,imgpath):
+        self.path=path; self.imgpath=imgpath
+        self.queue=queue.Queue()
+        self.count=0; self.seconds=0.
+        self.thread=threading.Thread(target=self._work,name='metrics',daemon=True)
+        self.thread.start()
+
+    def add(self,name,paths,zs=None,unchanged=False): # a sample's images are on disk; returns right away
+        self.queue.put((name,list(paths),list(zs) if zs else None,unchanged))
+
+    def close(self): # until every sample added so far is in the index
+        self.queue.put(None)
+        self.thread.join()
+
+    def _work(self):
+        db=connect(self.path) # sqlite connections stay on the thread that made them
+        while True:
+            item=self.queue.get()
+            if item is None: break
+            name,paths,zs,unchanged=item
+            t=time.time()
+            try:
+                m=score(paths,zs)
+                if m: store(db,self.imgpath,name,m,zs,unchanged)
+                self.count+=1
+            except Exception as e: print('metrics for '+name+' failed: '+str(e))
+            self.seconds+=time.time()-t
+        db.close()
+
+def index_run(db,imgpath): # adds a past run; the number of samples
+    n=0
+    for name,paths in ami_stack.find_stacks(imgpath).items():
+        zs=None # only stack files say where their slices were taken
+        if paths[0].endswith('.amis'):
+            from ami_stackfile import StackFile
+            zs=StackFile(paths[0]).z or None
+        m=score(paths,zs)
+        if m:
+            store(db,imgpath,name,m,zs,os.path.islink(imgpath+'/'+name+'.tif'))
+            n+=1
+    return n
+
+class Index: # queries; every row is a dict of the wells columns
+    def __init__(self,path=default_index):
+        self.db=connect(path)
+        self.db.row_factory=sqlite3.Row
+
+    def rows(self,sql,args=()):
+        return [dict(r) for r in self.db.execute(sql,args)]
+
+    def runs(self,sample,plate): # [(run, time)] oldest first
+        return [(r['run'],r['time']) for r in self.rows('select distinct run,time from wells where sample=? and plate=? order by time',(sample,plate))]
+
+    def run_on(self,sample,plate,day): # the run closest to day days after the plate's first one
+        runs=self.runs(sample,plate)
+        if not runs: return None
+        return min(runs,key=lambda r: abs(r[1]-runs[0][1]-day*86400.))[0]
+
+    def wells(self,sample=None,plate=None,run=None,well=None): # any of them left out matches everything
+        where=[(c,v) for c,v in (('sample',sample),('plate',plate),('run',run),('well',well)) if v is not None]
+        return self.rows('select * from wells'+(' where '+' and '.join(c+'=?' for c,v in where) if where else '')+
+                         ' order by time,well',[v for c,v in where])
+
+    def latest(self,sample,plate): # the plate's last run
+        runs=self.runs(sample,plate)
+        return self.wells(sample,plate,runs[-1][0]) if runs else []
+
+    def history(self,sample,plate,well): # one well over every run
+        return self.wells(sample,plate,None,well)
+
+    def slices(self,sample,plate,run,well): # [(slice, z, sharpness)]
+        return [(r['slice'],r['z'],r['sharpness']) for r in self.rows(
+            'select slice,z,sharpness from slices where sample=? and plate=? and run=? and well=? order by slice',(sample,plate,run,well))]
+
+    def compare(self,sample,plate,run_a,run_b,metric='sharpness'): # each well in both runs with metric in each, biggest change first
+        if metric not in metrics: raise ValueError('no metric '+metric)
+        return self.rows('select a.well as well,a.%s as a,b.%s as b,b.%s-a.%s as change from wells a join wells b '
+                         'on a.sample=b.sample and a.plate=b.plate and a.well=b.well '
+                         'where a.sample=? and a.plate=? and a.run=? and b.run=? and a.%s is not null and b.%s is not null '
+                         'order by abs(change) desc,well'%((metric,)*6),
+                         (sample,plate,run_a,run_b))
+
+    def dropped(self,sample,plate,metric='sharpness',by=0.3): # wells whose last run has metric down by more than the fraction by on the run before
+        runs=self.runs(sample,plate)
+        if len(runs)<2: return []
+        return [r for r in self.compare(sample,plate,runs[-2][0],runs[-1][0],metric) if r['a']>0 and r['change']<-by*r['a']]
+
+if __name__=='__main__':
+    import argparse
+    p=argparse.ArgumentParser(description='image quality metrics of every sample, and queries on them')
+    p.add_argument('--db',default=default_index,help='the index (default '+default_index+')')
+    sub=p.add_subparsers(dest='what',required=True)
+    q=sub.add_parser('index',help='add past runs'); q.add_argument('dirs',nargs='+')
+    q.add_argument('-a','--again',action='store_true',help='score runs already in the index again')
+    q=sub.add_parser('wells',help='a run of a plate (the latest by default)')
+    q.add_argument('sample'); q.add_argument('plate'); q.add_argument('run',nargs='?')
+    q=sub.add_parser('dropped',help='wells worse in the last run than in the one before')
+    q.add_argument('sample'); q.add_argument('plate'); q.add_argument('-m','--metric',default='sharpness',choices=metrics)
+    q.add_argument('--by',type=float,default=0.3,help='fraction it has to drop by (default 0.3)')
+    q=sub.add_parser('compare',help='two runs, each a run name or days after the first run')
+    q.add_argument('sample'); q.add_argument('plate'); q.add_argument('a'); q.add_argument('b')
+    q.add_argument('-m','--metric',default='edges',choices=metrics)
+    args=p.parse_args()
+    if args.what=='index':
+        from ami_reprocess import run_dirs
+        db=connect(args.db)
+        done=set(r[0] for r in db.execute('select distinct imgpath from wells'))
+        t=time.time(); n=0
+        for r in map(os.path.normpath,run_dirs(args.dirs)):
+            if r in done and not args.again: continue
+            n+=index_run(db,r)
+            print(r)
+        print('%d samples scored in %.1f s'%(n,time.time()-t))
+        sys.exit()
+    ix=Index(args.db)
+    t=time.time()
+    if args.what=='wells':
+        rows=ix.wells(args.sample,args.plate,args.run) if args.run else ix.latest(args.sample,args.plate)
+        print('well   run                  slices best  best_z  sharpness brightness edges')
+        for r in rows: print('%-6s %-20s %6d %4d %7s %10.1f %10.1f %5.3f'%(r['well'],r['run'],r['slices'],r['best_slice'],
+                             '-' if r['best_z'] is None else '%.3f'%r['best_z'],r['sharpness'],r['brightness'],r['edges']))
+    else:
+        if args.what=='dropped': rows=ix.dropped(args.sample,args.plate,args.metric,args.by)
+        else:
+            a,b=(ix.run_on(args.sample,args.plate,float(x)) if x.replace('.','',1).isdigit() else x for x in (args.a,args.b))
+            print(args.metric+': '+str(a)+' -> '+str(b))
+            rows=ix.compare(args.sample,args.plate,a,b,args.metric)
+        for r in rows: print('%-6s %10.3f %10.3f %+10.3f'%(r['well'],r['a'],r['b'],r['change']))
+    print('%d wells in %.1f ms'%(len(rows),(time.time()-t)*1000.))
@@ -0,0 +1,146 @@
+# plate overview: the whole plate as one small picture, kept up to date during RUN
+#
+# overview.jpg in the run directory has a tile for every sample, laid out like the
+# plate (rows A, B, ... down, columns 1, 2, ... across, the sub-samples of a well side
+# by side inside its cell).  Each tile is the sharpest slice of the sample's z-stack as
+# soon as its images are on disk, and is swapped for the fused <sample>.tif when the
+# FusionPool gets to it.  Wells not taken yet stay dark grey, so a plate that is in the
+# wrong place or has nothing in it shows up after the first row, not after the run.
+#
+# Tiles are made and the file rewritten on a thread of its own, a few samples at a
+# time; jpegs are decoded at 1/8 size (PIL's draft mode) and stack files and raw stacks
+# are only read every few pixels, so it takes next to nothing from the run.  The file is
+# written whole and renamed, so anything showing it never gets half a picture.
+#
+#   python ami_overview.py images/AMi_sample/AB_xs2/Oct-17-2026_11:02PM  # make one for a past run
+
+import numpy as np
+import os, sys, threading
+import ami_run
+from ami_focus import sharpness
+from ami_stack import gray, find_stacks
+
+background=40 # grey level of a tile not taken yet
+gap=4 # pixels between wells
+
+def small_slices(path,size): # the slices in path, shrunk to about size (w,h) or a bit bigger
+    from PIL import Image
+    w,h=size
+    if path.endswith('.amis') or path.endswith('.npy'):
+        if path.endswith('.amis'):
+            from ami_stackfile import StackFile
+            stack=StackFile(path)
+        else: stack=np.load(path,mmap_mode='r')
+        for frame in stack:
+            step=max(1,min(frame.shape[0]//h,frame.shape[1]//w))
+            yield np.ascontiguousarray(frame[::step,::step])
+    else:
+        with Image.open(path) as im:
+            im.draft('RGB',(w,h)) # a jpeg is decoded straight to 1/2, 1/4 or 1/8 size
+            yield np.asarray(im.convert('RGB'))
+
+def shrink(img,size):
+    from PIL import Image
+    return np.asarray(Image.fromarray(img).resize(size,Image.BILINEAR))
+
+class Overview:
+    def __init__(self,plate,path,tile=(160,120)):
+        self.plate=plate; self.path=path; self.tile=tile
+        self.cols=int(np.ceil(np.sqrt(plate.samps))) # sub-samples across a well
+        self.rows=-(-plate.samps//self.cols)
+        tw,th=tile
+        self.cell=(self.cols*tw+gap,self.rows*th+gap)
+        self.img=np.full((plate.ny*self.cell[1]+gap,plate.nx*self.cell[0]+gap,3),background,np.uint8)
+        self.where=dict((ami_run.well_name(plate,y,x,s),(y,x,s))
+                        for y in range(plate.ny) for x in range(plate.nx) for s in range(plate.samps))
+        self.fused=set() # samples showing their fused image, which a slice does not replace
+        self.todo=[]; self.busy=False; self.failed=0
+        self.lock=threading.Condition()
+        if os.path.exists(path): self._load() # a resumed run keeps the samples it already has
+
+    def _load(self):
+        from PIL import Image
+        try:
+            with Image.open(self.path) as im: old=np.asarray(im.convert('RGB'))
+        except Exception: return
+        if old.shape==self.img.shape: self.img[:]=old
+
+    def box(self,name): # (y0,y1,x0,x1) of a sample's tile
+        yrow,xcol,samp=self.where[name]
+        tw,th=self.tile
+        y0=gap+yrow*self.cell[1]+(samp//self.cols)*th
+        x0=gap+xcol*self.cell[0]+(samp%self.cols)*tw
+        return y0,y0+th,x0,x0+tw
+
+    def add(self,name,paths): # a sample's images are on disk: show its sharpest slice
+        self._queue(name,list(paths),False)
+
+    def add_fused(self,name,path): # its fused image is too (FusionPool.on_fused calls this)
+        self._queue(name,[path],True)
+
+    def _queue(self,name,paths,fused):
+        if name not in self.where: return
+        with self.lock:
+            self.todo.append((name,paths,fused))
+            if not self.busy: # a thread only while there is something to do
+                self.busy=True
+                threading.Thread(target=self._work,daemon=True).start()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if not self.todo:
+                    self.busy=False
+                    self.lock.notify_all()
+                    return
+                todo,self.todo=self.todo,[]
+            for name,paths,fused in todo:
+                try: self._tile(name,paths,fused)
+                except Exception as e:
+                    if not self.failed: print('overview: cannot show '+name+': '+str(e))
+                    self.failed+=1
+            try: self.write()
+            except Exception as e: print('overview: cannot write '+self.path+': '+str(e))
+
+    def _tile(self,name,paths,fused):
+        if name in self.fused and not fused: return
+        best=None
+        for p in paths:
+            for img in small_slices(p,self.tile):
+                score=sharpness(gray(img))
+                if best is None or score>best[0]: best=(score,img)
+        if best is None: return
+        y0,y1,x0,x1=self.box(name)
+        self.img[y0:y1,x0:x1]=shrink(best[1],self.tile)
+        if fused: self.fused.add(name)
+
+    def write(self): # written whole and renamed
+        from PIL import Image
+        tmp=self.path+'.part'
+        Image.fromarray(self.img).save(tmp,format='JPEG',quality=85)
+        os.replace(tmp,self.path)
+
+    def wait(self): # until every tile asked for so far is in the file
+        with self.lock:
+            while self.busy: self.lock.wait()
+
+def overview_run(imgpath,plate): # overview.jpg for a run directory, fused images where there are some
+    ov=Overview(plate,imgpath+'/overview.jpg')
+    for name,paths in find_stacks(imgpath).items():
+        if os.path.exists(imgpath+'/'+name+'.tif'): ov.add_fused(name,imgpath+'/'+name+'.tif')
+        else: ov.add(name,paths)
+    ov.wait()
+    return ov
+
+if __name__=='__main__':
+    if len(sys.argv)<2:
+        print('usage: python ami_overview.py run_directory [configuration file]')
+        sys.exit(1)
+    d=sys.argv[1]
+    confs=sys.argv[2:] or [d+'/'+f for f in os.listdir(d) if f.endswith('.config')] # RUN copies it into the run directory
+    if not confs:
+        print('no configuration file in '+d)
+        sys.exit(1)
+    conf=confs[0]
+    overview_run(d,ami_run.read_config(conf))
+    print('wrote '+d+'/overview.jpg')
@@ -0,0 +1,156 @@
+# the order RUN visits the samples on a plate
+#
+# Going row by row ('raster') sends the stage all the way back to column 1 at the end of
+# every row.  'serpentine' goes left to right on one row and right to left on the next.
+# 'shortest' starts from a nearest-neighbour tour and improves it with 2-opt, using the
+# time grbl takes for each move (every axis has its own max rate and acceleration) rather
+# than plain distance.  Sub-samples of one position are always visited together.
+# The order only changes when an image is taken, not what it is called.
+#
+# A PlatePlan works out the position and name of every sample on the plate in one go,
+# so RUN, GO TO and next/prev all read from the same table, and checks every position
+# (and the z-stack above and below it) is inside the stage's travel before anything moves.
+# RUN saves it in the run directory as plan.txt.
+
+import numpy as np
+from ami_hardware import grbl_max_rate, grbl_accel
+
+orders=('raster','serpentine','shortest')
+Ualphabet='ABCDEFGHIJKLMNOPQRSTUVWXYZ'; Lalphabet='abcdefghijklmnopqrstuvwxyz' # rows, and sub-samples
+
+def plate_order(plate): # (yrow,xcol,samp) row by row, the order RUN used to visit them
+    return [(yrow,xcol,samp) for yrow in range(plate.ny) for xcol in range(plate.nx) for samp in range(plate.samps)]
+
+def move_times(a,b,max_rate=grbl_max_rate,accel=grbl_accel): # grbl time from points a to points b (arrays of xyz)
+    d=np.abs(np.asarray(b,float)-np.asarray(a,float))
+    v=np.array(max_rate,float)/60.; acc=np.array(accel,float)
+    t=np.where(d>=v*v/acc,d/v+v/acc,2.*np.sqrt(d/acc))
+    return t.max(axis=-1)
+
+def positions(plate,order): # machine coordinates for a list of (yrow,xcol,samp)
+    plan=PlatePlan(plate)
+    return plan.xyz[[plan.index(*v) for v in order]]
+
+def travel_time(plate,order,**kw): # seconds spent moving between samples, starting from A1
+    p=positions(plate,[(0,0,0)]+list(order))
+    return float(move_times(p[:-1],p[1:],**kw).sum())
+
+def serpentine(plate):
+    order=[]
+    for yrow in range(plate.ny):
+        cols=range(plate.nx) if yrow%2==0 else range(plate.nx-1,-1,-1)
+        samps=range(plate.samps) if yrow%2==0 else range(plate.samps-1,-1,-1)
+        order+=[(yrow,xcol,samp) for xcol in cols for samp in samps]
+    return order
+
+def shortest(plate,max_rate=grbl_max_rate,accel=grbl_accel,passes=20):
+    # tour of the positions (sub-samples stay together), nearest neighbour then 2-opt
+    wells=[(yrow,xcol) for yrow in range(plate.ny) for xcol in range(plate.nx)]
+    p=positions(plate,[(yrow,xcol,0) for yrow,xcol in wells])
+    cost=move_times(p[:,None,:],p[None,:,:],max_rate,accel)
+    n=len(wells)
+    tour=[0]; left=set(range(1,n))
+    while left:
+        last=tour[-1]
+        nxt=min(left,key=lambda j:cost[last,j])
+        tour.append(nxt); left.remove(nxt)
+    tour=np.array(tour)
+    cost=np.pad(cost,((0,1),(0,1))) # node n is "nowhere", so the open end of the tour costs nothing
+    for _ in range(passes): # reverse tour[i:j+1] whenever that makes the tour quicker
+        improved=False
+        for i in range(1,n-1):
+            a,b=tour[i-1],tour[i]
+            c=tour[i:]; d=np.append(tour[i+1:],n)
+            gain=cost[a,b]+cost[c,d]-cost[a,c]-cost[b,d]
+            k=int(np.argmax(gain))
+            if gain[k]>1e-9:
+                tour[i:i+k+1]=tour[i:i+k+1][::-1].copy()
+                improved=True
+        if not improved: break
+    order=[]
+    for w in tour:
+        yrow,xcol=wells[w]
+        order+=[(yrow,xcol,samp) for samp in range(plate.samps)]
+    return order
+
+def plan_order(plate,how='serpentine',**kw): # list of (yrow,xcol,samp) for RUN
+    if how=='raster': return plate_order(plate)
+    if how=='serpentine': return serpentine(plate)
+    if how=='shortest': return shortest(plate,**kw)
+    raise ValueError('unknown order '+str(how)+', use one of '+', '.join(orders))
+
+def report(plate,order,**kw): # estimated travel time compared to going row by row
+    t0=travel_time(plate,plate_order(plate),**kw)
+    t1=travel_time(plate,order,**kw)
+    return 'estimated travel between samples %.1f s (row by row %.1f s), saves %.1f s'%(t1,t0,t0-t1)
+
+class PlatePlan: # every sample on a plate: where it is, what it is called and when RUN gets to it
+    def __init__(self,plate,how=None,order=None):
+        # how (or an explicit order of (yrow,xcol,samp)) sets the RUN order; row by row otherwise
+        self.plate=plate
+        n=plate.nx*plate.ny*plate.samps
+        yrow,xcol,samp=np.unravel_index(np.arange(n),(plate.ny,plate.nx,plate.samps)) # row by row, like next
+        self.where=np.stack([yrow,xcol,samp],axis=1)
+        sc=np.array(plate.samp_coord[:plate.samps],float).reshape(-1,2)
+        u=(xcol/float(plate.nx-1)+sc[samp,0])[:,None]
+        v=(yrow/float(plate.ny-1)+sc[samp,1])[:,None]
+        self.xyz=plate.br*u*v+plate.bl*(1.-u)*v+plate.tr*u*(1.-v)+plate.tl*(1.-u)*(1.-v)
+        if plate.focusmap: self.xyz[:,2]+=plate.focusmap.dz(u[:,0],v[:,0])
+        sub=Lalphabet if plate.samps>1 else ['']*plate.samps
+        self.names=[plate.alphabet[y]+str(x+1)+sub[s] for y,x,s in self.where]
+        self.lookup=self._lookup()
+        if order is None and how: order=plan_order(plate,how)
+        self.run=[self.index(*w) for w in order] if order is not None else list(range(n))
+
+    def _lookup(self): # every way GO TO accepts a sample: B7, b7, 19, with or without a sub-sample letter
+        p=self.plate; table={}
+        for i,(y,x,s) in enumerate(self.where):
+            for well in (Ualphabet[y],Lalphabet[y]):
+                for pos in (well+str(x+1),str(y*p.nx+x+1)):
+                    if s==0: table[pos]=i
+                    if p.samps>1: table[pos+Ualphabet[s]]=i; table[pos+Lalphabet[s]]=i
+        return table
+
+    def index(self,yrow,xcol,samp): # row in the table
+        return (yrow*self.plate.nx+xcol)*self.plate.samps+samp
+
+    def find(self,text): # row in the table for what was typed into the position box, or None
+        return self.lookup.get(text.replace(' ','').strip())
+
+    def __len__(self): return len(self.names)
+
+    def check(self,xmax,ymax,zmax,below=0.,above=0.): # names of samples the stage cannot reach
+        # below and above: how far the z-stack reaches under and over each sample's z
+        lo=np.array([0.,0.,-below]); hi=np.array([xmax,ymax,zmax-above])
+        bad=((self.xyz[:,:2]<=lo[:2])|(self.xyz[:,:2]>=hi[:2])).any(axis=1)|(self.xyz[:,2]-below<=0.)|(self.xyz[:,2]+above>=zmax)
+        return [self.names[i] for i in np.flatnonzero(bad)]
+
+    def save(self,path): # text table in RUN order
+        with open(path,'w') as f:
+            f.write('# plate %s %s: %d x %d, %d sample(s) per position\n'%(self.plate.sID,self.plate.nroot,self.plate.nx,self.plate.ny,self.plate.samps))
+            f.write('# name  yrow xcol samp        x        y        z\n')
+            for i in self.run:
+                y,x,s=self.where[i]
+                f.write('%-6s %4d %4d %4d %9.3f %9.3f %9.3f\n'%((self.names[i],y,x,s)+tuple(self.xyz[i])))
+
+    @classmethod
+    def load(cls,plate,path,how=None): # a saved plan; its positions and order replace the ones worked out from plate
+        # if it does not fit plate (its shape or names have changed since), a new plan in how's order instead
+        plan=cls(plate)
+        rows=[]
+        with open(path) as f:
+            for line in f:
+                if line.startswith('#') or not line.strip(): continue
+                w=line.split()
+                rows.append((w[0],int(w[1]),int(w[2]),int(w[3]),[float(c) for c in w[4:7]]))
+        where=[(y,x,s) for name,y,x,s,xyz in rows]
+        if len(set(where))!=len(rows) or not all(0<=y<plate.ny and 0<=x<plate.nx and 0<=s<plate.samps and
+                                                 plan.names[plan.index(y,x,s)]==name for name,y,x,s,xyz in rows):
+            print(path+' does not fit the plate as it is now: starting a new plan')
+            return cls(plate,how)
+        for name,y,x,s,xyz in rows: plan.xyz[plan.index(y,x,s)]=xyz
+        plan.run=[plan.index(*w) for w in where]
+        return plan
+
+    def order(self): # RUN order as (yrow,xcol,samp)
+        return [tuple(int(c) for c in self.where[i]) for i in self.run]
@@ -0,0 +1,222 @@
+# batch reprocessing: fuse past runs again, but only what has changed
+#
+# Sourcing a run's process<plate>.com aligns and fuses every sample again, one after the
+# other, however few of them changed.  This goes through any number of run directories
+# (a run, a plate, a sample, or the whole images directory) and works out what to do:
+#
+#  - each sample's key is a sha256 of its slices' contents, in z order, and of the
+#    fusion settings (align, window and ami_stack.version).  fused.json in the run
+#    directory keeps the key its <sample>.tif was made from; a sample whose key is the
+#    same is left alone.  The hash of each slice is kept there too, with its size and
+#    modification time, so months of runs are only read through once
+#  - a <sample>.tif that RUN fused (no key yet, newer than its slices, default settings)
+#    is taken as it is and its key written down
+#  - an unchanged sample's <sample>.tif is a link to an older run's (see ami_change):
+#    it is not fused, but the run's overview waits for the one it points to
+#  - each run's overview.jpg is made again after its samples are fused, when any of the
+#    images in it have changed
+#
+# The jobs that are left go to a process pool with one process per core (at low
+# priority, like RUN's FusionPool) in the order their dependencies allow.  Each result
+# is written whole and renamed, and fused.json is brought up to date after every job, so
+# stopping it part way loses nothing.
+#
+#   python ami_reprocess.py images/AMi_sample                # every run of every plate of it
+#   python ami_reprocess.py -n images                        # only say what would be done
+#   python ami_reprocess.py -w 7 images/AMi_sample/AB_xs2    # fused again with a 7 x 7 window
+
+import hashlib, json, os, sys, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ami_stack
+
+manifest='fused.json'
+
+def run_dirs(paths): # run directories in or under paths, in order
+    runs=[]
+    for top in paths:
+        for d,dirs,files in os.walk(top):
+            if 'rawimages' in dirs or any(f.startswith('process') and f.endswith('.com') for f in files):
+                runs.append(d)
+                dirs[:]=[]
+            else: dirs[:]=sorted(x for x in dirs if x not in ('probes','snaps'))
+    return runs
+
+def file_hash(path):
+    h=hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b''): h.update(block)
+    return h.hexdigest()
+
+def key(parts): # sha256 of a list of strings
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+def read_manifest(imgpath):
+    try:
+        with open(imgpath+'/'+manifest) as f: m=json.load(f)
+    except (OSError,ValueError): m={}
+    m.setdefault('files',{}); m.setdefault('samples',{})
+    return m
+
+def write_manifest(imgpath,m):
+    tmp=imgpath+'/'+manifest+'.part'
+    with open(tmp,'w') as f: json.dump(m,f,indent=1,sort_keys=True)
+    os.replace(tmp,imgpath+'/'+manifest)
+
+def make_overview(imgpath,conf): # for the pool
+    import ami_run, ami_overview
+    ami_overview.overview_run(imgpath,ami_run.read_config(conf))
+    return imgpath+'/overview.jpg'
+
+class Job:
+    def __init__(self,name,fn,args,after=(),done=None):
+        self.name=name; self.fn=fn; self.args=args
+        self.after=set(after) # names of the jobs that have to finish first
+        self.done=done # called here, not in the pool, when it has worked
+
+class JobGraph: # jobs that run in a process pool once the jobs they depend on have worked
+    def __init__(self):
+        self.jobs={}
+
+    def add(self,job):
+        self.jobs[job.name]=job
+        return job
+
+    def run(self,workers=None,report=print): # -> (names that worked, failed, were not run because something they need failed)
+        workers=workers or os.cpu_count() or 1
+        ok=set(); failed=set(); skipped=set()
+        todo=dict(self.jobs); running={}
+        for j in todo.values(): j.after&=set(self.jobs) # anything else is already done
+        with ProcessPoolExecutor(workers,initializer=ami_stack._lower_priority) as pool:
+            while todo or running:
+                for name,j in list(todo.items()):
+                    if j.after&(failed|skipped):
+                        skipped.add(name); del todo[name]
+                    elif j.after<=ok and len(running)<workers:
+                        running[pool.submit(j.fn,*j.args)]=j; del todo[name]
+                if not running: break # only jobs waiting on each other are left
+                finished,_=wait(running,return_when=FIRST_COMPLETED)
+                for f in finished:
+                    j=running.pop(f)
+                    if f.exception():
+                        failed.add(j.name)
+                        report(j.name+' failed: '+str(f.exception()))
+                    else:
+                        ok.add(j.name)
+                        if j.done: j.done()
+                        report('%s (%d of %d)'%(j.name,len(ok)+len(failed),len(self.jobs)))
+        skipped|=set(todo)
+        return ok,failed,skipped
+
+class Batch: # what to do to bring a set of run directories up to date
+    def __init__(self,runs,align=True,window=5,force=False,workers=None):
+        self.runs=runs; self.align=align; self.window=window; self.force=force
+        self.workers=workers or os.cpu_count() or 1
+        self.settings=['ami_stack',ami_stack.version,'align' if align else 'no align',window]
+        self.manifests={}; self.keys={} # run -> its fused.json; out path -> key of what it is (or will be) made from
+        self.graph=JobGraph()
+        self.counts=dict(runs=len(runs),samples=0,current=0,adopted=0,linked=0,fuse=0,overview=0)
+        t=time.time()
+        stacks=dict((r,ami_stack.find_stacks(r)) for r in runs)
+        self.hash_files(stacks)
+        for r in runs: self.plan_samples(r,stacks[r])
+        for r in runs: self.plan_overview(r,stacks[r])
+        self.planned=time.time()-t
+
+    def hash_files(self,stacks): # file hashes into the manifests, only reading files that are new or have changed
+        todo=[]
+        for r,samples in stacks.items():
+            m=self.manifests[r]=read_manifest(r)
+            for paths in samples.values():
+                for p in paths:
+                    rel=os.path.relpath(p,r); st=os.stat(p)
+                    old=m['files'].get(rel)
+                    if not old or old[:2]!=[st.st_size,st.st_mtime_ns]: todo.append((r,rel,p,st))
+        with ThreadPoolExecutor(self.workers) as ex: # hashlib lets go of the GIL
+            for (r,rel,p,st),h in zip(todo,ex.map(lambda t: file_hash(t[2]),todo)):
+                self.manifests[r]['files'][rel]=[st.st_size,st.st_mtime_ns,h]
+        self.counts['hashed']=len(todo)
+
+    def plan_samples(self,r,samples):
+        m=self.manifests[r]
+        for name,paths in sorted(samples.items()):
+            out=r+'/'+name+'.tif'
+            self.counts['samples']+=1
+            if os.path.islink(out): # unchanged since an older run: its key is the one of what it points to
+                self.counts['linked']+=1
+                continue
+            k=key(self.settings+[m['files'][os.path.relpath(p,r)][2] for p in paths])
+            self.keys[out]=k
+            if not self.force and os.path.exists(out):
+                if m['samples'].get(name)==k:
+                    self.counts['current']+=1
+                    continue
+                if name not in m['samples'] and self.align and self.window==5 and \
+                   os.path.getmtime(out)>=max(os.path.getmtime(p) for p in paths): # fused by RUN
+                    m['samples'][name]=k
+                    self.counts['adopted']+=1
+                    continue
+            self.counts['fuse']+=1
+            self.graph.add(Job(out,ami_stack.fuse_file,(paths,out,self.align,self.window),
+                               done=lambda r=r,name=name,k=k: self.fused(r,name,k)))
+
+    def fused(self,r,name,k):
+        self.manifests[r]['samples'][name]=k
+        write_manifest(r,self.manifests[r])
+
+    def link_target(self,out): # the fused image a link points to, and its key if known
+        target=os.path.normpath(os.path.join(os.path.dirname(out),os.readlink(out)))
+        if target in self.keys: return target,self.keys[target]
+        d,f=os.path.split(target)
+        return target,read_manifest(d)['samples'].get(f[:-4],'link '+target)
+
+    def plan_overview(self,r,samples):
+        confs=sorted(f for f in os.listdir(r) if f.endswith('.config')) # RUN copies it into the run directory
+        if not confs: return
+        parts=[]; after=[]
+        for name in sorted(samples):
+            out=r+'/'+name+'.tif'
+            if os.path.islink(out): out,k=self.link_target(out)
+            else: k=self.keys[out]
+            parts.append(name+' '+k); after.append(out)
+        k=key(parts)
+        after=[a for a in after if a in self.graph.jobs] # the others are already done
+        m=self.manifests[r]
+        if not self.force and m.get('overview')==k and os.path.exists(r+'/overview.jpg'): return
+        self.counts['overview']+=1
+        def done(): m['overview']=k; write_manifest(r,m)
+        self.graph.add(Job(r+'/overview.jpg',make_overview,(r,r+'/'+confs[0]),after,done))
+
+    def summary(self):
+        c=self.counts
+        return ('%(runs)d runs, %(samples)d samples: %(current)d up to date, %(adopted)d fused by RUN, %(linked)d links '
+                'to older runs, %(fuse)d to fuse, %(overview)d overviews to make (%(hashed)d files read)'%c)
+
+    def run(self):
+        t=time.time()
+        for r in self.runs: write_manifest(r,self.manifests[r]) # hashes and adopted keys, before anything is fused
+        ok,failed,skipped=self.graph.run(self.workers)
+        print('%d jobs done, %d failed, %d not done because of them in %.1f s on %d processes'%(
+            len(ok),len(failed),len(skipped),time.time()-t,self.workers))
+        return ok,failed,skipped
+
+if __name__=='__main__':
+    import argparse
+    p=argparse.ArgumentParser(description='fuse past runs again, only where something has changed')
+    p.add_argument('dirs',nargs='+',help='run directories, or directories with runs in them (images, a sample, a plate)')
+    p.add_argument('-n','--dry-run',action='store_true',help='only say what would be done')
+    p.add_argument('-f','--force',action='store_true',help='fuse everything again whether it has changed or not')
+    p.add_argument('-w','--window',type=int,default=5,help='contrast window of the fusion in pixels (default 5)')
+    p.add_argument('--no-align',action='store_true',help='do not line the slices up with each other')
+    p.add_argument('-j','--jobs',type=int,help='processes to use (default one per core)')
+    args=p.parse_args()
+    runs=run_dirs(args.dirs)
+    if not runs:
+        print('no run directories in '+' '.join(args.dirs))
+        sys.exit(1)
+    b=Batch(runs,not args.no_align,args.window,args.force,args.jobs)
+    print(b.summary()+', worked out in %.1f s'%b.planned)
+    if args.dry_run:
+        for name,j in b.graph.jobs.items(): print('would make '+name+(' after %d others'%len(j.after) if j.after else ''))
+    else:
+        ok,failed,skipped=b.run()
+        sys.exit(1 if failed or skipped else 0)
@@ -0,0 +1,520 @@
+# plate imaging without the GUI
+#
+# These are the pieces of AMiGUI that move the stage and take pictures.  They work on
+# a Hardware object from ami_hardware (real or simulated) and a Plate holding what is
+# in the configuration file.  The GUI calls them with the real hardware, and ami_bench
+# calls them with the simulator to time a whole plate.
+
+import numpy as np
+import collections, re, os, threading, time
+from datetime import datetime
+from shutil import copyfile
+from ami_capture import CapturePipeline
+import ami_focus, ami_plan, ami_journal, ami_timing, ami_stackfile, ami_overview, ami_change, ami_settle, ami_grbl, ami_metrics
+
+from ami_plan import Ualphabet, Lalphabet, plate_order # here too, for the GUI
+preview_window=(0,-76,1597,1200)
+idle_method='edge' # how wait_for_Idle finds out grbl has stopped: 'edge' (interrupt from gpio 27),
+                   # 'status' (ask grbl with '?') or 'poll' (sleep 0.2 s, then check gpio 27 every 0.1 s)
+idle_timeout=120. # seconds wait_for_Idle waits before giving up
+
+class LatencyHistogram: # how long each wait_for_Idle took, and how much of it came after the stage had stopped
+    bins=(0.005,0.01,0.02,0.05,0.1,0.2,0.3,0.5,1.)
+    def __init__(self): self.reset()
+    def reset(self): self.waits=[]; self.dead=[]
+    def add(self,wait,dead):
+        self.waits.append(wait); self.dead.append(dead)
+    def report(self): # text histogram of the dead time
+        if not self.dead: return 'no moves'
+        d=np.array(self.dead)
+        counts=np.histogram(d,[0.]+list(self.bins)+[np.inf])[0]
+        lines=['dead time after %d moves: mean %.0f ms, median %.0f ms, max %.0f ms, total %.1f s (waiting in total %.1f s)'%(
+               len(d),1e3*d.mean(),1e3*np.median(d),1e3*d.max(),d.sum(),sum(self.waits))]
+        lo=0.
+        for hi,n in zip(list(self.bins)+[np.inf],counts):
+            label='%4.0f-%4.0f ms'%(1e3*lo,1e3*hi) if hi<np.inf else '  >%4.0f ms  '%(1e3*lo)
+            lines.append('  '+label+' %5d '%n+'#'*int(round(50.*n/len(d))))
+            lo=hi
+        return '\n'.join(lines)
+
+idle_latency=LatencyHistogram()
+timings=ami_timing.Timings() # what each stage of the last run took
+
+class Plate: # everything in the configuration file
+    def __init__(self,nx=12,ny=8,samps=1,tl=(134.2,29.3,7.5),tr=(35.2,28.7,7.3),bl=(133.5,92.9,7.1),br=(35.0,91.9,7.0),
+                 samp_coord=None,zstep=0.3,nimages=4,sID='AMi_sample',nroot='AB_xs2',focusmap=None):
+        self.nx=nx; self.ny=ny; self.samps=samps
+        self.tl=np.array(tl,float); self.tr=np.array(tr,float); self.bl=np.array(bl,float); self.br=np.array(br,float)
+        self.samp_coord=[list(c) for c in samp_coord] if samp_coord else [[0.,0.]]
+        while len(self.samp_coord)<samps: self.samp_coord.append([0.,0.])
+        self.zstep=zstep; self.nimages=nimages
+        self.sID=sID; self.nroot=nroot
+        self.alphabet=Ualphabet[0:ny]+Lalphabet[0:ny]
+        self.focusmap=focusmap # ami_focusmap.FocusMap correcting the corners' z, or None
+
+def read_config(fname): # read a configuration file; raises an exception if the format is wrong
+    with open(fname,'r') as f:
+        jnk=list(map(int,(re.findall(r'\S+', (f.readline()).split('#', 1)[0]))))
+        nx=jnk[0]; ny=jnk[1]; samps=jnk[2]
+        tl=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
+        tr=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
+        bl=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
+        br=np.array(list(map(float,(re.findall(r'\S+', (f.readline()).split('#', 1)[0])))))
+        samp_coord=[]
+        for i in range(samps):
+            samp_coord.append(list(map(float,(re.findall(r'\S+',f.readline().split('#', 1)[0])))))
+        zstep=float((f.readline()).split('#', 1)[0])
+        nimages=int((f.readline()).split('#', 1)[0])
+        sID=(f.readline()).split('#', 1)[0]
+        sID=sID.replace("\n",""); sID=sID.replace(" ","")
+        nroot=(f.readline()).split('#', 1)[0]
+        nroot=nroot.replace("\n",""); nroot=nroot.replace(" ","")
+    if len(tl)!=3 or len(tr)!=3 or len(bl)!=3 or len(br)!=3: raise ValueError('corner coordinates need x, y and z')
+    return Plate(nx,ny,samps,tl,tr,bl,br,samp_coord,zstep,nimages,sID,nroot)
+
+def tdate(): # get the current date as a nice string
+   dstr=(datetime.now().strftime('%h-%d-%Y_%I:%M%p'))
+   dstr=dstr.replace(" ","")
+   return dstr
+
+def well_name(plate,yrow,xcol,samp): # e.g. B7, or B7c when there are sub-samples
+    letnum=plate.alphabet[yrow]+str(xcol+1)
+    if plate.samps>1:letnum+=Lalphabet[samp]
+    return letnum
+
+def plate_xyz(plate,yrow,xcol,samp): # bilinear interpolation between the four corners (z corrected by the focus map)
+    x=xcol/float(plate.nx-1)+plate.samp_coord[samp][0]
+    y=yrow/float(plate.ny-1)+plate.samp_coord[samp][1]
+    tl,tr,bl,br=plate.tl,plate.tr,plate.bl,plate.br
+    mx=br[0]*x*y+bl[0]*(1.-x)*y+tr[0]*x*(1.-y)+tl[0]*(1.-x)*(1.-y)
+    my=br[1]*x*y+bl[1]*(1.-x)*y+tr[1]*x*(1.-y)+tl[1]*(1.-x)*(1.-y)
+    mz=br[2]*x*y+bl[2]*(1.-x)*y+tr[2]*x*(1.-y)+tl[2]*(1.-x)*(1.-y)
+    if plate.focusmap: mz+=float(plate.focusmap.dz(x,y))
+    return mx,my,mz
+
+def idle_edge(hw): # event set by the falling edge of gpio 27, i.e. when grbl gets to an m9
+    # count is the number of falling edges so far and times the clock times of the last few of them
+    if not hasattr(hw,'idle_edge'):
+        hw.idle_edge=threading.Event(); hw.idle_edge.when=None
+        hw.idle_edge.count=0; hw.idle_edge.times=collections.deque(maxlen=64)
+        def falling(pin):
+            hw.idle_edge.when=hw.clock.time()
+            hw.idle_edge.times.append(hw.idle_edge.when); hw.idle_edge.count+=1
+            hw.idle_edge.set()
+        hw.GPIO.add_event_detect(27,hw.GPIO.FALLING,callback=falling)
+    return hw.idle_edge
+
+def grbl_state(hw): # ask grbl what it is doing: 'Idle', 'Run', 'Alarm'...
+    return hw.grbl.status()['state']
+
+def wait_for_Idle(hw,method=None,timeout=None): # wait for grbl to complete movement
+   grbl,GPIO,clock=hw.grbl,hw.GPIO,hw.clock
+   method=method or idle_method; timeout=timeout or idle_timeout
+   t0=clock.time(); moving=t0 # last time we know the stage was still moving
+   deadline=t0+timeout
+   if method=='edge':
+      edge=idle_edge(hw)
+      edge.clear()
+      if getattr(hw,'coolant_resets',None)!=grbl.resets: # grbl turned coolant off when it was reset or went into alarm:
+         grbl.send('m8') # the pin has to be high again for the m9 to make an edge
+         hw.coolant_resets=grbl.resets
+      grbl.send('m9') # set pin A3 low once the stage stops
+      # every m9 follows an m8 (home() sends the first one), so it always makes a falling edge;
+      # the pin being low now only means grbl has not got to the last m8 yet
+      if not edge.wait(timeout/clock.speed): raise RuntimeError('grbl did not finish moving within '+str(timeout)+' s')
+      moving=edge.when
+      grbl.send('m8') # set pin A3 high
+   elif method=='status':
+      clock.sleep(0.02) # give grbl time to take in the line we just sent
+      while grbl_state(hw)!='Idle':
+         moving=clock.time()
+         if moving>deadline: raise RuntimeError('grbl did not finish moving within '+str(timeout)+' s')
+         clock.sleep(0.01)
+   else: # new version wait for pin A8 to go low
+      grbl.send('m9') # set pin A3 low
+      clock.sleep(0.2) #wait a little just in case
+      while GPIO.input(27):
+         moving=clock.time()
+         if moving>deadline: raise RuntimeError('grbl did not finish moving within '+str(timeout)+' s')
+         clock.sleep(0.1)
+      grbl.send('m8') # set pin A3 high
+   t1=clock.time()
+   idle_latency.add(t1-t0,t1-moving)
+   timings.add('wait',t1-t0)
+
+def home(hw): # wake grbl up, find zero and get ready to move; runs once at startup
+    grbl=hw.grbl
+    hw.status['grbl']='waking up'
+    grbl.wake() # Wake up grbl and wait for it to initialize
+    grbl.command('$21=1') # enable hard limits
+    print(' ok so far...')
+    hw.status['grbl']='homing'
+    grbl.command('$H',ami_grbl.homing_timeout) # tell grbl to find zero
+    wx,wy,wz=grbl.status()['wpos']
+    if wx==-199.0:
+      grbl.command('G10 L2 P1 X '+str(wx)+' Y '+str(wy)+' Z '+str(wz)) # ensures that zero is zero and not -199.0, -199.0, -199.0
+    grbl.send('m8') # set pin A3 high -used later to detect end of movement
+    grbl.command('$x') # unlock so spindle power can engage for light2
+    grbl.command('s1000') # set max spindle volocity
+
+def goto_well(hw,plate,yrow,xcol,samp): # moves to the position of a sample and waits for the stage to stop
+    print('called mcoords with yrow,xcol,samp:',yrow,xcol,samp)
+    return goto(hw,plate_xyz(plate,yrow,xcol,samp))
+
+def goto(hw,xyz): # moves to machine coordinates xyz and waits for the stage to stop
+    wait_for_Idle(hw)
+    mx,my,mz=(float(c) for c in xyz)
+    print('mx,my,mz',mx,my,mz)
+    t0=hw.clock.time()
+    reply=hw.grbl.send('G0 x '+str(mx)+' y '+str(my)+' z '+ str(mz)) # g-code to grbl
+    if idle_method=='poll': hw.clock.sleep(0.2)
+    reply.wait() # Wait for grbl response
+    timings.add('move',hw.clock.time()-t0)
+    wait_for_Idle(hw)
+    return mx,my,mz
+
+def settle_down(hw,settle,z=None,frames=True): # sleep settle seconds, or as long as an ami_settle.Settler says after a move to z
+    if isinstance(settle,(int,float)): hw.clock.sleep(settle)
+    else:
+        settle.moved(z=z)
+        settle.wait(hw,frames)
+
+def take_stack(hw,zs,paths,capture,settle=0.4,stop=None): # one z move, wait, settle and capture at a time
+    # returns how many images were taken, fewer than len(zs) if stop() came true part way
+    n=0
+    for z,path in zip(zs,paths):
+        if stop and stop(): break
+        t0=hw.clock.time()
+        hw.grbl.command('G0 z '+ str(z)) # move to z
+        timings.add('move',hw.clock.time()-t0)
+        wait_for_Idle(hw)
+        t0=hw.clock.time()
+        settle_down(hw,settle,z) #slow things down to allow camera to settle down
+        timings.add('settle',hw.clock.time()-t0)
+        capture(path)
+        n+=1
+    return n
+
+def burst_stack(hw,zs,frames,settle=0.4,stop=None,times=None):
+    # like take_stack, but the camera stays on the video port for the whole stack and each
+    # frame goes straight into frames[k] (preallocated, padded rgb), so a capture costs one
+    # frame interval instead of a switch to still mode and a jpeg encode.  Returns how many
+    # frames were taken; the time each was taken is added to times if given.
+    clock=hw.clock
+    n=[0]
+    def outputs(): # capture_sequence takes frame k as soon as this hands it frames[k]
+        for k,z in enumerate(zs):
+            if stop and stop(): return
+            t0=clock.time()
+            hw.grbl.command('G0 z '+ str(z)) # move to z
+            timings.add('move',clock.time()-t0)
+            wait_for_Idle(hw)
+            t0=clock.time()
+            settle_down(hw,settle,z,frames=False) # the video port is ours
+            timings.add('settle',clock.time()-t0)
+            t0=clock.time()
+            yield frames[k]
+            timings.add('capture',clock.time()-t0)
+            if times is not None: times.append(time.time())
+            n[0]+=1
+    hw.camera.capture_sequence(outputs(),format='rgb',use_video_port=True)
+    return n[0]
+
+def stream_stack(hw,zs,paths,capture,settle=0.4,window=0.5,timeout=30.,stop=None):
+    # sends the whole stack to grbl at once.  After each z move grbl dwells for settle seconds,
+    # sets pin A3 low (m9), which is our cue to take a picture, dwells for window seconds while
+    # we do, then sets it high again (m8) and carries on to the next z.  Lines are sent as room
+    # frees up in grbl's receive buffer (hw.grbl keeps count).  The falling edges are counted (see idle_edge),
+    # so one that comes and goes while the capture before is still going is not lost: that slice is
+    # taken late, with the stage already on its way.  Returns how long after its edge each capture was
+    # done; any longer than window may have been taken while the stage was moving.  Once stop() comes
+    # true no more slices are sent; the ones grbl already has are still taken.
+    grbl,GPIO,clock=hw.grbl,hw.GPIO,hw.clock
+    edge=idle_edge(hw)
+    n=len(zs)
+    lines=[]
+    for z in zs: lines+=['G0 z '+str(z),'G4 P%.3f'%settle,'m9','G4 P%.3f'%window,'m8']
+    if not GPIO.input(27): grbl.send('m8') # the first falling edge has to be ours
+    deadline=clock.time()+timeout
+    while not GPIO.input(27):
+        if clock.time()>deadline: raise RuntimeError('pin 27 never went high before streaming a z-stack')
+        clock.sleep(0.002)
+    clock.sleep(0.01) # any edge from before is counted by now
+    first=edge.count # the edge of slice k is the first+k-th
+    sent=[] # Commands of the lines sent so far
+    i=0; k=0; took=[]
+    deadline=clock.time()+timeout
+    while k<n or i<len(lines):
+        if n==len(zs) and i<len(lines) and stop and stop():
+            n=-(-i//5) # finish the slice being sent, so every m9 still gets its m8
+            lines=lines[:5*n]
+        while i<len(lines) and grbl.room()>=len(lines[i])+1:
+            sent.append(grbl.send(lines[i],timeout)); i+=1
+        for c in sent:
+            if c.error: raise c.error # an alarm or an error: the m9s will not come
+        if k<n and edge.count>first+k: # grbl has reached the m9 after slice k
+            behind=edge.count-first-k # 2 or more: the next slice's window has already begun
+            if behind>len(edge.times): raise RuntimeError('lost count of the slices while streaming a z-stack')
+            t0=edge.times[-behind]
+            capture(paths[k])
+            took.append(clock.time()-t0)
+            if behind>1: print('capture of '+paths[k]+' is late: the stage had moved on to the next slice before it began')
+            elif took[-1]>window: print('capture of '+paths[k]+' took longer than the '+str(window)+' s window')
+            k+=1
+            deadline=clock.time()+timeout
+        if clock.time()>deadline: raise RuntimeError('no word from grbl for '+str(timeout)+' s while streaming a z-stack')
+        clock.sleep(0.002)
+    for c in sent: c.wait()
+    return took
+
+def make_run_dir(sID,nroot,fname=None,images='images'): # images/<sID>/<nroot>/<date>/rawimages
+    imgpath=images+'/'+sID
+    if not os.path.isdir(imgpath):
+      os.mkdir(imgpath)
+      print('created directory: '+imgpath)
+    imgpath=images+'/'+sID+'/'+nroot
+    if not os.path.isdir(imgpath):
+      os.mkdir(imgpath)
+      print('created directory: '+imgpath)
+    imgpath+='/'+tdate()
+    if not os.path.isdir(imgpath):
+      os.mkdir(imgpath)
+      print('created directory: '+imgpath)
+    if not os.path.isdir(imgpath+'/rawimages'):
+      os.mkdir(imgpath+'/rawimages')
+      print('created directory: '+imgpath+'/rawimages')
+      if fname: copyfile(fname,(imgpath+'/'+os.path.basename(fname)))
+    return imgpath
+
+class OutOfBounds(ValueError): # some samples of the plate are where the stage cannot go
+    def __init__(self,names):
+        ValueError.__init__(self,'%d samples would be out of bounds, e.g. %s'%(len(names),names[0]))
+        self.names=names
+
+def prepare_run(plate,order='raster',fname=None,resume_within=6.,limits=(160.,118.,29.3),fracbelow=0.5,images='images'):
+    # (run directory, plan, resumed) for RUN: the plate's run left unfinished less than resume_within hours ago
+    # (0: never) with its own plan, or a new directory with a new plan in order; raises OutOfBounds before
+    # anything is made if the stage cannot reach every sample
+    resume=ami_journal.unfinished(images+'/'+plate.sID+'/'+plate.nroot,resume_within) if resume_within else None
+    if resume: plan=ami_plan.PlatePlan.load(plate,resume+'/plan.txt',order) # same positions and order as before
+    else: plan=ami_plan.PlatePlan(plate,order)
+    zrange=(plate.nimages-1)*plate.zstep
+    bad=plan.check(limits[0],limits[1],limits[2],(1-fracbelow)*zrange,fracbelow*zrange) # look before anything moves
+    if bad:
+        print('out of bounds: '+' '.join(bad))
+        raise OutOfBounds(bad)
+    if resume:
+        print('carrying on the unfinished run in '+resume)
+        return resume,plan,True
+    imgpath=make_run_dir(plate.sID,plate.nroot,fname,images)
+    plan.save(imgpath+'/plan.txt')
+    print(ami_plan.report(plate,plan.order()))
+    return imgpath,plan,False
+
+def tidy(what,step): # one step of the clean-up after a run: False if it failed
+    try: step(); return True
+    except Exception as e:
+        print(what+' failed: '+str(e))
+        return False
+
+def run_plate(hw,plate,imgpath,show=None,stop=None,preview=True,camera_delay=.2,fracbelow=0.5,disable_hard_limits=True,plan=None,
+              pipelined=False,streamed=False,capture_window=0.5,fusion=None,autofocus_images=0,autofocus_steps=7,resume=False,
+              progress=None,metrics_file=None,burst=False,keep_raw=False,stack_files=False,overview=True,
+              changes=False,previous=None,change_threshold=0.25,unchanged_images=1,settle_mode='fixed',settle_min=0.05,
+              settle_per_mm=0.005,settle_cap=1.0,quality_index=None):
+    # images every sample on the plate into imgpath/rawimages and writes the process<plate>.com script
+    # plan is the ami_plan.PlatePlan with the positions and order to visit them, row by row if not given
+    # pipelined saves the images in the background while the stage moves on (see ami_capture)
+    # streamed sends each z-stack to grbl in one go (see stream_stack); with capture_window=None
+    # the window grbl holds still for is fitted to the slowest capture so far
+    # fusion is an ami_stack.FusionPool; each sample is handed to it once its images are written
+    # autofocus_images>0 sweeps the z range with small video frames first and takes only that many
+    # full-size images around the sharpest z (see ami_focus); results go to imgpath/autofocus.log
+    # resume carries on the unfinished run in imgpath: samples its journal has as done are skipped, the
+    # plan comes from its plan.txt and the process file is added to (see ami_journal)
+    # show(yrow,xcol,samp,mx,my,mz) is called after each move to a sample, progress(name,done,total,seconds,eta)
+    # after each sample is taken; stop() is checked before every move, so RUN stops within one
+    # (a stopped sample's images are taken again when the run is resumed)
+    # burst captures each z-stack from the video port into memory and has it encoded afterwards (see
+    # burst_stack); keep_raw also saves it as rawimages/<sample>.npy
+    # stack_files (which implies burst) writes each sample as one rawimages/<sample>.amis instead of
+    # jpegs (see ami_stackfile); the process file exports the jpegs before aligning them
+    # overview keeps imgpath/overview.jpg, the whole plate in one picture, up to date as samples are
+    # finished and fused (see ami_overview)
+    # changes probes each sample first and compares it with the last run of the plate (previous, or found
+    # by ami_change.previous_run); samples that look the same get only unchanged_images slices, are not
+    # fused, and their <sample>.tif links to the last run's (see ami_change)
+    # settle_mode other than 'fixed' decides each settle time from frames or the distance moved instead of
+    # always waiting camera_delay, at most settle_cap seconds; each one is logged to imgpath/settle.log (see ami_settle)
+    # quality_index is an SQLite file each sample's sharpness, best focus, brightness and edge score are added to
+    # once its images are on disk, on a thread of its own (see ami_metrics)
+    # every stage is timed into imgpath/timings.txt and summed up in imgpath/metrics.prom (see ami_timing),
+    # and in metrics_file too if given, e.g. in the node exporter's textfile collector directory
+    camera,GPIO,clock=hw.camera,hw.GPIO,hw.clock
+    t0=clock.time()
+    nwells=0; nimg=0; stopped=False; hidden=0.; late=0; slowest=0.
+    focus={} # (yrow,xcol,samp) -> z autofocus found sharpest
+    focuslog=ami_focus.FocusLog(imgpath+'/autofocus.log',append=resume) if autofocus_images else None
+    journal=ami_journal.RunJournal(imgpath,resume)
+    ov=ami_overview.Overview(plate,imgpath+'/overview.jpg') if overview else None
+    if ov and fusion: fusion.on_fused(ov.add_fused)
+    probes=ami_change.Changes(imgpath,previous or ami_change.previous_run(imgpath),change_threshold,append=resume) if changes else None
+    quality=ami_metrics.Indexer(quality_index,imgpath) if quality_index else None
+    done=set(journal.done)
+    if resume and not plan and os.path.exists(imgpath+'/plan.txt'): plan=ami_plan.PlatePlan.load(plate,imgpath+'/plan.txt')
+    idle_latency.reset(); hw.grbl.reset_stats()
+    settle=camera_delay+(0.2 if idle_method=='poll' else 0.) # the extra 0.2 s covered for the polling
+    settler=ami_settle.Settler(settle_mode,settle,settle_min,settle_per_mm,settle_cap,log=imgpath+'/settle.log',append=resume) if settle_mode!='fixed' else None
+    timings.start(clock,imgpath+'/timings.txt')
+    burst=burst or stack_files
+    pipe=CapturePipeline(camera,clock,timings=timings) if pipelined or burst else None
+    capture=pipe.capture if pipe else camera.capture
+    plan=plan or ami_plan.PlatePlan(plate)
+    processf=None; limits_off=False; complete=False
+    try:
+        goto(hw,plan.xyz[0]) #go to A1
+        if preview:
+            camera.start_preview(fullscreen=False,window=preview_window)
+            clock.sleep(2) # let camera adapt to the light before collecting images
+        processf=open(imgpath+'/process'+plate.nroot+'.com','a' if resume else 'w')
+        if not resume: processf.write('rm OUT*.tif \n')
+        if fusion: # samples a stopped run finished but did not get round to fusing
+            for name in journal.done:
+                if not os.path.lexists(imgpath+'/'+name+'.tif'): # an unchanged sample's is a link
+                    slices=list(dict.fromkeys(journal.slices.get(name,[]))) # a stack file is there once for each slice
+                    fusion.submit(name,[imgpath+'/'+p for p in slices],imgpath+'/'+name+'.tif')
+        journal.start(resume)
+        zrange=(plate.nimages-1)*plate.zstep
+        if disable_hard_limits:
+          hw.grbl.command('$21=0') #turn off hard limits
+          limits_off=True
+          print('hard limits disabled')
+        todo=[i for i in plan.run if plan.names[i] not in done]
+        for i in todo:
+           if stop and stop():
+               stopped=True
+               break
+           twell=clock.time()
+           timings.sample=plan.names[i]
+           yrow,xcol,samp=(int(c) for c in plan.where[i])
+           print('called mcoords with yrow,xcol,samp:',yrow,xcol,samp)
+           mx,my,mz=goto(hw,plan.xyz[i]) # go to the expected position of the focussed sample
+           if show: show(yrow,xcol,samp,mx,my,mz)
+           if settler: settler.moved(mx,my,mz); settler.sample=plan.names[i]
+           z=mz-(1-fracbelow)*zrange # bottom of the zrange (this is the top of the sample!)
+           samp_name=plan.names[i]
+           nimages=plate.nimages
+           same=False
+           if probes:
+               tprobe=clock.time()
+               settle_down(hw,settler or settle,mz) # a frame still ringing from the move would look changed
+               timings.add('settle',clock.time()-tprobe)
+               tprobe=clock.time()
+               same=probes.check(samp_name,ami_focus.grab(camera))
+               timings.add('probe',clock.time()-tprobe)
+               if same: # a few slices around the focus, for the record
+                   nimages=min(unchanged_images,plate.nimages)
+                   z=mz-(nimages-1)*plate.zstep/2.
+           if focuslog and not same:
+               tsweep=clock.time()
+               zbest,scores=ami_focus.autofocus(hw,z,z+zrange,autofocus_steps,settle=settler or settle)
+               tsweep=clock.time()-tsweep
+               timings.add('autofocus',tsweep)
+               if zbest is not None:
+                   focus[(yrow,xcol,samp)]=zbest
+                   nimages=min(autofocus_images,plate.nimages)
+                   z=zbest-(nimages-1)*plate.zstep/2.
+           journal.well(samp_name)
+           def logged(path,name=samp_name): # capture, then note it in the journal
+               tcap=clock.time()
+               capture(path)
+               timings.add('capture',clock.time()-tcap,0 if pipe else os.path.getsize(path)) # without pipe the capture wrote it
+               journal.slice(name,path[len(imgpath)+1:])
+           processf.write('echo \'processing: '+samp_name+'\' \n')
+           line='align_image_stack -m -a OUT '
+           tstack=clock.time()
+           zs=[z+imgnum*plate.zstep for imgnum in range(nimages)]
+           names=['rawimages/'+samp_name+'_'+str(imgnum)+'.jpg' for imgnum in range(nimages)]
+           paths=[imgpath+'/'+n for n in names]
+           if burst:
+               frames=pipe.stack_buffer(len(zs)); times=[]
+               taken=burst_stack(hw,zs,frames,settler or settle,stop=stop,times=times)
+               if stack_files: paths=[imgpath+'/rawimages/'+samp_name+'.amis'] # what the journal and fusion get
+               for k in range(taken): journal.slice(samp_name,paths[min(k,len(paths)-1)][len(imgpath)+1:])
+               if taken<len(zs): pipe.stacks.put(frames)
+               elif stack_files:
+                   processf.write('python3 '+os.path.abspath(ami_stackfile.__file__)+' export rawimages/'+samp_name+'.amis \n')
+                   meta={'sample':samp_name,'sID':plate.sID,'nroot':plate.nroot,'z':zs,'xyz':[mx,my,mz],'times':times,'zstep':plate.zstep}
+                   def store(frames=frames,path=paths[0],meta=meta): # on the saving thread, in turn with everything else
+                       t=clock.time(); w,h=camera.resolution
+                       try: size=ami_stackfile.write_stack(path,frames[:len(meta['z']),:h,:w],meta)
+                       finally: pipe.stacks.put(frames)
+                       timings.add('write',clock.time()-t,size,meta['sample'])
+                   pipe.after(store)
+               else: pipe.save_stack(paths,frames,imgpath+'/rawimages/'+samp_name+'.npy' if keep_raw else None)
+           elif streamed:
+               window=capture_window or (1.1*slowest+0.02 if slowest else 0.5)
+               took=stream_stack(hw,zs,paths,logged,settler.guess(plate.zstep) if settler else settle,window,stop=stop) # grbl dwells: no frames to watch
+               late+=sum(t>window for t in took)
+               slowest=max([slowest]+took)
+               taken=len(took)
+           else: taken=take_stack(hw,zs,paths,logged,settler or settle,stop=stop)
+           nimg+=taken
+           if taken<len(zs): # stopped part way through the stack
+               stopped=True
+               break
+           if focuslog and not same:
+               saved,secs=focuslog.add(samp_name,focus.get((yrow,xcol,samp)),len(zs),plate.nimages,tsweep,(clock.time()-tstack)/len(zs))
+               print('%s: autofocus saved %d images, %.1f s'%(samp_name,saved,secs))
+           if same: processf.write('ln -sf '+probes.target(samp_name)+' '+samp_name+'.tif \n') # unchanged since last time
+           else:
+               line+=' '.join(names)+' '
+               line+=(' \n')
+               processf.write(line)
+               processf.write('enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask --output='+samp_name+'.tif OUT*.tif \n')
+               processf.write('rm OUT*.tif \n')
+           def finished(name=samp_name,paths=paths,zs=zs,same=same): # once the images are on disk
+               journal.finished(name,len(zs))
+               if ov: ov.add(name,paths)
+               if quality: quality.add(name,paths,zs,same)
+               if same: probes.link(name)
+               elif fusion: fusion.submit(name,paths,imgpath+'/'+name+'.tif')
+           if pipe: pipe.after(finished)
+           else: finished()
+           nwells+=1
+           if pipe:
+               h=pipe.well_done()
+               print('%s: %.2f s of %.2f s saving images in the background'%(samp_name,h,clock.time()-twell))
+           timings.add('sample',clock.time()-twell)
+           if progress:
+               per=(clock.time()-t0)/nwells
+               progress(samp_name,nwells+len(done),len(plan.run),clock.time()-twell,per*(len(todo)-nwells))
+        complete=not stopped
+    finally: # however the run ends, the lights, the hard limits and the files are seen to
+        cleaned=all([ # each step is tried whether the ones before worked or not
+            tidy('closing the process file',lambda: processf and processf.close()),
+            tidy('saving the images',lambda: pipe and (pipe.flush(),pipe.close())),
+            tidy('closing the journal',lambda: (journal.end() if complete else journal.note('stopped'),journal.close())),
+            tidy('the overview',lambda: ov and ov.wait()), # the slices are all in; fused images carry on arriving while the pool works
+            tidy('the image metrics',lambda: quality and quality.close()),
+            tidy('turning off the preview',camera.stop_preview), # so the monitor can go black when the pi sleeps
+            tidy('turning off light1',lambda: GPIO.output(17, GPIO.LOW)),
+            tidy('turning off light2',lambda: GPIO.output(18, GPIO.LOW)),
+            tidy('turning off the spindle power',lambda: hw.grbl.send('m5')), # light 2
+            tidy('turning hard limits back on',lambda: limits_off and (hw.grbl.command('$21=1'),print('hard limits enabled'))),
+            tidy('the timings',timings.finish)])
+    if pipe: hidden=pipe.hidden+pipe.well_done()
+    if quality: print('image metrics of %d samples added to %s in %.1f s'%(quality.count,quality_index,quality.seconds))
+    print(idle_latency.report())
+    print(hw.grbl.report())
+    if settler: print(settler.report())
+    if probes: print('%d of %d samples unchanged since %s'%(probes.unchanged,probes.compared,probes.previous))
+    seconds=clock.time()-t0
+    print(timings.report(nwells,seconds))
+    timings.write_metrics(imgpath+'/metrics.prom',nwells,seconds)
+    if metrics_file: timings.write_metrics(metrics_file,nwells,seconds)
+    return {'wells':nwells,'images':nimg,'seconds':seconds,'bytes':timings.nbytes,'stopped':stopped,'hidden':hidden,'late':late,
+            'fused':len(fusion.done) if fusion else 0,'unfused':fusion.pending() if fusion else 0,'focus':focus,
+            'af_images_saved':focuslog.saved_images if focuslog else 0,'af_seconds_saved':focuslog.saved_seconds if focuslog else 0.,
+            'resumed':len(done),'overview':ov,'cleaned':cleaned,
+            'unchanged':probes.unchanged if probes else 0,'compared':probes.compared if probes else 0}
@@ -0,0 +1,114 @@
+# time-lapse schedule: plates imaged again and again without anyone there
+#
+#   python ami_schedule.py add plateA.config 0,1,3,7,14   # now, then 1, 3, 7 and 14 days from now
+#   python ami_schedule.py add plateB.config 0,2 --lights 12 --start 2026-10-18_20:00
+#   python ami_schedule.py list
+#   python ami_schedule.py remove plateA.config
+#
+# schedule.txt (next to AMi.config) has a line for each plate: its configuration file,
+# when it was set up, the days after that it is to be imaged, which of those are done and
+# which lights it needs.  The GUI looks at it every minute while nothing else is going
+# on; when plates are due it loads each one's configuration, turns its lights on and
+# RUNs it, one straight after another, with no homing in between.  A time that was
+# missed (the pi was off, another plate was running) is made up as soon as possible, and
+# one run covers all the times that are due, so a plate is never imaged twice in a row.
+# The file is rewritten (whole, then renamed) as each run finishes, so the schedule
+# carries on where it was after a restart; a run that was cut short is carried on by
+# RUN's journal.
+#
+#   # config        start             days        done  lights
+#   plateA.config   2026-10-17_21:00  0,1,3,7,14  0,1   1
+
+import os, time
+
+time_format='%Y-%m-%d_%H:%M'
+
+class Entry: # one plate on the schedule
+    def __init__(self,config,start,days,done=(),lights='1'):
+        self.config=config
+        self.start=start # seconds since the epoch
+        self.days=sorted(float(d) for d in days)
+        self.done=set(float(d) for d in done)
+        self.lights=lights # which lights to turn on: '1', '2', '12' or '0'
+
+    def due(self,now=None): # days that have come round and are not done yet
+        now=time.time() if now is None else now
+        return [d for d in self.days if d not in self.done and self.start+d*86400.<=now]
+
+    def next(self): # when the next imaging not done yet is, or None when it is all done
+        left=[d for d in self.days if d not in self.done]
+        return self.start+left[0]*86400. if left else None
+
+def days_text(days): return ','.join('%g'%d for d in days) or '-'
+
+class Schedule:
+    def __init__(self,path='schedule.txt'):
+        self.path=path
+        self.entries=[]
+        if os.path.exists(path): self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                w=line.split('#',1)[0].split()
+                if len(w)<3: continue
+                done=[d for d in w[3].split(',') if d!='-'] if len(w)>3 else []
+                self.entries.append(Entry(w[0],time.mktime(time.strptime(w[1],time_format)),w[2].split(','),done,
+                                          w[4] if len(w)>4 else '1'))
+
+    def save(self): # written to a temporary file first so a crash never leaves half a schedule
+        tmp=self.path+'.part'
+        with open(tmp,'w') as f:
+            f.write('# config        start             days        done  lights\n')
+            for e in self.entries:
+                f.write('%-15s %s  %-11s %-5s %s\n'%(e.config,time.strftime(time_format,time.localtime(e.start)),
+                                                     days_text(e.days),days_text(sorted(e.done)),e.lights))
+        os.replace(tmp,self.path)
+
+    def add(self,config,days,start=None,lights='1'): # a plate already on the schedule is started over
+        self.remove(config)
+        e=Entry(config,time.time() if start is None else start,days,(),lights)
+        self.entries.append(e)
+        self.save()
+        return e
+
+    def remove(self,config):
+        n=len(self.entries)
+        self.entries=[e for e in self.entries if e.config!=config]
+        if len(self.entries)!=n: self.save()
+        return len(self.entries)!=n
+
+    def due(self,now=None): # plates to image now, the one that has waited longest first
+        now=time.time() if now is None else now
+        return sorted((e for e in self.entries if e.due(now)),key=lambda e:e.start+e.due(now)[0]*86400.)
+
+    def finished(self,entry,now=None): # entry has just been imaged: everything due is done
+        entry.done.update(entry.due(now))
+        self.save()
+
+    def report(self,now=None):
+        now=time.time() if now is None else now
+        lines=[]
+        for e in self.entries:
+            t=e.next()
+            when='all done' if t is None else 'due now' if t<=now else 'next '+time.strftime('%a %d %b %H:%M',time.localtime(t))
+            lines.append('%-15s days %-11s done %-11s %s'%(e.config,days_text(e.days),days_text(sorted(e.done)),when))
+        return '\n'.join(lines) or 'nothing scheduled'
+
+if __name__=='__main__':
+    import argparse
+    p=argparse.ArgumentParser(description='plates for the GUI to image on a timetable')
+    p.add_argument('what',choices=('add','remove','list'))
+    p.add_argument('config',nargs='?',help='configuration file of the plate')
+    p.add_argument('days',nargs='?',default='0,1,3,7,14',help='days after the start to image it (default 0,1,3,7,14)')
+    p.add_argument('--start',help='when day 0 is, as YYYY-MM-DD_HH:MM (default now)')
+    p.add_argument('--lights',default='1',help='lights to turn on: 1, 2, 12 or 0 (default 1)')
+    p.add_argument('--file',default='schedule.txt',help='schedule file (default schedule.txt)')
+    args=p.parse_args()
+    sched=Schedule(args.file)
+    if args.what!='list' and not args.config: p.error('which configuration file?')
+    if args.what=='add':
+        if not os.path.exists(args.config): p.error(args.config+' not found')
+        sched.add(args.config,args.days.split(','),time.mktime(time.strptime(args.start,time_format)) if args.start else None,args.lights)
+    elif args.what=='remove' and not sched.remove(args.config): print(args.config+' was not on the schedule')
+    print(sched.report())
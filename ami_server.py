@@ -0,0 +1,426 @@
+# control server: drive AMi over the network, with or without the GUI
+#
+#   python3 ami_server.py AMi.config                # headless, on the real hardware
+#   python3 ami_server.py --sim --port 8765 AMi.config
+#   python3 ami_server.py --check                   # drives a server on the simulator and checks what it does
+#
+# The GUI starts one too when control_address is set.  Everything is JSON over HTTP:
+#
+#   GET  /status                          where the stage is, lights, who has it, the run
+#   POST /goto    {"well": "B7"}  or  {"x": 60.1, "y": 40.2, "z": 7.3}
+#   POST /snap    {}                      picture into images/<sID>/<nroot>/snaps
+#   POST /stack   {"nimages": 5, "zstep": 0.3}   z-stack there, like right click on snap
+#   POST /light   {"light": 1, "on": true}
+#   POST /run     {"config": "plateB.config"}    RUN (the loaded plate without config)
+#   POST /stop    {}
+#   GET  /events                          websocket (or text/event-stream without Upgrade):
+#                                         a JSON message for every move, picture, light and
+#                                         sample RUN finishes, as it happens
+#
+# Only one of the GUI, RUN and a client can use the stage and camera at a time: they all
+# go through one CommandLock, and a command that cannot have it gets 409 with who has it.
+# A command blocks its own connection until it is done (a goto answers once the stage has
+# stopped); /run answers as soon as the run has started and /events tells how it goes.
+# Once RUN is over the lights are what it left them (off, unless it could not turn them
+# off) and the focus map has what autofocus found, as when RUN is clicked in the GUI.
+# With a token, every request needs "Authorization: Bearer <token>" (or ?token=<token>).
+#
+# Runs on asyncio on a thread of its own; the commands themselves, which wait on grbl and
+# the camera, run on worker threads so the server keeps answering /status and /events.
+
+import asyncio, base64, contextlib, hashlib, json, os, struct, threading, time
+from urllib.parse import urlsplit, parse_qs
+import ami_run, ami_plan, ami_stack, ami_focusmap
+
+class Busy(RuntimeError): # someone else has the stage
+    def __init__(self,holder,message=None):
+        RuntimeError.__init__(self,message or holder+' has the stage')
+        self.holder=holder
+
+class CommandLock: # the stage and camera, for one of the GUI, RUN or a remote client at a time
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.holder=None
+
+    def acquire(self,who): # True if who has it now; never waits
+        if not self.lock.acquire(blocking=False): return False
+        self.holder=who
+        return True
+
+    def release(self,who=None): # with who, only if who still has it
+        if who is not None and self.holder!=who: return
+        self.holder=None
+        self.lock.release()
+
+    def hand_over(self,frm,to): # e.g. from the GUI's click on RUN to RUN itself, without letting go
+        if self.holder==frm: self.holder=to
+
+class Controller: # the commands, for the server (and anything else) to call from any thread
+    def __init__(self,hw,plate,options=None,limits=(160.,118.,29.3),order='serpentine',resume_within=6.,fuse=True,
+                 fname=None,images='images',where=None,focus_maps=True):
+        # plate() is the ami_run.Plate to use, options() the run_plate keyword arguments RUN is to use and
+        # where() the machine position if something else (the GUI) moves the stage too
+        # focus_maps gives a plate RUN from its configuration file the focus map next to it (see ami_focusmap)
+        self.hw=hw; self.plate=plate; self.options=options or (lambda: {}); self.where=where; self.focus_maps=focus_maps
+        self.limits=limits; self.order=order; self.resume_within=resume_within; self.fuse=fuse
+        self.fname=fname; self.images=images
+        self.lock=CommandLock()
+        self.listeners=[] # fn(event) for every event, called on whatever thread made it
+        self.position=[0.,0.,0.]; self.well=None # where the stage is, if where is not given
+        self.lights={1:False,2:False}
+        self.run=None # what RUN is doing or last did
+        self.stopping=False
+
+    def publish(self,kind,**data):
+        event=dict(data,event=kind,time=round(time.time(),3))
+        for fn in list(self.listeners): fn(event)
+
+    def check_up(self): # the GUI opens the window before homing and the camera are done
+        if not self.hw: raise Busy('offline','offline: there is no hardware')
+        if not self.hw.up(): raise Busy('startup','still starting up: '+', '.join(p+' '+s for p,s in self.hw.status.items()))
+
+    @contextlib.contextmanager
+    def holding(self,who='remote'):
+        self.check_up()
+        if not self.lock.acquire(who): raise Busy(self.lock.holder)
+        try: yield
+        finally: self.lock.release(who)
+
+    def here(self):
+        return [float(c) for c in self.where()] if self.where else self.position
+
+    def status(self):
+        return {'holder':self.lock.holder,'position':[round(c,3) for c in self.here()],'well':self.well,
+                'lights':{str(k):v for k,v in self.lights.items()},'run':self.run,
+                'hardware':dict(self.hw.status) if self.hw else 'offline'}
+
+    def goto(self,well=None,x=None,y=None,z=None): # a sample by name (B7, b7c, 19...) or machine coordinates
+        p=self.plate()
+        if well is not None:
+            plan=ami_plan.PlatePlan(p)
+            i=plan.find(str(well))
+            if i is None: raise ValueError('no sample '+str(well)+' on this plate')
+            xyz=plan.xyz[i]; name=plan.names[i]; at=[int(c) for c in plan.where[i]]
+        else:
+            if x is None or y is None or z is None: raise ValueError('goto needs a well or x, y and z')
+            xyz=(float(x),float(y),float(z)); name=None; at=None
+        if not (0.<xyz[0]<self.limits[0] and 0.<xyz[1]<self.limits[1] and 0.<xyz[2]<self.limits[2]):
+            raise ValueError('that move would take you out of bounds')
+        with self.holding():
+            self.position=list(ami_run.goto(self.hw,xyz)); self.well=name
+        self.publish('position',position=self.position,well=name,at=at)
+        return self.status()
+
+    def snaps_dir(self,p):
+        d=self.images
+        for part in (p.sID,p.nroot,'snaps'):
+            d+='/'+part
+            if not os.path.isdir(d): os.mkdir(d)
+        return d
+
+    def snap(self): # one picture where the stage is
+        p=self.plate()
+        path=self.snaps_dir(p)+'/'+(self.well or 'snap')+'_'+ami_run.tdate()+'.jpg'
+        with self.holding(): self.hw.camera.capture(path)
+        self.publish('snap',path=path)
+        return {'path':path}
+
+    def stack(self,nimages=None,zstep=None): # z-stack where the stage is, and a .com file to fuse it
+        p=self.plate(); opts=self.options()
+        nimages=int(nimages or p.nimages); zstep=float(zstep or p.zstep)
+        frac=opts.get('fracbelow',0.5)
+        here=self.here(); z0=here[2]
+        zs=[z0-(1-frac)*(nimages-1)*zstep+k*zstep for k in range(nimages)]
+        if zs[0]<=0. or zs[-1]>=self.limits[2]: raise ValueError('that stack would take you out of bounds')
+        d=self.snaps_dir(p)
+        name=(self.well or 'snap')+'_'+ami_run.tdate()
+        names=[name+'_'+str(k)+'.jpg' for k in range(nimages)]
+        with self.holding():
+            ami_run.take_stack(self.hw,zs,[d+'/'+n for n in names],self.hw.camera.capture,opts.get('camera_delay',0.2))
+            ami_run.goto(self.hw,here) # back to where it was
+        with open(d+'/'+name+'_process_snap.com','w') as f:
+            f.write('rm OUT*.tif \nalign_image_stack -m -a OUT '+' '.join(names)+'  \n')
+            f.write('enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1 --hard-mask --output='+name+'.tif OUT*.tif \nrm OUT*.tif \n')
+        self.publish('stack',paths=[d+'/'+n for n in names])
+        return {'paths':[d+'/'+n for n in names]}
+
+    def light(self,light,on=True): # 1: gpio 17; 2: gpio 18 and the spindle output of the arduino
+        light=int(light); on=bool(on)
+        if light not in (1,2): raise ValueError('light is 1 or 2')
+        with self.holding():
+            GPIO=self.hw.GPIO
+            GPIO.output(17 if light==1 else 18,GPIO.HIGH if on else GPIO.LOW)
+            if light==2:
+                self.hw.grbl.command('m3' if on else 'm5')
+        self.lights[light]=on
+        self.publish('light',light=light,on=on)
+        return self.status()
+
+    def start_run(self,config=None): # RUN on a thread of its own; returns once it has started
+        p=ami_run.read_config(config) if config else self.plate()
+        if config and self.focus_maps: p.focusmap=ami_focusmap.FocusMap(ami_focusmap.path_for(config,p.sID,p.nroot))
+        self.check_up()
+        if not self.lock.acquire('RUN'): raise Busy(self.lock.holder)
+        try:
+            imgpath,plan,resume=ami_run.prepare_run(p,self.order,config or self.fname,self.resume_within,self.limits,
+                                                    self.options().get('fracbelow',0.5),self.images)
+        except Exception:
+            self.lock.release('RUN')
+            raise
+        self.stopping=False
+        self.run={'state':'running','imgpath':imgpath,'resumed':resume,'done':0,'total':len(plan.run),'eta':None}
+        self.publish('run',**self.run)
+        threading.Thread(target=self._run,args=(p,imgpath,plan,resume),name='ami-run',daemon=True).start()
+        return self.run
+
+    def _run(self,p,imgpath,plan,resume):
+        fusion=ami_stack.FusionPool() if self.fuse else None
+        def show(yrow,xcol,samp,mx,my,mz):
+            self.position=[mx,my,mz]; self.well=ami_run.well_name(p,yrow,xcol,samp)
+            self.publish('position',position=self.position,well=self.well,at=[yrow,xcol,samp])
+        def progress(name,done,total,secs,eta):
+            self.run.update(done=done,total=total,eta=round(eta))
+            self.publish('sample',name=name,done=done,total=total,seconds=round(secs,2),eta=round(eta))
+        stats=None
+        try:
+            stats=ami_run.run_plate(self.hw,p,imgpath,show=show,stop=lambda: self.stopping,plan=plan,fusion=fusion,
+                                    resume=resume,progress=progress,**self.options())
+            self.run.update(state='stopped' if stats['stopped'] else 'finished',wells=stats['wells'],seconds=round(stats['seconds'],1))
+        except Exception as e:
+            self.run.update(state='failed',error=str(e))
+        finally:
+            if fusion: fusion.close(wait=False)
+            self.after_run(p,stats)
+            self.lock.release('RUN')
+        self.publish('run',**self.run)
+
+    def after_run(self,p,stats): # the lights and the focus map, as the GUI has them after its own RUN
+        for light,pin in ((1,17),(2,18)):
+            on=False # run_plate turned them off
+            if not (stats and stats['cleaned']): # failed, maybe before it got that far: see what they are
+                try: on=bool(self.hw.GPIO.input(pin))
+                except Exception: on=self.lights[light]
+            self.lights[light]=on
+            self.publish('light',light=light,on=on)
+        if stats and stats['focus'] and p.focusmap:
+            try:
+                for (y,x,sa),z in stats['focus'].items(): p.focusmap.add(p,y,x,sa,z)
+                p.focusmap.fit().save()
+                print(p.focusmap.report(p))
+            except Exception as e: print('focus map not updated: '+str(e))
+
+    def stop(self): # RUN stops before its next move
+        if not self.run or self.run['state']!='running': raise ValueError('RUN is not going')
+        self.stopping=True
+        self.publish('stopping')
+        return self.run
+
+class Server: # the HTTP and websocket side, on its own thread and event loop
+    def __init__(self,controller,host='127.0.0.1',port=8765,token=None):
+        self.controller=controller; self.host=host; self.port=port; self.token=token
+        self.loop=None; self.server=None
+        self.queues=set() # one per /events connection
+        self.ready=threading.Event()
+        controller.listeners.append(self._event)
+        self.commands={'/goto':controller.goto,'/snap':controller.snap,'/stack':controller.stack,'/light':controller.light,
+                       '/run':controller.start_run,'/stop':controller.stop}
+
+    def start(self): # returns once it is listening
+        threading.Thread(target=self._serve,name='ami-server',daemon=True).start()
+        self.ready.wait()
+        return self
+
+    def _serve(self):
+        self.loop=asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server=self.loop.run_until_complete(asyncio.start_server(self._client,self.host,self.port))
+        self.port=self.server.sockets[0].getsockname()[1] # when port was 0
+        print('control server on http://%s:%d'%(self.host,self.port))
+        self.ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop: self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _event(self,event): # from any thread: to every /events connection
+        if self.loop: self.loop.call_soon_threadsafe(self._fan_out,event)
+
+    def _fan_out(self,event):
+        for q in list(self.queues):
+            if q.qsize()<1000: q.put_nowait(event) # a client that reads nothing only loses its own events
+
+    async def _client(self,reader,writer):
+        try:
+            while True: # keep-alive: one request after another
+                line=await reader.readline()
+                if not line: break
+                method,target,_=line.decode('latin-1').split(' ',2)
+                headers={}
+                while True:
+                    h=(await reader.readline()).decode('latin-1').strip()
+                    if not h: break
+                    k,v=h.split(':',1); headers[k.strip().lower()]=v.strip()
+                body=await reader.readexactly(int(headers.get('content-length',0)))
+                url=urlsplit(target)
+                if self.token and headers.get('authorization')!='Bearer '+self.token and parse_qs(url.query).get('token',[''])[0]!=self.token:
+                    await self._reply(writer,401,{'error':'needs the token'}); continue
+                if url.path=='/events' and method=='GET':
+                    if headers.get('upgrade','').lower()=='websocket': await self._websocket(reader,writer,headers)
+                    else: await self._event_stream(writer)
+                    break
+                code,answer=await self._handle(method,url.path,body)
+                await self._reply(writer,code,answer)
+                if headers.get('connection','').lower()=='close': break
+        except (ConnectionError,asyncio.IncompleteReadError,ValueError): pass
+        finally:
+            writer.close()
+
+    async def _handle(self,method,path,body):
+        if path=='/status' and method=='GET': return 200,self.controller.status()
+        if path not in self.commands: return 404,{'error':'no such command: '+path}
+        if method!='POST': return 405,{'error':path+' needs POST'}
+        try: args=json.loads(body or b'{}')
+        except ValueError: return 400,{'error':'body is not JSON'}
+        if not isinstance(args,dict): return 400,{'error':'body is not a JSON object'}
+        try: return 200,await self.loop.run_in_executor(None,lambda: self.commands[path](**args))
+        except Busy as e: return 409,{'error':str(e),'holder':e.holder}
+        except (TypeError,ValueError,OSError) as e: return 400,{'error':str(e)}
+        except Exception as e: return 500,{'error':str(e)}
+
+    async def _reply(self,writer,code,answer):
+        body=json.dumps(answer).encode('utf-8')
+        reason={200:'OK',400:'Bad Request',401:'Unauthorized',404:'Not Found',405:'Method Not Allowed',409:'Conflict'}.get(code,'Error')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'%(code,reason,len(body))).encode('latin-1')+body)
+        await writer.drain()
+
+    async def _event_stream(self,writer): # server-sent events, for curl and browsers
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+        await self._send_events(writer,lambda e: ('data: '+json.dumps(e)+'\n\n').encode('utf-8'))
+
+    async def _websocket(self,reader,writer,headers):
+        accept=base64.b64encode(hashlib.sha1((headers.get('sec-websocket-key','')+'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest()).decode()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: '+accept+'\r\n\r\n').encode())
+        listen=asyncio.ensure_future(self._ws_read(reader,writer))
+        try: await self._send_events(writer,lambda e: ws_frame(json.dumps(e).encode('utf-8')),listen)
+        finally: listen.cancel()
+
+    async def _ws_read(self,reader,writer): # answers pings; returns when the client closes
+        while True:
+            b0,b1=await reader.readexactly(2)
+            n=b1&0x7f
+            if n==126: n=struct.unpack('>H',await reader.readexactly(2))[0]
+            elif n==127: n=struct.unpack('>Q',await reader.readexactly(8))[0]
+            mask=await reader.readexactly(4) if b1&0x80 else b'\0\0\0\0'
+            data=bytes(c^mask[i%4] for i,c in enumerate(await reader.readexactly(n)))
+            op=b0&0x0f
+            if op==8: # close
+                writer.write(ws_frame(data[:2],8)); return
+            if op==9: writer.write(ws_frame(data,10)) # ping: pong
+
+    async def _send_events(self,writer,encode,until=None):
+        q=asyncio.Queue()
+        self.queues.add(q)
+        try:
+            writer.write(encode(dict(self.controller.status(),event='status',time=round(time.time(),3))))
+            await writer.drain()
+            while not (until and until.done()):
+                try: event=await asyncio.wait_for(q.get(),15.)
+                except asyncio.TimeoutError: event={'event':'alive','time':round(time.time(),3)} # keeps proxies and dead peers honest
+                writer.write(encode(event))
+                await writer.drain()
+        finally: self.queues.discard(q)
+
+def ws_frame(data,op=1): # one unmasked websocket frame, text by default
+    n=len(data)
+    if n<126: head=struct.pack('>BB',0x80|op,n)
+    elif n<65536: head=struct.pack('>BBH',0x80|op,126,n)
+    else: head=struct.pack('>BBQ',0x80|op,127,n)
+    return head+data
+
+def check(speed=50.): # a server on the simulator, driven over HTTP with the events read from a websocket
+    import ami_hardware, socket, tempfile, urllib.request, urllib.error
+    tmp=tempfile.mkdtemp(prefix='ami_server_check_')
+    hw=ami_hardware.open_hardware(True,speed,images=True)
+    hw.camera.focus=lambda x,y: 7.3 # flat, and between the corners' z: somewhere for autofocus to find
+    GPIO=hw.GPIO
+    GPIO.setmode(GPIO.BCM); GPIO.setup(17,GPIO.OUT); GPIO.setup(18,GPIO.OUT)
+    with contextlib.redirect_stdout(None): ami_run.home(hw)
+    plate=ami_run.Plate(nx=3,ny=2,nimages=3,focusmap=ami_focusmap.FocusMap(tmp+'/focusmap.txt'))
+    control=Controller(hw,lambda: plate,lambda: {'preview':False,'overview':False,'autofocus_images':2},fuse=False,images=tmp)
+    server=Server(control,'127.0.0.1',0).start()
+    def call(path,body=None): # (HTTP status, answer)
+        req=urllib.request.Request('http://127.0.0.1:%d%s'%(server.port,path),None if body is None else json.dumps(body).encode())
+        try:
+            with urllib.request.urlopen(req,timeout=60) as r: return r.status,json.load(r)
+        except urllib.error.HTTPError as e: return e.code,json.load(e)
+    ws=socket.create_connection(('127.0.0.1',server.port),timeout=120)
+    ws.sendall(b'GET /events HTTP/1.1\r\nHost: ami\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+               b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+    f=ws.makefile('rb')
+    assert b' 101 ' in f.readline(),'no websocket'
+    while f.readline().strip(): pass
+    def event(kind,**like): # reads events until one of kind with the values in like
+        while True:
+            b0,b1=f.read(2); n=b1&0x7f
+            if n==126: n=struct.unpack('>H',f.read(2))[0]
+            e=json.loads(f.read(n))
+            if e['event']==kind and all(e.get(k)==v for k,v in like.items()): return e
+    event('status')
+    with contextlib.redirect_stdout(None):
+        assert control.lock.acquire('GUI')
+        code,a=call('/goto',{'well':'B2'})
+        assert code==409 and a['holder']=='GUI','goto while the GUI has the stage: %d %s'%(code,a)
+        control.lock.release('GUI')
+        code,a=call('/goto',{'well':'B2'})
+        assert code==200 and a['well']=='B2','goto: %d %s'%(code,a)
+        code,a=call('/light',{'light':1,'on':True})
+        assert code==200 and a['lights']['1'] and GPIO.input(17),'light 1 on: %d %s'%(code,a)
+        event('light',light=1,on=True)
+        code,a=call('/run',{})
+        assert code==200 and a['state']=='running','run: %d %s'%(code,a)
+        code,a=call('/light',{'light':2,'on':True})
+        assert code==409 and a['holder']=='RUN','light while RUN has the stage: %d %s'%(code,a)
+        event('sample')
+        assert call('/stop',{})[0]==200
+        event('light',light=1,on=False) # what RUN left them, before it says it has stopped
+        event('run',state='stopped')
+        code,a=call('/status')
+        assert not a['lights']['1'] and not GPIO.input(17),'light 1 after RUN: %s'%a
+        code,a=call('/run',{}) # carries on where it stopped
+        assert code==200 and a['resumed'],'resume: %d %s'%(code,a)
+        e=event('run',state='finished')
+        assert len(plate.focusmap.points)==e['total'] and os.path.exists(tmp+'/focusmap.txt'),'focus map: %s'%plate.focusmap.points
+    print('lock, light, RUN, STOP and the focus map all as they should be; %d samples resumed and finished'%e['wells'])
+    ws.close(); hw.grbl.close(); hw.s.close()
+
+if __name__=='__main__':
+    import argparse, ami_hardware
+    p=argparse.ArgumentParser(description='drive AMi over the network without the GUI')
+    p.add_argument('config',nargs='?',default='AMi.config',help='configuration file of the plate (default AMi.config)')
+    p.add_argument('--sim',action='store_true',help='use the simulated grbl, camera and gpio')
+    p.add_argument('--speed',type=float,default=1.,help='with --sim, how much faster than real time')
+    p.add_argument('--host',default='127.0.0.1',help='address to listen on (0.0.0.0 for the whole network)')
+    p.add_argument('--port',type=int,default=8765)
+    p.add_argument('--token',help='needed by every request when given')
+    p.add_argument('--check',action='store_true',help='drive a server on the simulator and check what it does')
+    args=p.parse_args()
+    if args.check:
+        check()
+        raise SystemExit
+    if not os.path.isdir('images'): os.mkdir('images')
+    hw=ami_hardware.open_hardware(args.sim,args.speed,images=args.sim)
+    hw.camera.resolution=(1640,1232)
+    GPIO=hw.GPIO
+    GPIO.setmode(GPIO.BCM); GPIO.setwarnings(False)
+    GPIO.setup(17,GPIO.OUT); GPIO.setup(18,GPIO.OUT)
+    GPIO.setup(27,GPIO.IN,pull_up_down=GPIO.PUD_DOWN)
+    ami_run.home(hw)
+    plate=ami_run.read_config(args.config)
+    control=Controller(hw,lambda: plate,lambda: {'preview':False},fname=args.config)
+    server=Server(control,args.host,args.port,args.token).start()
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt: pass
+    GPIO.output(17,GPIO.LOW); GPIO.output(18,GPIO.LOW)
+    hw.grbl.close()
+    hw.s.close()
@@ -0,0 +1,86 @@
+# settle: how long to let the stage stop shaking before each picture
+#
+# RUN used to sleep camera_delay after every move, however far it was.  A 0.3 mm z step
+# is still almost at once; the first slice after a long move to the next well can ring
+# for longer.  A Settler decides each time, one of three ways (settle_mode):
+#
+#   'fixed'   camera_delay every time, as before
+#   'frames'  grab small video-port frames until two in a row differ by less than
+#             threshold grey levels on average, so the wait is measured, not guessed
+#   'model'   settle_min + settle_per_mm times the distance moved since the last picture
+#
+# and never longer than cap.  Every wait goes into settle.log in the run directory with
+# the distance moved, and report() fits min + per_mm * distance to what 'frames' measured:
+# run once with 'frames' and the numbers for 'model' (which costs no frames at all) come
+# out for that instrument.  Burst captures have the video port busy, so there 'frames'
+# goes by the model.
+#
+#   # sample  distance_mm  settle_s  frames  capped
+
+import numpy as np
+import ami_focus
+
+modes=('fixed','frames','model')
+
+class Settler:
+    def __init__(self,mode='fixed',delay=0.2,settle_min=0.05,per_mm=0.005,cap=1.0,threshold=1.5,size=(160,120),log=None,append=False):
+        if mode not in modes: raise ValueError('settle mode is one of '+', '.join(modes))
+        self.mode=mode; self.delay=delay
+        self.settle_min=settle_min; self.per_mm=per_mm; self.cap=cap
+        self.threshold=threshold; self.size=size
+        self.pos=None # where the last picture was taken from
+        self.distance=0. # moved since then, mm
+        self.sample='-'
+        self.measured=[] # (distance, seconds) 'frames' found
+        self.waited=[] # seconds of every wait
+        self.log=log
+        if log and not append:
+            with open(log,'w') as f: f.write('# sample  distance_mm  settle_s  frames  capped\n')
+
+    def moved(self,x=None,y=None,z=None): # the stage has gone to x,y,z (any left out did not change)
+        to=[x,y,z]
+        if self.pos is None: self.pos=[c or 0. for c in to]
+        to=[p if c is None else float(c) for c,p in zip(to,self.pos)]
+        self.distance+=float(np.sqrt(sum((a-b)**2 for a,b in zip(to,self.pos))))
+        self.pos=to
+
+    def guess(self,distance): # what the model says for a move of distance mm
+        if self.mode=='fixed': return self.delay
+        return min(self.cap,self.settle_min+self.per_mm*distance)
+
+    def wait(self,hw,frames=True): # settle after the moves since the last picture; returns seconds waited
+        # frames=False when the video port is taken (burst captures)
+        clock=hw.clock
+        t0=clock.time(); n=0
+        if self.mode=='frames' and frames:
+            prev=ami_focus.grab(hw.camera,self.size).astype(np.int16)
+            while clock.time()-t0<self.cap:
+                cur=ami_focus.grab(hw.camera,self.size).astype(np.int16)
+                n+=1
+                if np.mean(np.abs(cur-prev))<self.threshold: break
+                prev=cur
+            secs=clock.time()-t0
+            if secs<self.cap: self.measured.append((self.distance,secs))
+        else:
+            clock.sleep(self.guess(self.distance))
+            secs=clock.time()-t0
+        self.waited.append(secs)
+        if self.log:
+            with open(self.log,'a') as f:
+                f.write('%-8s %9.3f %8.3f %5d  %s\n'%(self.sample,self.distance,secs,n,'yes' if secs>=self.cap else 'no'))
+        self.distance=0.
+        return secs
+
+    def fit(self): # (settle_min, per_mm) that fit what 'frames' measured, or None with too little to go on
+        if len(self.measured)<4: return None
+        d,s=np.array(self.measured).T
+        if np.ptp(d)<1.: return None # all short moves: nothing to learn the slope from
+        per_mm,smin=np.polyfit(d,s,1)
+        return max(float(smin),0.),max(float(per_mm),0.)
+
+    def report(self):
+        if not self.waited: return 'settle (%s): no waits'%self.mode
+        line='settle (%s) %d times: median %.3f s, longest %.3f s'%(self.mode,len(self.waited),np.median(self.waited),max(self.waited))
+        f=self.fit()
+        if f: line+='; for settle_mode=\'model\' use settle_min=%.3f, settle_per_mm=%.4f'%f
+        return line
@@ -0,0 +1,209 @@
+# focus stacking without align_image_stack and enfuse
+#
+#   python ami_stack.py images/AMi_sample/AB_xs2/Oct-17-2026_11:02PM        # every sample in the run
+#   python ami_stack.py images/AMi_sample/AB_xs2/Oct-17-2026_11:02PM A1 B7  # just these
+#
+# Does what the process<plate>.com script does, the same way
+#   align_image_stack -m -a OUT ... ; enfuse --contrast-weight=1 --hard-mask ...
+# would: every slice is lined up with the one before it (phase correlation, to the nearest
+# pixel), and each pixel of the result comes from whichever slice has the most local
+# contrast there (standard deviation of the brightness in a 5x5 window, like enfuse's
+# default contrast window).  Slices go through one at a time, so memory use stays at a
+# few frames however many images there are per sample.  The result is written as
+# <sample>.tif in the run directory, where sourcing the .com file would have put it.
+# Needs PIL (pillow) to read and write the images.
+#
+# During RUN a FusionPool fuses each sample in other processes as soon as its last slice
+# is on disk, so most of the plate is done by the time the stage gets home.
+
+import numpy as np
+import os, re, sys, threading
+from concurrent.futures import ProcessPoolExecutor
+
+version=1 # of what fusion makes of a stack: bump it when that changes, and ami_reprocess fuses everything again
+
+def load(path): # rgb image as a uint8 array
+    from PIL import Image
+    with Image.open(path) as im: return np.asarray(im.convert('RGB'))
+
+def save(path,img):
+    from PIL import Image
+    tmp=path+'.part'
+    Image.fromarray(img).save(tmp,format='TIFF')
+    os.replace(tmp,path)
+
+def gray(img): # brightness, as float32
+    return img[:,:,0]*np.float32(0.299)+img[:,:,1]*np.float32(0.587)+img[:,:,2]*np.float32(0.114)
+
+def box_mean(a,r): # mean over a (2r+1) x (2r+1) window, from an integral image
+    p=np.pad(a.astype(np.float64),r+1,mode='edge')
+    c=p.cumsum(0).cumsum(1)
+    n=2*r+1
+    s=c[n:,n:]-c[:-n,n:]-c[n:,:-n]+c[:-n,:-n]
+    return s[:a.shape[0],:a.shape[1]]/(n*n)
+
+def local_contrast(g,window=5): # standard deviation of the brightness around each pixel
+    r=window//2
+    m=box_mean(g,r)
+    return np.sqrt(np.maximum(box_mean(g*g,r)-m*m,0.)).astype(np.float32)
+
+def find_shift(ref,img,down=2): # (dy,dx) to move img by so it lines up with ref
+    a=ref[::down,::down]; b=img[::down,::down]
+    w=np.outer(np.hanning(a.shape[0]),np.hanning(a.shape[1])).astype(np.float32)
+    fa=np.fft.rfft2((a-a.mean())*w); fb=np.fft.rfft2((b-b.mean())*w)
+    r=fa*np.conj(fb)
+    c=np.fft.irfft2(r/np.maximum(np.abs(r),1e-9),s=a.shape)
+    py,px=np.unravel_index(np.argmax(c),c.shape)
+    def sub(cm,c0,cp): # parabola through the peak and its neighbours
+        d=cm-2.*c0+cp
+        return 0. if d==0. else 0.5*(cm-cp)/d
+    dy=py+sub(c[py-1,px],c[py,px],c[(py+1)%c.shape[0],px])
+    dx=px+sub(c[py,px-1],c[py,px],c[py,(px+1)%c.shape[1]])
+    if dy>a.shape[0]/2: dy-=a.shape[0]
+    if dx>a.shape[1]/2: dx-=a.shape[1]
+    return float(dy*down),float(dx*down)
+
+def shift(a,dy,dx,fill=0): # a moved down by dy and right by dx whole pixels
+    dy,dx=int(round(dy)),int(round(dx))
+    out=np.full_like(a,fill)
+    h,w=a.shape[:2]
+    if abs(dy)>=h or abs(dx)>=w: return out
+    out[max(dy,0):h+min(dy,0),max(dx,0):w+min(dx,0)]=a[max(-dy,0):h+min(-dy,0),max(-dx,0):w+min(-dx,0)]
+    return out
+
+class Stacker: # fuses a z-stack handed over one slice at a time
+    def __init__(self,align=True,window=5):
+        self.align=align; self.window=window
+        self.best=None # highest contrast so far at each pixel
+        self.fused=None
+        self.prev=None # brightness of the last slice, to line the next one up with
+        self.offset=(0.,0.) # shift of the last slice relative to the first
+        self.n=0; self.shifts=[]
+
+    def add(self,img):
+        g=gray(img)
+        if self.align and self.prev is not None:
+            dy,dx=find_shift(self.prev,g)
+            self.offset=(self.offset[0]+dy,self.offset[1]+dx)
+        self.prev=g
+        self.shifts.append(self.offset)
+        c=local_contrast(g,self.window)
+        if self.offset!=(0.,0.):
+            img=shift(img,*self.offset)
+            c=shift(c,*self.offset,fill=-1.) # nothing from outside the picture wins
+        if self.fused is None:
+            self.fused=img.copy(); self.best=c
+        else:
+            win=c>self.best # hard mask: each pixel from the sharpest slice only
+            self.fused[win]=img[win]
+            np.maximum(self.best,c,out=self.best)
+        self.n+=1
+
+    def result(self): return self.fused
+
+def slices(paths): # the images in paths in turn; a .amis stack file or .npy stack gives all of its slices
+    for p in paths:
+        if p.endswith('.amis'):
+            from ami_stackfile import StackFile
+            for img in StackFile(p): yield img
+        elif p.endswith('.npy'):
+            for img in np.load(p,mmap_mode='r'): yield img
+        else: yield load(p)
+
+def fuse_stack(paths,out=None,align=True,window=5): # fuse the images in paths, save as out if given
+    st=Stacker(align,window)
+    for img in slices(paths): st.add(img)
+    if out: save(out,st.result())
+    return st.result()
+
+def fuse_file(paths,out,align=True,window=5): # for the pool: fuse, save and only send back the name
+    fuse_stack(paths,out,align,window)
+    return out
+
+def _lower_priority(): # fusion can wait, capturing can't
+    try: os.nice(10)
+    except (AttributeError,OSError): pass
+
+class FusionPool: # fuses stacks in the background while the run goes on
+    # Uses one process fewer than there are cores, so acquisition keeps one to itself.  At
+    # most one stack per process is handed to the pool at a time; the rest wait here as
+    # file names, so submit() never blocks and never piles images up in memory.
+    def __init__(self,workers=None,align=True):
+        self.workers=workers or max(1,(os.cpu_count() or 2)-1)
+        self.align=align
+        self.pool=ProcessPoolExecutor(self.workers,initializer=_lower_priority)
+        self.waiting=[]; self.running=0
+        self.done=[]; self.failed=[]
+        self.closing=False
+        self.listeners=[]
+        self.lock=threading.Condition()
+
+    def submit(self,name,paths,out): # queue a stack; returns right away
+        with self.lock:
+            self.waiting.append((name,list(paths),out))
+            self._feed()
+
+    def on_fused(self,fn): # fn(name,out) is called (on a pool thread) as each stack is fused
+        self.listeners.append(fn)
+
+    def _feed(self):
+        while self.waiting and self.running<self.workers:
+            name,paths,out=self.waiting[0]
+            try: f=self.pool.submit(fuse_file,paths,out,self.align)
+            except RuntimeError: # python is exiting; what is left can be fused later with ami_stack.py
+                print('%d samples left unfused'%len(self.waiting))
+                self.waiting=[]
+                return
+            self.waiting.pop(0)
+            self.running+=1
+            f.add_done_callback(lambda f,name=name: self._finished(name,f))
+
+    def _finished(self,name,f):
+        with self.lock:
+            self.running-=1
+            if f.exception(): 
+                self.failed.append(name)
+                print('fusing '+name+' failed: '+str(f.exception()))
+            else:
+                self.done.append(name)
+                for fn in self.listeners: fn(name,f.result())
+            self._feed()
+            if self.closing and not self.waiting and not self.running: self.pool.shutdown(wait=False)
+            self.lock.notify_all()
+
+    def pending(self): # stacks not fused yet
+        with self.lock: return len(self.waiting)+self.running
+
+    def close(self,wait=True): # with wait=False the remaining stacks are finished in the background
+        with self.lock:
+            self.closing=True
+            if wait:
+                while self.waiting or self.running: self.lock.wait()
+            elif self.waiting or self.running: return # the last one to finish shuts the pool down
+        self.pool.shutdown(wait=wait)
+
+def find_stacks(imgpath): # {sample: [slice paths in z order]} from imgpath/rawimages (or imgpath itself, for snaps)
+    d=imgpath+'/rawimages' if os.path.isdir(imgpath+'/rawimages') else imgpath
+    stacks={}; files={}
+    for f in os.listdir(d):
+        m=re.match(r'(.+)_(\d+)\.jpg$',f)
+        if m: stacks.setdefault(m.group(1),[]).append((int(m.group(2)),d+'/'+f))
+        elif f.endswith('.amis'): files[f[:-5]]=[d+'/'+f]
+    stacks=dict((k,[p for i,p in sorted(v)]) for k,v in stacks.items())
+    for k,v in files.items(): stacks.setdefault(k,v) # stack files, where nobody has exported the jpegs
+    return stacks
+
+def fuse_run(imgpath,samples=None,align=True): # fuse every sample in a run directory into <sample>.tif
+    done=[]
+    for name,paths in sorted(find_stacks(imgpath).items()):
+        if samples and name not in samples: continue
+        print('processing: '+name)
+        fuse_stack(paths,imgpath+'/'+name+'.tif',align)
+        done.append(name)
+    return done
+
+if __name__=='__main__':
+    if len(sys.argv)<2:
+        print('usage: python ami_stack.py run_directory [sample ...]')
+        sys.exit(1)
+    fuse_run(sys.argv[1],sys.argv[2:] or None)
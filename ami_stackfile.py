@@ -0,0 +1,85 @@
+# one file per sample instead of one jpeg per slice
+#
+#   python ami_stackfile.py info rawimages/B7.amis
+#   python ami_stackfile.py export rawimages/B7.amis [...]   # B7_0.jpg, B7_1.jpg ... next to it
+#
+# With stack_files on, RUN writes each sample's z-stack as rawimages/<sample>.amis: a
+# fixed-size header with the metadata as JSON (z of each slice, machine coordinates,
+# when each slice was taken, plate and sample names) followed by the raw rgb slices,
+# each in its own chunk aligned to 4096 bytes.  One file per sample is much quicker to
+# create on the SD card and to rsync than a few thousand jpegs, and is lossless.
+#
+# StackFile memory-maps the file, so its slices are numpy views straight onto the page
+# cache: nothing is copied or decoded until it is used.  export() writes the usual
+# <sample>_<n>.jpg files for align_image_stack and enfuse, or anything else that wants them.
+
+import numpy as np
+import json, os, sys
+
+magic=b'AMISTACK'
+header_size=16384
+align=4096
+
+def write_stack(path,frames,meta): # frames: n x h x w x 3 uint8 (any strides); meta: dict saved with them
+    n,h,w=frames.shape[:3]
+    chunk=-(-h*w*3//align)*align
+    meta=dict(meta,shape=[n,h,w,3],dtype='uint8',offset=header_size,chunk=chunk)
+    head=json.dumps(meta).encode('utf-8')
+    if len(head)>header_size-16: raise ValueError('stack metadata too big for the header')
+    tmp=path+'.part'
+    with open(tmp,'wb') as f:
+        f.write(magic+np.uint32(1).tobytes()+np.uint32(len(head)).tobytes()+head)
+        f.write(bytes(header_size-f.tell()))
+        pad=bytes(chunk-h*w*3)
+        for frame in frames:
+            f.write(np.ascontiguousarray(frame).data)
+            f.write(pad)
+        size=f.tell()
+    os.replace(tmp,path)
+    return size
+
+class StackFile:
+    def __init__(self,path):
+        self.path=path
+        with open(path,'rb') as f:
+            head=f.read(16)
+            if head[:8]!=magic: raise ValueError(path+' is not a stack file')
+            self.meta=json.loads(f.read(int(np.frombuffer(head[12:16],np.uint32)[0])).decode('utf-8'))
+        self.shape=tuple(self.meta['shape'])
+        self.z=self.meta.get('z',[])
+        self.mm=np.memmap(path,np.uint8,'r')
+
+    def __len__(self): return self.shape[0]
+
+    def __getitem__(self,k): # slice k as an h x w x 3 view of the file, no copy
+        n,h,w,c=self.shape
+        if not -n<=k<n: raise IndexError('slice '+str(k)+' of '+str(n))
+        k%=n
+        start=self.meta['offset']+k*self.meta['chunk']
+        return self.mm[start:start+h*w*c].reshape(h,w,c)
+
+    def __iter__(self):
+        for k in range(len(self)): yield self[k]
+
+    def export(self,outdir=None,quality=90): # the slices as <sample>_<n>.jpg; returns their paths
+        from PIL import Image
+        outdir=outdir or os.path.dirname(self.path)
+        name=self.meta.get('sample') or os.path.splitext(os.path.basename(self.path))[0]
+        paths=[]
+        for k,frame in enumerate(self):
+            p=os.path.join(outdir,name+'_'+str(k)+'.jpg')
+            Image.fromarray(frame).save(p,format='JPEG',quality=quality)
+            paths.append(p)
+        return paths
+
+if __name__=='__main__':
+    if len(sys.argv)<3 or sys.argv[1] not in ('info','export'):
+        print('usage: python ami_stackfile.py info|export file.amis [...]')
+        sys.exit(1)
+    for path in sys.argv[2:]:
+        st=StackFile(path)
+        if sys.argv[1]=='info':
+            print(path+': %d slices of %d x %d'%(st.shape[0],st.shape[2],st.shape[1]))
+            for k,v in sorted(st.meta.items()): print('  %s: %s'%(k,v))
+        else:
+            for p in st.export(): print('wrote '+p)
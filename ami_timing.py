@@ -0,0 +1,88 @@
+# where the time goes during a RUN
+#
+# run_plate records how long every stage takes for each sample: the g-code for a move
+# ('move'), waiting for grbl to stop ('wait'), camera_delay ('settle'), taking the
+# picture ('capture'), writing it to the card ('write', with its size), the change
+# detection probe ('probe'), the autofocus sweep ('autofocus') and the whole sample ('sample').  Each one is a line in
+# timings.txt in the run directory:
+#
+#   # stage  sample  start_s  seconds  bytes
+#   move     A1      12.031   0.0012   0
+#
+# and at the end of the run a summary (median and 95th percentile of each stage,
+# samples/hour and bytes written) is printed and written as metrics.prom, in the text
+# format the node exporter's textfile collector reads.
+
+import numpy as np
+import os, threading
+
+stages=('move','wait','settle','capture','write','probe','autofocus','sample')
+
+class Timings:
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.clock=None; self.f=None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.times={} # stage -> list of seconds
+            self.nbytes=0
+            self.sample=''
+            self.t0=self.clock.time() if self.clock else 0.
+
+    def start(self,clock,path=None): # start recording a run, logging each stage to path if given
+        self.clock=clock
+        self.reset()
+        if path:
+            self.f=open(path,'w')
+            self.f.write('# stage  sample  start_s  seconds  bytes\n')
+
+    def add(self,stage,seconds,nbytes=0,sample=None): # stage just took seconds (for sample, the current one by default)
+        if self.clock is None: return
+        t=self.clock.time()
+        with self.lock:
+            self.times.setdefault(stage,[]).append(seconds)
+            self.nbytes+=nbytes
+            if self.f: self.f.write('%-9s %-6s %9.3f %8.4f %d\n'%(stage,sample or self.sample or '-',t-seconds-self.t0,seconds,nbytes))
+
+    def summary(self): # stage -> (count, median, 95th percentile, total seconds)
+        with self.lock:
+            return dict((k,(len(v),float(np.percentile(v,50)),float(np.percentile(v,95)),float(np.sum(v))))
+                        for k,v in self.times.items() if v)
+
+    def report(self,wells,seconds):
+        lines=['stage         count   median     p95    total']
+        for k,(n,p50,p95,tot) in sorted(self.summary().items(),key=lambda kv:stages.index(kv[0]) if kv[0] in stages else 99):
+            lines.append('%-10s %8d %7.3f s %6.3f s %7.1f s'%(k,n,p50,p95,tot))
+        lines.append('%.1f samples/hour, %.1f MB written'%(3600.*wells/max(seconds,1e-9),self.nbytes/1e6))
+        return '\n'.join(lines)
+
+    def metrics(self,wells,seconds): # node exporter textfile format
+        m=['# HELP ami_stage_seconds time taken by each stage of the last run',
+           '# TYPE ami_stage_seconds summary']
+        for k,(n,p50,p95,tot) in sorted(self.summary().items()):
+            m.append('ami_stage_seconds{stage="%s",quantile="0.5"} %.6f'%(k,p50))
+            m.append('ami_stage_seconds{stage="%s",quantile="0.95"} %.6f'%(k,p95))
+            m.append('ami_stage_seconds_sum{stage="%s"} %.6f'%(k,tot))
+            m.append('ami_stage_seconds_count{stage="%s"} %d'%(k,n))
+        m.append('# HELP ami_run_samples_per_hour samples imaged per hour in the last run')
+        m.append('# TYPE ami_run_samples_per_hour gauge')
+        m.append('ami_run_samples_per_hour %.3f'%(3600.*wells/max(seconds,1e-9)))
+        m.append('# HELP ami_run_bytes_written bytes of images written in the last run')
+        m.append('# TYPE ami_run_bytes_written gauge')
+        m.append('ami_run_bytes_written %d'%self.nbytes)
+        m.append('# HELP ami_run_samples samples imaged in the last run')
+        m.append('# TYPE ami_run_samples gauge')
+        m.append('ami_run_samples %d'%wells)
+        return '\n'.join(m)+'\n'
+
+    def write_metrics(self,path,wells,seconds): # written whole and renamed, so the scraper never reads half a file
+        tmp=path+'.part'
+        with open(tmp,'w') as f: f.write(self.metrics(wells,seconds))
+        os.replace(tmp,path)
+
+    def finish(self):
+        with self.lock:
+            if self.f: self.f.close()
+            self.f=None